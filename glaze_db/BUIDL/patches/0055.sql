@@ -0,0 +1,15 @@
+-- Running totals for `glaze_db/scripts/reconcile.py`. Each total covers the
+-- rows of its table with ids up to the table's watermark.
+CREATE TABLE accounting_totals (
+    asset_id int NOT NULL PRIMARY KEY REFERENCES assets (id),
+    deliveries_id int NOT NULL DEFAULT 0,
+    delivered bigint NOT NULL DEFAULT 0,
+    erc20_deposits_id int NOT NULL DEFAULT 0,
+    erc20_deposited bigint NOT NULL DEFAULT 0,
+    withdrawals_id int NOT NULL DEFAULT 0,
+    withdrawn_to_ethereum bigint NOT NULL DEFAULT 0,
+    withdrawn_to_reddit bigint NOT NULL DEFAULT 0,
+    updated_time timestamptz NOT NULL DEFAULT now()
+        CHECK (date_part('timezone', updated_time) = 0),
+    verified_time timestamptz
+        CHECK (date_part('timezone', verified_time) = 0));
@@ -0,0 +1,10 @@
+-- db_manager: no_transaction
+
+-- For `glaze_db/scripts/prune_tables.py`, which deletes old logs in order of
+-- creation_time, keeping the newest of each subreddit. The second index is
+-- also used to find the newest log of a subreddit when a balance is logged.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS subreddit_balance_logs_creation_time_idx
+    ON subreddit_balance_logs (creation_time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS
+    subreddit_balance_logs_subreddit_id_creation_time_idx
+    ON subreddit_balance_logs (subreddit_id, creation_time);
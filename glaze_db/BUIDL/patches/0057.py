@@ -0,0 +1,12 @@
+# Partitions the logs by month of creation_time, so that old logs can be
+# dropped a partition at a time and queries by time only scan the months they
+# need. New partitions are created by `manager.py partitions`, which has to run
+# at least monthly. Balance logs are copied in order of creation_time, which
+# 0056 indexed, since they have no id.
+
+partition_by_range('event_logs', 'creation_time', rows_per_second=5000)
+partition_by_range(
+    'subreddit_balance_logs',
+    'creation_time',
+    key='creation_time',
+    rows_per_second=5000)
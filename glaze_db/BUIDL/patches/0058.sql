@@ -0,0 +1,14 @@
+-- How long each patch took to apply, the rows it changed and the locks it
+-- acquired, recorded by db_manager once this patch has been applied. See
+-- `tools/db_manager/patch_history.py`.
+CREATE TABLE db_patch_history (
+    id serial PRIMARY KEY,
+    hash bytea NOT NULL,
+    file_name text NOT NULL,
+    deploy text NOT NULL,
+    run_id text NOT NULL,
+    start_time timestamp with time zone NOT NULL
+        CHECK (date_part('timezone', start_time) = 0),
+    duration interval NOT NULL,
+    rows_affected bigint,
+    locks text[]);
@@ -0,0 +1,16 @@
+#!/bin/bash
+# Run by cronjob.yaml. Creates the partitions of the coming months, drops the
+# partitions of logs older than $LOG_RETENTION, and prunes expired sessions and
+# CSRF tokens.
+
+set -e
+
+tools/db_manager/manager.sh \
+    --db_config="$DB_CONFIG,$DB_USER_CONFIG" \
+    partitions \
+    --detach_after="${LOG_RETENTION:-90 days}" \
+    --drop
+
+PYTHONPATH="$PWD" glaze_db/scripts/prune_tables.py \
+    --db_config="$DB_CONFIG,$DB_USER_CONFIG" \
+    --metrics=-
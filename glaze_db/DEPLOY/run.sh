@@ -1,7 +1,11 @@
 #!/bin/bash
 
+set -e
+
 tools/db_manager/manager.sh \
     --db_config="$DB_CONFIG,$DB_USER_CONFIG" \
     --patches="$PWD/glaze_db/BUIDL/patches" \
     --schema="$PWD/glaze_db/schema.sql" \
+    --online \
+    --lock_timeout=5s \
     upgrade -y
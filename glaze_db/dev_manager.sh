@@ -3,10 +3,14 @@ set -e -o pipefail
 workspace=$(pwd)
 "$workspace/bin/ensure_veil"
 
-"$workspace/tools/db_manager/manager.sh" \
+# Commands go to a server started with `glaze_db/dev_manager.sh serve` if one
+# is running, and are run directly otherwise.
+"$workspace/tools/db_manager/client.sh" \
+    --socket="$HOME/.pillsbury/dev/db_manager.sock" \
     --dev_mode \
     --WARNING__permit_data_loss \
     --db_config="$HOME/.pillsbury/dev/config/db.json,$HOME/.pillsbury/dev/secret/db_user.json" \
     --patches="$workspace/glaze_db/BUIDL/patches" \
     --schema="$($workspace/bin/unveil $workspace/glaze_db/schema.sql)" \
+    --snapshot_stride=10 \
     $@
@@ -658,6 +658,28 @@ CREATE TABLE public.account_types (
 
 ALTER TABLE public.account_types OWNER TO pod_admin;
 
+--
+-- Name: accounting_totals; Type: TABLE; Schema: public; Owner: pod_admin
+--
+
+CREATE TABLE public.accounting_totals (
+    asset_id integer NOT NULL,
+    deliveries_id integer DEFAULT 0 NOT NULL,
+    delivered bigint DEFAULT 0 NOT NULL,
+    erc20_deposits_id integer DEFAULT 0 NOT NULL,
+    erc20_deposited bigint DEFAULT 0 NOT NULL,
+    withdrawals_id integer DEFAULT 0 NOT NULL,
+    withdrawn_to_ethereum bigint DEFAULT 0 NOT NULL,
+    withdrawn_to_reddit bigint DEFAULT 0 NOT NULL,
+    updated_time timestamp with time zone DEFAULT now() NOT NULL,
+    verified_time timestamp with time zone,
+    CONSTRAINT accounting_totals_updated_time_check CHECK ((date_part('timezone'::text, updated_time) = (0)::double precision)),
+    CONSTRAINT accounting_totals_verified_time_check CHECK ((date_part('timezone'::text, verified_time) = (0)::double precision))
+);
+
+
+ALTER TABLE public.accounting_totals OWNER TO pod_admin;
+
 --
 -- Name: assets; Type: TABLE; Schema: public; Owner: pod_admin
 --
@@ -725,6 +747,64 @@ CREATE TABLE public.csrf_tokens (
 
 ALTER TABLE public.csrf_tokens OWNER TO pod_admin;
 
+--
+-- Name: db_backfills; Type: TABLE; Schema: public; Owner: pod_admin
+--
+
+CREATE TABLE public.db_backfills (
+    name text NOT NULL,
+    last_key text,
+    rows_updated bigint DEFAULT 0 NOT NULL,
+    done boolean DEFAULT false NOT NULL,
+    updated_time timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT db_backfills_updated_time_check CHECK ((date_part('timezone'::text, updated_time) = (0)::double precision))
+);
+
+
+ALTER TABLE public.db_backfills OWNER TO pod_admin;
+
+--
+-- Name: db_patch_history; Type: TABLE; Schema: public; Owner: pod_admin
+--
+
+CREATE TABLE public.db_patch_history (
+    id integer NOT NULL,
+    hash bytea NOT NULL,
+    file_name text NOT NULL,
+    deploy text NOT NULL,
+    run_id text NOT NULL,
+    start_time timestamp with time zone NOT NULL,
+    duration interval NOT NULL,
+    rows_affected bigint,
+    locks text[],
+    CONSTRAINT db_patch_history_start_time_check CHECK ((date_part('timezone'::text, start_time) = (0)::double precision))
+);
+
+
+ALTER TABLE public.db_patch_history OWNER TO pod_admin;
+
+--
+-- Name: db_patch_history_id_seq; Type: SEQUENCE; Schema: public; Owner: pod_admin
+--
+
+CREATE SEQUENCE public.db_patch_history_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+ALTER TABLE public.db_patch_history_id_seq OWNER TO pod_admin;
+
+--
+-- Name: db_patch_history_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: pod_admin
+--
+
+ALTER SEQUENCE public.db_patch_history_id_seq OWNED BY public.db_patch_history.id;
+
+
 --
 -- Name: db_patches; Type: TABLE; Schema: public; Owner: pod_admin
 --
@@ -841,7 +921,8 @@ CREATE TABLE public.event_logs (
     type text NOT NULL,
     data text NOT NULL,
     creation_time timestamp with time zone DEFAULT now() NOT NULL
-);
+)
+PARTITION BY RANGE (creation_time);
 
 
 ALTER TABLE public.event_logs OWNER TO pod_admin;
@@ -1011,7 +1092,8 @@ CREATE TABLE public.subreddit_balance_logs (
     amount integer NOT NULL,
     expected_amount integer NOT NULL,
     creation_time timestamp with time zone DEFAULT now() NOT NULL
-);
+)
+PARTITION BY RANGE (creation_time);
 
 
 ALTER TABLE public.subreddit_balance_logs OWNER TO pod_admin;
@@ -1201,6 +1283,13 @@ ALTER SEQUENCE public.withdrawals_id_seq OWNED BY public.withdrawals.id;
 ALTER TABLE ONLY public.assets ALTER COLUMN id SET DEFAULT nextval('public.assets_id_seq'::regclass);
 
 
+--
+-- Name: db_patch_history id; Type: DEFAULT; Schema: public; Owner: pod_admin
+--
+
+ALTER TABLE ONLY public.db_patch_history ALTER COLUMN id SET DEFAULT nextval('public.db_patch_history_id_seq'::regclass);
+
+
 --
 -- Name: deliveries id; Type: DEFAULT; Schema: public; Owner: pod_admin
 --
@@ -1272,6 +1361,14 @@ ALTER TABLE ONLY public.account_types
     ADD CONSTRAINT account_types_pkey PRIMARY KEY (name);
 
 
+--
+-- Name: accounting_totals accounting_totals_pkey; Type: CONSTRAINT; Schema: public; Owner: pod_admin
+--
+
+ALTER TABLE ONLY public.accounting_totals
+    ADD CONSTRAINT accounting_totals_pkey PRIMARY KEY (asset_id);
+
+
 --
 -- Name: assets assets_pkey; Type: CONSTRAINT; Schema: public; Owner: pod_admin
 --
@@ -1296,6 +1393,22 @@ ALTER TABLE ONLY public.csrf_tokens
     ADD CONSTRAINT csrf_tokens_pkey PRIMARY KEY (token);
 
 
+--
+-- Name: db_backfills db_backfills_pkey; Type: CONSTRAINT; Schema: public; Owner: pod_admin
+--
+
+ALTER TABLE ONLY public.db_backfills
+    ADD CONSTRAINT db_backfills_pkey PRIMARY KEY (name);
+
+
+--
+-- Name: db_patch_history db_patch_history_pkey; Type: CONSTRAINT; Schema: public; Owner: pod_admin
+--
+
+ALTER TABLE ONLY public.db_patch_history
+    ADD CONSTRAINT db_patch_history_pkey PRIMARY KEY (id);
+
+
 --
 -- Name: db_patches db_patches_pkey; Type: CONSTRAINT; Schema: public; Owner: pod_admin
 --
@@ -1333,7 +1446,7 @@ ALTER TABLE ONLY public.erc20_deposits
 --
 
 ALTER TABLE ONLY public.event_logs
-    ADD CONSTRAINT event_logs_pkey PRIMARY KEY (id);
+    ADD CONSTRAINT event_logs_pkey PRIMARY KEY (id, creation_time);
 
 
 --
@@ -1432,6 +1545,20 @@ ALTER TABLE ONLY public.withdrawals
     ADD CONSTRAINT withdrawals_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: subreddit_balance_logs_creation_time_idx; Type: INDEX; Schema: public; Owner: pod_admin
+--
+
+CREATE INDEX subreddit_balance_logs_creation_time_idx ON ONLY public.subreddit_balance_logs USING btree (creation_time);
+
+
+--
+-- Name: subreddit_balance_logs_subreddit_id_creation_time_idx; Type: INDEX; Schema: public; Owner: pod_admin
+--
+
+CREATE INDEX subreddit_balance_logs_subreddit_id_creation_time_idx ON ONLY public.subreddit_balance_logs USING btree (subreddit_id, creation_time);
+
+
 --
 -- Name: balances update_balances_last_modified; Type: TRIGGER; Schema: public; Owner: pod_admin
 --
@@ -1455,6 +1582,14 @@ ALTER TABLE ONLY public.accepted_user_terms
     ADD CONSTRAINT accepted_user_terms_user_term_id_fkey FOREIGN KEY (user_term_id) REFERENCES public.user_terms(id);
 
 
+--
+-- Name: accounting_totals accounting_totals_asset_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: pod_admin
+--
+
+ALTER TABLE ONLY public.accounting_totals
+    ADD CONSTRAINT accounting_totals_asset_id_fkey FOREIGN KEY (asset_id) REFERENCES public.assets(id);
+
+
 --
 -- Name: balances balances_asset_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: pod_admin
 --
@@ -1531,7 +1666,7 @@ ALTER TABLE ONLY public.sessions
 -- Name: subreddit_balance_logs subreddit_balance_logs_subreddit_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: pod_admin
 --
 
-ALTER TABLE ONLY public.subreddit_balance_logs
+ALTER TABLE public.subreddit_balance_logs
     ADD CONSTRAINT subreddit_balance_logs_subreddit_id_fkey FOREIGN KEY (subreddit_id) REFERENCES public.subreddits(id);
 
 
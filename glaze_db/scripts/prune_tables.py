@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Deletes rows that are past their retention from tables that only grow.
+
+Each table's rows are kept for its retention after the time in its policy's
+column, which can be changed with `--retention`. Rows are deleted in batches
+of `--batch_size`, waiting `--pause` seconds between batches, so that no
+statement holds its locks for long. With `--archive_dir`, the rows are first
+written to a gzipped NDJSON file per table in that directory.
+
+`event_logs` and `subreddit_balance_logs` are partitioned by month, and their
+old rows are dropped a partition at a time by `manager.py partitions
+--detach_after=<interval> --drop` instead.
+
+Metrics for each table are printed, and with `--metrics` also written as lines
+of JSON to a file, or to stdout if it's `-`.
+
+Usage:
+    PYTHONPATH=. glaze_db/scripts/prune_tables.py --db_config=<files>
+        [--tables=<table>,...] [--retention=<table>=<interval>,...]
+        [--batch_size=<rows>] [--pause=<seconds>] [--archive_dir=<path>]
+        [--metrics=<path>]"""
+
+import datetime
+import gzip
+import json
+import os
+import re
+import sys
+from tools.db_manager import db
+from tools.db_manager import prune
+
+_POLICIES = [
+    # (table, key, column, retention)
+    # Sessions are kept for a while after they expire, so that a user whose
+    # session expired can still be told so.
+    ('sessions', 'token', 'expiration', '7 days'),
+    # CSRF tokens don't expire, so this has to be longer than a page is
+    # expected to stay open.
+    ('csrf_tokens', 'token', 'creation_time', '7 days'),
+]
+
+_DEFAULT_BATCH_SIZE = 1000
+
+# Seconds to wait between batches.
+_DEFAULT_PAUSE = 0.1
+
+def prune_table(policy, retention, batch_size, pause, archive_dir):
+    """Prunes one table and returns its `prune.PruneResult`."""
+    table, key, column, _ = policy
+    # The cutoff is fixed for the whole run, so that archived rows are the
+    # ones that get deleted.
+    cutoff = db.query(
+        'SELECT (now() - $1::interval)::text', [retention]).strip()
+    condition = '{} < $1::timestamptz'.format(column)
+    if archive_dir is None:
+        return prune.prune(
+            table, condition, [cutoff], key, batch_size, pause)
+    path = os.path.join(archive_dir, '{}-{}.ndjson.gz'.format(
+        table, datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')))
+    with gzip.open(path, 'wt', encoding='utf8') as archive:
+        return prune.prune(
+            table, condition, [cutoff], key, batch_size, pause, archive)
+
+def main(argv):
+    tables = [policy[0] for policy in _POLICIES]
+    retentions = dict((policy[0], policy[3]) for policy in _POLICIES)
+    batch_size = _DEFAULT_BATCH_SIZE
+    pause = _DEFAULT_PAUSE
+    archive_dir = None
+    metrics_path = None
+    for arg in argv[1:]:
+        matches = re.search(
+            r'^--(db_config|tables|retention|batch_size|pause|archive_dir|'
+                r'metrics)\=(.*)$',
+            arg)
+        if not matches:
+            raise Exception('Unknown argument "{}"'.format(arg))
+        name, value = matches.group(1), matches.group(2)
+        if name == 'db_config':
+            db.set_config_files(value.split(','))
+        elif name == 'tables':
+            tables = value.split(',')
+        elif name == 'retention':
+            for retention in value.split(','):
+                table, _, interval = retention.partition('=')
+                retentions[table] = interval
+        elif name == 'batch_size':
+            batch_size = int(value)
+        elif name == 'pause':
+            pause = float(value)
+        elif name == 'archive_dir':
+            archive_dir = value
+        else:
+            metrics_path = value
+    policies = dict((policy[0], policy) for policy in _POLICIES)
+    for table in list(tables) + list(retentions):
+        if table not in policies:
+            raise Exception('There is no policy for "{}". Expected one of: '
+                '{}'.format(table, ', '.join(sorted(policies))))
+    if batch_size < 1:
+        raise Exception('The batch size must be at least 1.')
+    if archive_dir is not None:
+        os.makedirs(archive_dir, exist_ok=True)
+
+    metrics = []
+    for table in tables:
+        result = prune_table(
+            policies[table],
+            retentions[table],
+            batch_size,
+            pause,
+            archive_dir)
+        print('Pruned {} rows from {} older than {} in {} batches, in {:.1f} '
+            'seconds.'.format(
+                result.rows_deleted,
+                table,
+                retentions[table],
+                result.batches,
+                result.seconds))
+        metrics.append(dict(result._asdict(), retention=retentions[table]))
+    if metrics_path == '-':
+        for metric in metrics:
+            print(json.dumps(metric))
+    elif metrics_path is not None:
+        with open(metrics_path, 'a') as file:
+            for metric in metrics:
+                file.write(json.dumps(metric) + '\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Checks bridge solvency like `accounting.sql`, without rescanning history.
+
+Totals of deliveries, ERC-20 deposits and withdrawals are kept per asset in
+`accounting_totals`, each covering the rows of its table up to an id
+watermark. Each run adds the rows that have settled since the last run and
+moves the watermarks past them. A row has settled once it's older than
+`_SETTLE_TIME`, so that rows whose ids were assigned by transactions that
+haven't committed yet aren't skipped, and withdrawals also need a result. Rows
+past the watermarks are few, and are summed on every run so that the report
+is exact.
+
+A withdrawal that still has no result after `_UNRESOLVED_TIME` no longer
+holds its watermark back, and is reported as a failure until it gets one. Its
+amount isn't in the totals, so if it later succeeds, the next verification
+corrects them.
+
+Every `--verify_every` (an hour by default), or on every run with `--full`,
+the stored totals are recomputed from scratch and corrected if they were
+wrong, which is reported as a failure.
+
+Usage:
+    PYTHONPATH=. glaze_db/scripts/reconcile.py --db_config=<files>
+        [--verify_every=<interval>] [--full]
+
+Exits with status 1 if the stored totals were wrong, the books don't balance
+or withdrawals are unresolved."""
+
+import json
+import re
+import sys
+from tools.db_manager import db
+
+# How long to wait before counting a row. Longer than any transaction that
+# inserts into the tables should take.
+_SETTLE_TIME = '5 minutes'
+
+# How long a withdrawal can go without a result before it's reported, and
+# stops holding back the withdrawals watermark.
+_UNRESOLVED_TIME = '1 day'
+
+_DEFAULT_VERIFY_EVERY = '1 hour'
+
+# Each table's rows are counted up to the row before the first one that hasn't
+# settled, or up to the last row if they all have.
+_WATERMARK = '''coalesce(
+            (SELECT min(id) - 1 FROM {table} x
+                WHERE x.asset_id = t.asset_id
+                    AND x.id > t.{watermark}
+                    AND ({unsettled})),
+            (SELECT max(id) FROM {table} x
+                WHERE x.asset_id = t.asset_id
+                    AND x.id > t.{watermark}),
+            t.{watermark})'''
+
+# The sum of a column over a table's rows in a range of ids.
+_SUM = '''(SELECT coalesce(sum({column}), 0) FROM {table} x
+                WHERE x.asset_id = t.asset_id
+                    AND x.id > {after}
+                    AND x.id <= {through}
+                    AND {condition})'''
+
+_SOURCES = [
+    # (total, table, watermark, column, condition, unsettled)
+    (
+        'delivered', 'deliveries', 'deliveries_id', 'deposited_amount',
+        'true',
+        'x.received_time >= now() - interval \'{settle}\'',
+    ),
+    (
+        'erc20_deposited', 'erc20_deposits', 'erc20_deposits_id', 'amount',
+        'true',
+        'x.received_time >= now() - interval \'{settle}\'',
+    ),
+    (
+        'withdrawn_to_ethereum', 'withdrawals', 'withdrawals_id', 'amount',
+        'x.success AND (x.recipient).type = \'ethereum_address\'',
+        'x.creation_time >= now() - interval \'{settle}\' '
+            'OR (x.success IS NULL '
+                'AND x.creation_time >= now() - interval \'{unresolved}\')',
+    ),
+    (
+        'withdrawn_to_reddit', 'withdrawals', 'withdrawals_id', 'amount',
+        'x.success AND (x.recipient).type = \'reddit_user\'',
+        'x.creation_time >= now() - interval \'{settle}\' '
+            'OR (x.success IS NULL '
+                'AND x.creation_time >= now() - interval \'{unresolved}\')',
+    ),
+]
+
+def _get_watermarks():
+    """Gets each watermark column with the SQL for where it can move to."""
+    watermarks = []
+    for _, table, watermark, _, _, unsettled in _SOURCES:
+        if watermark not in [w for w, _ in watermarks]:
+            watermarks.append((watermark, _WATERMARK.format(
+                table=table,
+                watermark=watermark,
+                unsettled=unsettled.format(
+                    settle=_SETTLE_TIME, unresolved=_UNRESOLVED_TIME))))
+    return watermarks
+
+def _get_advance_sql():
+    watermarks = _get_watermarks()
+    return '''WITH watermarks AS (
+    SELECT t.asset_id,
+        {watermarks}
+        FROM accounting_totals t),
+additions AS (
+    SELECT w.*,
+        {sums}
+        FROM watermarks w
+        JOIN accounting_totals t USING (asset_id))
+UPDATE accounting_totals t SET
+        {watermark_updates},
+        {total_updates},
+        updated_time = now()
+    FROM additions a
+    WHERE a.asset_id = t.asset_id;'''.format(
+        watermarks=',\n        '.join(
+            '{} AS {}'.format(sql, watermark)
+            for watermark, sql in watermarks),
+        sums=',\n        '.join(
+            '{} AS {}'.format(
+                _SUM.format(
+                    column=column,
+                    table=table,
+                    after='t.' + watermark,
+                    through='w.' + watermark,
+                    condition=condition),
+                total)
+            for total, table, watermark, column, condition, _ in _SOURCES),
+        watermark_updates=',\n        '.join(
+            '{0} = a.{0}'.format(watermark) for watermark, _ in watermarks),
+        total_updates=',\n        '.join(
+            '{0} = t.{0} + a.{0}'.format(total)
+            for total, _, _, _, _, _ in _SOURCES))
+
+def _get_verify_sql(verify_every):
+    """Recomputes the totals of assets that are due to be verified, prints the
+    ones that were wrong as JSON and corrects them."""
+    totals = [total for total, _, _, _, _, _ in _SOURCES]
+    return '''WITH recomputed AS (
+    SELECT t.asset_id,
+        {sums}
+        FROM accounting_totals t
+        WHERE t.verified_time IS NULL
+            OR t.verified_time <= now() - interval {verify_every}),
+wrong AS (
+    SELECT r.asset_id,
+        {wrong_totals}
+        FROM recomputed r
+        JOIN accounting_totals t USING (asset_id)
+        WHERE ({stored}) IS DISTINCT FROM ({recomputed})),
+corrected AS (
+    UPDATE accounting_totals t SET
+            {corrections},
+            verified_time = now()
+        FROM recomputed r
+        WHERE r.asset_id = t.asset_id
+        RETURNING t.asset_id)
+SELECT array_to_json(array_agg(w)) FROM wrong w;'''.format(
+        sums=',\n        '.join(
+            '{} AS {}'.format(
+                _SUM.format(
+                    column=column,
+                    table=table,
+                    after='0',
+                    through='t.' + watermark,
+                    condition=condition),
+                total)
+            for total, table, watermark, column, condition, _ in _SOURCES),
+        verify_every=_quote(verify_every),
+        wrong_totals=',\n        '.join(
+            'json_build_array(t.{0}, r.{0}) AS {0}'.format(total)
+            for total in totals),
+        stored=', '.join('t.' + total for total in totals),
+        recomputed=', '.join('r.' + total for total in totals),
+        corrections=',\n            '.join(
+            '{0} = r.{0}'.format(total) for total in totals))
+
+def _get_report_sql():
+    """Gets the totals of every asset, including rows past the watermarks, the
+    sum of user balances and the number of unresolved withdrawals."""
+    return '''SELECT array_to_json(array_agg(r ORDER BY asset_id)) FROM (
+    SELECT t.asset_id,
+        {totals},
+        (SELECT coalesce(sum(balance), 0) FROM balances b
+            WHERE b.asset_id = t.asset_id) AS balances,
+        (SELECT count(*) FROM withdrawals w
+            WHERE w.asset_id = t.asset_id
+                AND w.success IS NULL
+                AND w.creation_time < now() - interval {unresolved})
+            AS unresolved_withdrawals,
+        t.verified_time
+        FROM accounting_totals t) r;'''.format(
+        unresolved=_quote(_UNRESOLVED_TIME),
+        totals=',\n        '.join(
+            't.{} + {} AS {}'.format(
+                total,
+                _SUM.format(
+                    column=column,
+                    table=table,
+                    after='t.' + watermark,
+                    through='2147483647',
+                    condition=condition),
+                total)
+            for total, table, watermark, column, condition, _ in _SOURCES))
+
+def reconcile(verify_every=_DEFAULT_VERIFY_EVERY):
+    """Brings the stored totals up to date and returns `(report, wrong)`,
+    where `report` has the current totals of each asset and `wrong` has the
+    stored totals that were found to be wrong, as `[stored, recomputed]`
+    pairs."""
+    script = '\n'.join([
+        '\\set QUIET on',
+        # Everything is read from one snapshot, so the totals and balances are
+        # consistent with each other.
+        'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;',
+        'INSERT INTO accounting_totals (asset_id) '
+            'SELECT id FROM assets ON CONFLICT DO NOTHING;',
+        _get_advance_sql(),
+        _get_verify_sql(verify_every),
+        _get_report_sql(),
+    ])
+    # The last two lines are the verification and the report. Either may be
+    # empty, if there are no rows.
+    lines = db.query_script(script).rstrip('\n').split('\n')
+    wrong, report = [json.loads(l) if l else None for l in lines[-2:]]
+    return report or [], wrong or []
+
+def _print_report(report, wrong):
+    balanced = True
+    for asset in report:
+        # As in accounting.sql: tokens minted on the blockchain, donuts held by
+        # the bridge accounts, and the difference between what the bridge
+        # holds and what users and the blockchain are owed.
+        supply = asset['withdrawn_to_ethereum'] - asset['erc20_deposited']
+        held = asset['delivered'] - asset['withdrawn_to_reddit']
+        difference = held - supply - asset['balances']
+        balanced = balanced and difference == 0
+        print('Asset {}: ERC-20 supply {}, held by bridge {}, user balances '
+            '{}, difference {}{}'.format(
+                asset['asset_id'],
+                supply,
+                held,
+                asset['balances'],
+                difference,
+                '' if difference == 0 else ' (should be 0)'))
+        if asset['unresolved_withdrawals'] > 0:
+            balanced = False
+            print('Asset {}: {} withdrawals have had no result for over {}.'
+                .format(
+                    asset['asset_id'],
+                    asset['unresolved_withdrawals'],
+                    _UNRESOLVED_TIME))
+    for asset in wrong:
+        for total, values in sorted(asset.items()):
+            if total != 'asset_id' and values[0] != values[1]:
+                print('Asset {}: Stored {} was {} but should be {}; '
+                    'corrected.'.format(
+                        asset['asset_id'], total, values[0], values[1]))
+    return balanced and len(wrong) == 0
+
+def _quote(value):
+    return '\'{}\''.format(value.replace('\'', '\'\''))
+
+def main(argv):
+    verify_every = _DEFAULT_VERIFY_EVERY
+    for arg in argv[1:]:
+        matches = re.search(r'^--(db_config|verify_every)\=(.*)$', arg)
+        if matches:
+            if matches.group(1) == 'db_config':
+                db.set_config_files(matches.group(2).split(','))
+            else:
+                verify_every = matches.group(2)
+        elif arg == '--full':
+            verify_every = '0'
+        else:
+            raise Exception('Unknown argument "{}"'.format(arg))
+    report, wrong = reconcile(verify_every)
+    if not _print_report(report, wrong):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
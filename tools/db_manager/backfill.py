@@ -0,0 +1,156 @@
+"""Updates large tables in small batches, for data migrations in Python patches.
+
+Python patches get `backfill` as a global. For example:
+
+    backfill(
+        'withdrawals',
+        'fee = 0',
+        where='fee IS NULL',
+        rows_per_second=5000)
+
+Rows are visited in order of a unique key, each batch starting after the last
+key of the one before, so every batch is an index range scan however far along
+the backfill is. Each batch commits on its own together with a checkpoint in
+`db_backfills`, so no transaction is held for long, and a backfill that is
+interrupted picks up after its last committed batch when the patch is run
+again."""
+
+import time
+from tools.db_manager import db_instance
+
+_CREATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS db_backfills (
+    name text PRIMARY KEY,
+    last_key text,
+    rows_updated bigint NOT NULL DEFAULT 0,
+    done boolean NOT NULL DEFAULT false,
+    updated_time timestamp with time zone NOT NULL DEFAULT now()
+        CHECK (date_part('timezone', updated_time) = 0))'''
+
+# Updates one batch and saves the checkpoint in the same statement, so both
+# commit together. Prints the number of rows in the batch and its last key.
+# `$1` is the name of the backfill, and `$2` the last key of the batch before.
+_BATCH = '''
+WITH batch AS (
+    SELECT {key} AS backfill_key FROM {table}
+        WHERE {conditions}
+        ORDER BY {key}
+        LIMIT {batch_size}),
+updated AS (
+    UPDATE {table} SET {update}
+        FROM batch
+        WHERE {table}.{key} = batch.backfill_key
+        RETURNING 1),
+checkpoint AS (
+    INSERT INTO db_backfills AS b (name, last_key, rows_updated, updated_time)
+        SELECT $1::text, max(backfill_key)::text,
+                (SELECT count(*) FROM updated), now()
+            FROM batch
+            HAVING count(*) > 0
+        ON CONFLICT (name) DO UPDATE SET
+            last_key = EXCLUDED.last_key,
+            rows_updated = b.rows_updated + EXCLUDED.rows_updated,
+            updated_time = EXCLUDED.updated_time)
+SELECT count(*), max(backfill_key)::text FROM batch'''
+
+# Seconds between progress reports.
+_PROGRESS_INTERVAL = 10
+
+def backfill(
+        table,
+        update,
+        where=None,
+        key='id',
+        batch_size=1000,
+        rows_per_second=None,
+        name=None,
+        patch=None):
+    """Runs `UPDATE table SET update` over the rows matching `where`, in
+    batches of `batch_size` rows ordered by `key`, which must be unique.
+
+    `rows_per_second` limits how fast rows are updated, to keep the load on the
+    database (and replication lag) down. The checkpoint is saved under `name`,
+    which defaults to the table name, qualified by the patch the backfill is
+    run from. Returns the number of rows updated."""
+    create_checkpoint_table()
+    name = name or table
+    if patch is not None:
+        name = '{}:{}'.format(patch, name)
+
+    last_key, rows_updated, done = get_checkpoint(name)
+    if done:
+        print('Backfill {} was already completed.'.format(name))
+        return rows_updated
+    if last_key is not None:
+        print('Resuming backfill {} after {} = {}.'.format(
+            name, key, last_key))
+    max_key = db_instance.query('SELECT max({}) FROM {}'.format(
+        key, table)).strip()
+
+    start = time.time()
+    last_report = start
+    updated_this_run = 0
+    while True:
+        batch_start = time.time()
+        conditions = []
+        if last_key is not None:
+            conditions.append('{} > $2'.format(key))
+        if where is not None:
+            conditions.append('({})'.format(where))
+        count, batch_last_key = db_instance.query(
+            _BATCH.format(
+                key=key,
+                table=table,
+                conditions=' AND '.join(conditions) or 'true',
+                batch_size=int(batch_size),
+                update=update),
+            [name] if last_key is None else [name, last_key]
+        ).strip().split('|')
+        count = int(count)
+        if count == 0:
+            break
+        last_key = batch_last_key
+        updated_this_run += count
+        rows_updated += count
+
+        now = time.time()
+        if now - last_report >= _PROGRESS_INTERVAL:
+            last_report = now
+            print('Backfill {}: {} rows updated ({:.0f}/s), at {} {} of '
+                '{}.'.format(
+                    name,
+                    rows_updated,
+                    updated_this_run / (now - start),
+                    key,
+                    last_key,
+                    max_key or 'none'))
+        if count < batch_size:
+            break
+        if rows_per_second is not None:
+            time.sleep(max(0, count / rows_per_second - (now - batch_start)))
+
+    mark_done(name)
+    print('Backfill {} completed: {} rows updated in {:.1f}s.'.format(
+        name, rows_updated, time.time() - start))
+    return rows_updated
+
+def create_checkpoint_table():
+    db_instance.query(_CREATE_TABLE)
+
+def get_checkpoint(name):
+    """Gets the last key, the rows updated and whether the backfill saved
+    under `name` is done."""
+    rows = db_instance.query_to_json(
+        'SELECT last_key, rows_updated, done FROM db_backfills '
+            'WHERE name = $1',
+        [name])
+    if not rows:
+        return None, 0, False
+    return rows[0]['last_key'], rows[0]['rows_updated'], rows[0]['done']
+
+def mark_done(name):
+    db_instance.query(
+        'INSERT INTO db_backfills (name, done) VALUES ($1, true) '
+            'ON CONFLICT (name) DO UPDATE SET '
+                'done = true, updated_time = now()',
+        [name])
@@ -0,0 +1,47 @@
+"""Reads and writes baselines, which stand in for replaying the oldest patches.
+
+A baseline is a `pg_dump` of a database with a prefix of the patches applied,
+including its data and so the `db_patches` rows for those patches. Its first
+line records how many patches it covers and the version hash of a database
+with those patches, so a baseline whose patches have since changed is not
+used."""
+
+import re
+from tools.db_manager import db
+from tools.db_manager import db_instance
+
+_HEADER = '-- db_manager baseline: {} patches, version {}'
+_HEADER_RE = re.compile(
+    r'^-- db_manager baseline: (\d+) patches, version (\w+)$')
+
+# Tables whose rows describe how a database was built, rather than being part
+# of what was built.
+_EXCLUDED_TABLE_DATA = ['db_patch_history', 'db_backfills']
+
+def write(path, patch_count):
+    """Writes a baseline of the current database, which must have the first
+    `patch_count` patches applied."""
+    dump = db.call_with_params(
+        ['pg_dump', '--no-owner']
+        + [
+            '--exclude-table-data={}'.format(table)
+            for table in _EXCLUDED_TABLE_DATA],
+        db_name=db_instance.get_db_name())
+    with open(path, 'wt', encoding='utf8') as file:
+        file.write(_HEADER.format(
+            patch_count, db_instance.get_version_hash(patch_count)) + '\n')
+        file.write(dump)
+
+def read_patch_count(path):
+    """Gets the number of patches a baseline covers, or `None` if it doesn't
+    match the current patches."""
+    with open(path, 'rt', encoding='utf8') as file:
+        matches = _HEADER_RE.match(file.readline().rstrip('\n'))
+    if matches is None:
+        raise Exception('"{}" is not a baseline.'.format(path))
+    patch_count = int(matches.group(1))
+    try:
+        version = db_instance.get_version_hash(patch_count)
+    except IndexError:
+        return None
+    return patch_count if version == matches.group(2) else None
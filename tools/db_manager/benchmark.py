@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""Measures how db manager's patch planning and upgrade paths scale.
+
+Generates synthetic patch directories of several sizes, mixing SQL, Python and
+shell patches, and runs each phase against them. By default queries go to
+`fake_psql.py`, which records every call instead of talking to a database. Pass
+`--db_config=...` to use a real (scratch!) database that has been set up with
+`manager.py init` instead.
+
+For each phase this reports wall time, the number of subprocesses started, the
+bytes read by this process (from /proc/self/io, where available) and the peak
+memory allocated by Python. Use `--output=<file>` to save results as JSON and
+`--baseline=<file>` to compare against results saved from another commit.
+
+Usage:
+    tools/db_manager/benchmark.sh [--sizes=10,100,1000] [--output=<file>]
+        [--baseline=<file>] [--db_config=<files>] [--db_backend=<backend>]"""
+
+import collections
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from tools.db_manager import db
+from tools.db_manager import db_instance
+from tools.db_manager import file_reader
+from tools.db_manager import manager
+from tools.db_manager import patch_reader
+from tools.workspace import workspace
+
+_DEFAULT_SIZES = [10, 100, 1000]
+_FAKE_PSQL = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'fake_psql.py')
+
+_Measurement = collections.namedtuple(
+    'Measurement',
+    ['seconds', 'subprocesses', 'bytes_read', 'peak_memory'])
+
+_subprocess_count = 0
+
+def _count_subprocesses():
+    """Counts every subprocess started by this process from now on."""
+    popen_init = subprocess.Popen.__init__
+
+    def counting_init(self, *args, **kwargs):
+        global _subprocess_count
+        _subprocess_count += 1
+        popen_init(self, *args, **kwargs)
+
+    subprocess.Popen.__init__ = counting_init
+
+def _get_bytes_read():
+    try:
+        with open('/proc/self/io', 'rt') as file:
+            for line in file:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _measure(fn):
+    subprocesses_before = _subprocess_count
+    bytes_read_before = _get_bytes_read()
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    bytes_read_after = _get_bytes_read()
+    return _Measurement(
+        seconds,
+        _subprocess_count - subprocesses_before,
+        None if bytes_read_before is None
+            else bytes_read_after - bytes_read_before,
+        peak_memory)
+
+def _generate_patches(patch_dir, size):
+    """Writes `size` patches. Most are SQL, every 10th is Python, every 25th is
+    a shell script and every 20th SQL patch adds an enum value, which can't be
+    batched with other patches."""
+    os.mkdir(patch_dir)
+    enum_name = 'bench_enum_{}'.format(size)
+    for i in range(size):
+        if i % 25 == 24:
+            path = os.path.join(patch_dir, '{:04d}.sh'.format(i))
+            _write(path, '#!/bin/sh\n# Synthetic patch {}.\ntrue\n'.format(i))
+            os.chmod(path, 0o755)
+        elif i % 10 == 9:
+            _write(
+                os.path.join(patch_dir, '{:04d}.py'.format(i)),
+                '# Synthetic patch {}.\nvalue = {}\n'.format(i, i))
+        elif i == 0:
+            _write(
+                os.path.join(patch_dir, '0000.sql'),
+                'CREATE TYPE {} AS ENUM (\'v0\');\n'.format(enum_name))
+        elif i % 20 == 0:
+            _write(
+                os.path.join(patch_dir, '{:04d}.sql'.format(i)),
+                'ALTER TYPE {} ADD VALUE \'v{}\';\n'.format(enum_name, i))
+        else:
+            _write(
+                os.path.join(patch_dir, '{:04d}.sql'.format(i)),
+                _SQL_PATCH.format(size=size, i=i))
+
+_SQL_PATCH = '''-- Synthetic patch {i}; with a semicolon in a comment.
+CREATE TABLE bench_{size}_{i} (
+    id serial PRIMARY KEY,
+    label text NOT NULL DEFAULT 'a;b'
+);
+
+CREATE FUNCTION bench_{size}_{i}_count()
+    RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  RETURN (SELECT count(*) FROM bench_{size}_{i});
+END; $$;
+'''
+
+def _write(path, content):
+    with open(path, 'wt', encoding='utf8') as file:
+        file.write(content)
+
+def _reset():
+    db.close()
+    patch_reader.get_patches.cache_clear()
+    file_reader.read.cache_clear()
+    db_instance._get_db_name.cache_clear()
+    db_instance._get_version_hashes.cache_clear()
+    db_instance._get_patch_counts_by_db_name.cache_clear()
+
+def _benchmark_size(root, size):
+    patch_dir = os.path.join(root, 'patches_{}'.format(size))
+    _generate_patches(patch_dir, size)
+    patch_reader.set_patch_dir(patch_dir)
+    _reset()
+    # Start each size with no patches applied.
+    if 'FAKE_PSQL_STATE' in os.environ:
+        hashes_path = os.path.join(os.environ['FAKE_PSQL_STATE'], 'hashes')
+        if os.path.exists(hashes_path):
+            os.remove(hashes_path)
+
+    results = collections.OrderedDict()
+    results['get_patches'] = _measure(patch_reader.get_patches)
+    _reset()
+    results['get_patches_indexed'] = _measure(patch_reader.get_patches)
+    results['version_hashes'] = _measure(db_instance._get_version_hashes)
+    # The worst case: only the base database exists, so every snapshot name is
+    # tried.
+    results['closest_db_name'] = _measure(
+        lambda: db_instance._get_closest_db_name({db.get_db_name()}))
+    results['next_batch_of_upgrades'] = _measure(
+        lambda: list(manager._get_next_batch_of_upgrades()))
+    sql_upgrades = [
+        u for u in manager._get_upgrades()
+        if isinstance(u, manager._SqlUpgrade)]
+    results['combine_sql_upgrades'] = _measure(
+        lambda: manager._combine_sql_upgrades(sql_upgrades))
+    results['rewind'] = _measure(db_instance.rewind_invalid_patches)
+    results['upgrade'] = _measure(lambda: manager.upgrade(None, force=True))
+    return results
+
+def _print_results(results, baseline):
+    print('{:>6}  {:<24}{:>10}{:>8}{:>14}{:>12}'.format(
+        'size', 'phase', 'seconds', 'procs', 'bytes read', 'peak mem'))
+    for size, phases in results.items():
+        for phase, measurement in phases.items():
+            line = '{:>6}  {:<24}{:>10.4f}{:>8}{:>14}{:>12}'.format(
+                size,
+                phase,
+                measurement['seconds'],
+                measurement['subprocesses'],
+                '-' if measurement['bytes_read'] is None
+                    else measurement['bytes_read'],
+                measurement['peak_memory'])
+            previous = baseline.get(size, {}).get(phase)
+            if previous is not None:
+                line += '  ({:+.0%} time, {:+d} procs)'.format(
+                    measurement['seconds'] / max(previous['seconds'], 1e-9)
+                        - 1,
+                    measurement['subprocesses'] - previous['subprocesses'])
+            print(line)
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _use_fake_psql(root):
+    """Puts `fake_psql.py` on the path as `psql` and points db at it."""
+    bin_dir = os.path.join(root, 'bin')
+    state_dir = os.path.join(root, 'fake_psql')
+    os.mkdir(bin_dir)
+    os.mkdir(state_dir)
+    os.symlink(_FAKE_PSQL, os.path.join(bin_dir, 'psql'))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_PSQL_STATE'] = state_dir
+    config_path = os.path.join(root, 'db.json')
+    _write(config_path, json.dumps({
+        'host': 'localhost',
+        'port': 5432,
+        'database': 'bench',
+        'username': 'bench',
+        'password': 'bench',
+    }))
+    return [config_path]
+
+def main(argv):
+    sizes = _DEFAULT_SIZES
+    output_path = None
+    baseline_path = None
+    config_files = None
+    for arg in argv[1:]:
+        matches = re.search(
+            r'^--(sizes|output|baseline|db_config|db_backend)\=(.*)$', arg)
+        if matches is None:
+            raise Exception('Unknown argument "{}"'.format(arg))
+        if matches.group(1) == 'sizes':
+            sizes = [int(s) for s in matches.group(2).split(',')]
+        elif matches.group(1) == 'output':
+            output_path = matches.group(2)
+        elif matches.group(1) == 'baseline':
+            baseline_path = matches.group(2)
+        elif matches.group(1) == 'db_backend':
+            db.set_backend(matches.group(2))
+        else:
+            config_files = matches.group(2).split(',')
+
+    baseline = dict()
+    if baseline_path is not None:
+        with open(baseline_path, 'rt', encoding='utf8') as file:
+            baseline = json.load(file)['results']
+
+    # Patches have to be inside the workspace for upgrades to list them.
+    root = tempfile.mkdtemp(
+        prefix='.db_manager_benchmark_',
+        dir=workspace.get_path())
+    try:
+        if config_files is None:
+            config_files = _use_fake_psql(root)
+        db_instance.set_config_files(config_files)
+        _count_subprocesses()
+        results = collections.OrderedDict()
+        for size in sizes:
+            # Each size gets its own dev mode database name, so sizes don't
+            # see each other's patches.
+            db_instance.set_dev_mode(True)
+            results[str(size)] = collections.OrderedDict(
+                (phase, measurement._asdict())
+                for phase, measurement in _benchmark_size(root, size).items())
+    finally:
+        db.close()
+        shutil.rmtree(root)
+
+    _print_results(results, baseline)
+    if output_path is not None:
+        with open(output_path, 'wt', encoding='utf8') as file:
+            json.dump(
+                {
+                    'commit': _get_commit(),
+                    'db_backend': db.get_backend(),
+                    'results': results,
+                },
+                file,
+                indent=2)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,5 @@
+#!/bin/bash
+set -e -o pipefail
+workspace=$(pwd)
+
+PYTHONPATH="$workspace" "$workspace/tools/db_manager/benchmark.py" "$@"
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Sends a db manager command to a server started with `manager.py serve`.
+
+Takes the same arguments as `manager.py`, plus `--socket=<path>`. If nothing
+is serving on the socket, or the command has to run locally, `manager.py` is
+run in its place, so this can always be used instead of it. Only imports what
+it needs to forward the command, so that it starts quickly."""
+
+import os
+import socket
+import sys
+from tools.db_manager import daemon
+
+_MANAGER_PATH = os.path.join(os.path.dirname(__file__), 'manager.py')
+
+# Commands that read stdin when they're run without a file argument.
+_STDIN_COMMANDS = ('query', 'export')
+
+def main(argv):
+    socket_path = None
+    for arg in argv[1:]:
+        if arg.startswith('--socket='):
+            socket_path = arg[len('--socket='):]
+    commands = [u for u in argv[1:] if u[0:1] != '-']
+    command = commands[0] if commands else ''
+    if socket_path is None or command in daemon.LOCAL_COMMANDS:
+        _run_locally(argv)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        _run_locally(argv)
+    stdin = None
+    if command in _STDIN_COMMANDS and len(commands) == 1:
+        stdin = sys.stdin.read()
+    with connection:
+        file = connection.makefile('rwb')
+        daemon.send(file, argv=argv, cwd=os.getcwd(), stdin=stdin)
+        while True:
+            try:
+                message = daemon.receive(file)
+            except EOFError:
+                raise Exception('The server exited without finishing.')
+            if 'fallback' in message:
+                file.close()
+                connection.close()
+                _run_locally(argv)
+            for kind, out in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+                if kind in message:
+                    out.flush()
+                    out.buffer.write(
+                        message[kind].encode('utf8', 'surrogateescape'))
+                    out.buffer.flush()
+            if 'exit' in message:
+                sys.exit(message['exit'])
+
+def _run_locally(argv):
+    sys.stdout.flush()
+    os.execv(_MANAGER_PATH, [_MANAGER_PATH] + argv[1:])
+
+if __name__ == '__main__':
+    main(sys.argv)
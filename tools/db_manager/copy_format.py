@@ -0,0 +1,290 @@
+"""Decodes rows written by `COPY ... TO STDOUT` in PostgreSQL's text format.
+
+Column values are converted to Python values based on their PostgreSQL types,
+which are looked up with the query returned by `describe_columns`."""
+
+import datetime
+import decimal
+import json
+import re
+
+_ESCAPE_RE = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))')
+_ESCAPES = {
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'v': '\v',
+}
+_TIMESTAMP_RE = re.compile(
+    r'^(\d{4,})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?'
+    r'(?:([+-])(\d\d)(?::?(\d\d))?(?::?(\d\d))?)?$')
+_DATE_RE = re.compile(r'^(\d{4,})-(\d\d)-(\d\d)$')
+_BYTEA_ESCAPE_RE = re.compile(r'\\([0-7]{3}|\\)')
+
+def describe_columns(columns):
+    """Returns a query describing columns, given as pairs of their names and
+    type names, and every type needed to decode them, as a single JSON
+    value."""
+    values = ',\n'.join(
+        '    ({}, {}, {}::regtype)'.format(
+            n, _quote_literal(name), _quote_literal(type_name))
+        for n, (name, type_name) in enumerate(columns))
+    if values == '':
+        values = '    SELECT NULL::int, NULL::text, NULL::regtype LIMIT 0'
+    else:
+        values = 'VALUES\n' + values
+    return '''
+WITH RECURSIVE columns(n, name, type) AS (
+{values}),
+types(oid) AS (
+        SELECT type::oid FROM columns
+    UNION
+        SELECT s.oid
+            FROM types t
+            JOIN pg_type ty ON ty.oid = t.oid
+            CROSS JOIN LATERAL (
+                SELECT a.atttypid FROM pg_attribute a
+                    WHERE a.attrelid = ty.typrelid
+                        AND a.attnum > 0
+                        AND NOT a.attisdropped
+                UNION ALL
+                SELECT ty.typelem WHERE ty.typcategory = 'A'
+                UNION ALL
+                SELECT ty.typbasetype WHERE ty.typtype = 'd') s(oid))
+SELECT json_build_object(
+    'columns', (
+        SELECT json_agg(
+                json_build_array(name, type::oid::bigint)
+                ORDER BY n)
+            FROM columns),
+    'types', (
+        SELECT json_agg(json_build_object(
+                'oid', ty.oid::bigint,
+                'name', ty.typname,
+                'type', ty.typtype,
+                'category', ty.typcategory,
+                'element', ty.typelem::bigint,
+                'base', ty.typbasetype::bigint,
+                'attributes', (
+                    SELECT json_agg(
+                            json_build_array(a.attname, a.atttypid::bigint)
+                            ORDER BY a.attnum)
+                        FROM pg_attribute a
+                        WHERE a.attrelid = ty.typrelid
+                            AND a.attnum > 0
+                            AND NOT a.attisdropped)))
+            FROM types t
+            JOIN pg_type ty ON ty.oid = t.oid))'''.format(values=values)
+
+def _quote_literal(value):
+    return '\'{}\''.format(value.replace('\'', '\'\''))
+
+def unescape_field(field):
+    """Decodes a single field of a COPY text row. NULLs become `None`."""
+    if field == '\\N':
+        return None
+    if '\\' not in field:
+        return field
+    return _ESCAPE_RE.sub(_unescape_match, field)
+
+def split_row(line):
+    return [unescape_field(f) for f in line.split('\t')]
+
+def _unescape_match(match):
+    if match.group(1) is not None:
+        return chr(int(match.group(1), 8))
+    if match.group(2) is not None:
+        return chr(int(match.group(2), 16))
+    return _ESCAPES.get(match.group(3), match.group(3))
+
+class RowDecoder:
+    """Turns COPY text rows into dicts keyed by column name."""
+
+    def __init__(self, description):
+        """`description` is the row produced by the `describe_columns`
+        query."""
+        description = json.loads(unescape_field(description))
+        self._types = {t['oid']: t for t in description['types'] or []}
+        self._decoders = dict()
+        self._columns = [
+            (name, self._get_decoder(oid))
+            for name, oid in description['columns'] or []]
+
+    @property
+    def column_names(self):
+        return [name for name, _ in self._columns]
+
+    def decode(self, line):
+        fields = split_row(line)
+        assert len(fields) == len(self._columns)
+        return {
+            name: None if value is None else decode(value)
+            for (name, decode), value in zip(self._columns, fields)}
+
+    def _get_decoder(self, oid):
+        if oid not in self._decoders:
+            self._decoders[oid] = self._make_decoder(self._types[oid])
+        return self._decoders[oid]
+
+    def _make_decoder(self, pg_type):
+        if pg_type['type'] == 'd':
+            return self._get_decoder(pg_type['base'])
+        if pg_type['type'] == 'c':
+            fields = [
+                (name, self._get_decoder(oid))
+                for name, oid in pg_type['attributes']]
+            return lambda value: _decode_composite(value, fields)
+        if pg_type['category'] == 'A':
+            element = self._get_decoder(pg_type['element'])
+            return lambda value: _decode_array(value, element)
+        return _SCALAR_DECODERS.get(pg_type['name'], str)
+
+def _decode_composite(value, fields):
+    values = _parse_record(value)
+    assert len(values) == len(fields)
+    return {
+        name: None if v is None else decode(v)
+        for (name, decode), v in zip(fields, values)}
+
+def _parse_record(value):
+    """Splits a record literal such as `(a,"b c",)` into its fields."""
+    assert value[0] == '(' and value[-1] == ')'
+    fields = []
+    i = 1
+    end = len(value) - 1
+    while True:
+        if value[i] == '"':
+            field, i = _read_quoted(value, i)
+        else:
+            start = i
+            while value[i] not in ',)':
+                i += 1
+            # An empty unquoted field is a NULL.
+            field = value[start:i] if i > start else None
+        fields.append(field)
+        if i >= end:
+            return fields
+        assert value[i] == ','
+        i += 1
+
+def _decode_array(value, decode):
+    # Arrays with non-default bounds are written as `[0:1]={...}`.
+    if value[0] == '[':
+        value = value[value.index('=') + 1:]
+    parsed, _ = _parse_array(value, 0)
+    return _map_array(parsed, decode)
+
+def _map_array(items, decode):
+    return [
+        _map_array(i, decode) if isinstance(i, list)
+        else None if i is None
+        else decode(i)
+        for i in items]
+
+def _parse_array(value, i):
+    assert value[i] == '{'
+    i += 1
+    items = []
+    if value[i] == '}':
+        return items, i + 1
+    while True:
+        if value[i] == '{':
+            item, i = _parse_array(value, i)
+        elif value[i] == '"':
+            item, i = _read_quoted(value, i)
+        else:
+            start = i
+            while value[i] not in ',}':
+                i += 1
+            item = value[start:i]
+            if item == 'NULL':
+                item = None
+        items.append(item)
+        if value[i] == '}':
+            return items, i + 1
+        assert value[i] == ','
+        i += 1
+
+def _read_quoted(value, i):
+    """Reads a double-quoted element starting at `value[i]`, returning its
+    content and the index just past the closing quote."""
+    assert value[i] == '"'
+    i += 1
+    out = []
+    while True:
+        c = value[i]
+        if c == '\\':
+            out.append(value[i + 1])
+            i += 2
+        elif c == '"':
+            # Records escape quotes by doubling them.
+            if value[i + 1:i + 2] == '"':
+                out.append('"')
+                i += 2
+            else:
+                return ''.join(out), i + 1
+        else:
+            out.append(c)
+            i += 1
+
+def _decode_bool(value):
+    return value == 't'
+
+def _decode_bytea(value):
+    if value[0:2] == '\\x':
+        return bytes.fromhex(value[2:])
+    # The legacy "escape" output format.
+    return _BYTEA_ESCAPE_RE.sub(
+        lambda m: '\\' if m.group(1) == '\\' else chr(int(m.group(1), 8)),
+        value).encode('latin-1')
+
+def _decode_timestamp(value):
+    matches = _TIMESTAMP_RE.match(value)
+    # Values such as 'infinity' or BC dates have no Python equivalent.
+    if matches is None:
+        return value
+    (year, month, day, hour, minute, second, fraction,
+        sign, tz_hours, tz_minutes, tz_seconds) = matches.groups()
+    tzinfo = None
+    if sign is not None:
+        offset = datetime.timedelta(
+            hours=int(tz_hours),
+            minutes=int(tz_minutes or 0),
+            seconds=int(tz_seconds or 0))
+        tzinfo = datetime.timezone(-offset if sign == '-' else offset)
+    try:
+        return datetime.datetime(
+            int(year), int(month), int(day),
+            int(hour), int(minute), int(second),
+            int((fraction or '0').ljust(6, '0')),
+            tzinfo)
+    except ValueError:
+        return value
+
+def _decode_date(value):
+    matches = _DATE_RE.match(value)
+    if matches is None:
+        return value
+    try:
+        return datetime.date(*(int(g) for g in matches.groups()))
+    except ValueError:
+        return value
+
+_SCALAR_DECODERS = {
+    'bool': _decode_bool,
+    'bytea': _decode_bytea,
+    'date': _decode_date,
+    'float4': float,
+    'float8': float,
+    'int2': int,
+    'int4': int,
+    'int8': int,
+    'json': json.loads,
+    'jsonb': json.loads,
+    'numeric': decimal.Decimal,
+    'oid': int,
+    'timestamp': _decode_timestamp,
+    'timestamptz': _decode_timestamp,
+}
@@ -0,0 +1,141 @@
+import datetime
+import decimal
+import json
+import unittest
+from tools.db_manager import copy_format
+
+def _type(oid, name, type='b', category='U', element=0, base=0,
+        attributes=None):
+    return {
+        'oid': oid,
+        'name': name,
+        'type': type,
+        'category': category,
+        'element': element,
+        'base': base,
+        'attributes': attributes,
+    }
+
+_TYPES = [
+    _type(16, 'bool', category='B'),
+    _type(17, 'bytea'),
+    _type(23, 'int4', category='N'),
+    _type(25, 'text', category='S'),
+    _type(1007, '_int4', category='A', element=23),
+    _type(1009, '_text', category='A', element=25),
+    _type(1184, 'timestamptz', category='D'),
+    _type(1700, 'numeric', category='N'),
+    _type(3802, 'jsonb'),
+    _type(90000, 'amount', type='d', category='N', base=1700),
+    _type(90001, 'recipient', type='c', category='C',
+        attributes=[['type', 25], ['ids', 1007]]),
+]
+
+def _make_decoder(columns):
+    """Makes a `RowDecoder` for columns given as pairs of their names and type
+    oids, as if from the output of the `describe_columns` query."""
+    description = json.dumps({'columns': columns, 'types': _TYPES})
+    # COPY escapes the backslashes that JSON escapes are written with.
+    return copy_format.RowDecoder(description.replace('\\', '\\\\'))
+
+class UnescapeFieldTest(unittest.TestCase):
+
+    def test_null(self):
+        self.assertIsNone(copy_format.unescape_field('\\N'))
+        self.assertEqual(copy_format.unescape_field('N'), 'N')
+
+    def test_escapes(self):
+        self.assertEqual(
+            copy_format.unescape_field('a\\tb\\nc\\\\d\\101\\x42\\.'),
+            'a\tb\nc\\dAB.')
+
+    def test_split_row(self):
+        self.assertEqual(
+            copy_format.split_row('a\\tb\t\\N\t'),
+            ['a\tb', None, ''])
+
+class RowDecoderTest(unittest.TestCase):
+
+    def test_scalars(self):
+        decoder = _make_decoder([
+            ['id', 23],
+            ['ok', 16],
+            ['hash', 17],
+            ['amount', 90000],
+            ['data', 3802],
+            ['name', 25],
+        ])
+        self.assertEqual(
+            decoder.column_names,
+            ['id', 'ok', 'hash', 'amount', 'data', 'name'])
+        self.assertEqual(
+            decoder.decode(
+                '7\tt\t\\\\x00ff\t1.50\t{"a": [1]}\t\\N'),
+            {
+                'id': 7,
+                'ok': True,
+                'hash': b'\x00\xff',
+                'amount': decimal.Decimal('1.50'),
+                'data': {'a': [1]},
+                'name': None,
+            })
+
+    def test_timestamps(self):
+        decoder = _make_decoder([['time', 1184]])
+        for text, value in [
+                (
+                    '2020-01-02 03:04:05.5+00',
+                    datetime.datetime(
+                        2020, 1, 2, 3, 4, 5, 500000, datetime.timezone.utc),
+                ),
+                (
+                    '2020-01-02 03:04:05-05:30',
+                    datetime.datetime(
+                        2020, 1, 2, 3, 4, 5, 0,
+                        datetime.timezone(
+                            -datetime.timedelta(hours=5, minutes=30))),
+                ),
+                ('infinity', 'infinity'),
+                ('0001-01-01 00:00:00+00 BC', '0001-01-01 00:00:00+00 BC')]:
+            self.assertEqual(decoder.decode(text), {'time': value})
+
+    def test_legacy_bytea(self):
+        decoder = _make_decoder([['hash', 17]])
+        self.assertEqual(
+            decoder.decode('a\\\\000\\\\\\\\'), {'hash': b'a\x00\\'})
+
+    def test_arrays(self):
+        decoder = _make_decoder([['ids', 1007], ['names', 1009]])
+        self.assertEqual(
+            decoder.decode(
+                '{{1,NULL},{3,4}}\t[0:2]={"a,b","\\\\"",NULL,"NULL"}'),
+            {
+                'ids': [[1, None], [3, 4]],
+                'names': ['a,b', '"', None, 'NULL'],
+            })
+        self.assertEqual(decoder.decode('{}\t{}'), {'ids': [], 'names': []})
+
+    def test_composites(self):
+        decoder = _make_decoder([['recipient', 90001]])
+        self.assertEqual(
+            decoder.decode('(reddit_user,"{1,2}")'),
+            {'recipient': {'type': 'reddit_user', 'ids': [1, 2]}})
+        self.assertEqual(
+            decoder.decode('("a ""b""",)'),
+            {'recipient': {'type': 'a "b"', 'ids': None}})
+
+class DescribeColumnsTest(unittest.TestCase):
+
+    def test_quotes_names(self):
+        query = copy_format.describe_columns(
+            [('it\'s', 'integer'), ('b', 'character varying(3)')])
+        self.assertIn(
+            '    (0, \'it\'\'s\', \'integer\'::regtype),\n'
+            '    (1, \'b\', \'character varying(3)\'::regtype))',
+            query)
+
+    def test_no_columns(self):
+        self.assertIn('LIMIT 0', copy_format.describe_columns([]))
+
+if __name__ == '__main__':
+    unittest.main()
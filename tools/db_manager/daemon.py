@@ -0,0 +1,153 @@
+"""Serves db manager commands on a Unix socket, from a process that stays up.
+
+Starting db manager means starting Python, finding the workspace, reading the
+configs and connecting to the database, which takes much longer than most
+commands do. `manager.py serve` does all that once and then runs the commands
+sent by `client.py`, keeping its database sessions open between them.
+
+Requests and responses are JSON objects, one per line. A request has the
+command line, working directory and stdin of a client. The server answers with
+`stdout` and `stderr` messages as output is written, and ends with one with the
+`exit` status. If the server's code has changed since it started, it answers
+with `fallback` instead and exits, and the client runs the command itself.
+
+Commands are run one at a time. Output written directly to the server's file
+descriptors, such as that of shell patches, goes to the server's terminal."""
+
+import io
+import json
+import os
+import socket
+import sys
+import traceback
+
+# Commands that are never sent to the server: `connect` needs a terminal, and
+# the others never finish.
+LOCAL_COMMANDS = ('serve', 'connect', 'watch')
+
+def serve(socket_path, run, is_stale):
+    """Runs commands sent to a socket until interrupted. `run` is called with
+    the arguments of each command, with the request's stdin and working
+    directory and with its output sent to the client. `is_stale` says whether
+    the server should stop and let clients run commands themselves."""
+    if os.path.exists(socket_path):
+        if _is_listening(socket_path):
+            raise Exception('A server is already listening on "{}".'.format(
+                socket_path))
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        server.listen(16)
+        print('Serving on {}.'.format(socket_path))
+        sys.stdout.flush()
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                if not _handle(connection, run, is_stale):
+                    print('Code has changed; stopping.')
+                    return
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+def send(file, **message):
+    file.write(json.dumps(message).encode('utf8') + b'\n')
+    file.flush()
+
+def receive(file):
+    line = file.readline()
+    if not line:
+        raise EOFError()
+    return json.loads(line.decode('utf8'))
+
+def _handle(connection, run, is_stale):
+    file = connection.makefile('rwb')
+    try:
+        request = receive(file)
+        if is_stale():
+            send(file, fallback=True)
+            return False
+        send(file, exit=_run_request(request, file, run))
+    except (EOFError, BrokenPipeError, ConnectionResetError):
+        # The client went away. Whatever it asked for has already run.
+        pass
+    finally:
+        file.close()
+    return True
+
+def _run_request(request, file, run):
+    stdout, stderr, stdin = sys.stdout, sys.stderr, sys.stdin
+    cwd = os.getcwd()
+    sys.stdout = _Writer(file, 'stdout')
+    sys.stderr = _Writer(file, 'stderr')
+    sys.stdin = io.StringIO(request.get('stdin') or '')
+    try:
+        os.chdir(request['cwd'])
+        run(request['argv'])
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr, sys.stdin = stdout, stderr, stdin
+        os.chdir(cwd)
+
+def _is_listening(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        client.close()
+
+class _Writer(io.TextIOBase):
+    """Sends text written to it to the client, as messages of one kind."""
+
+    def __init__(self, file, kind):
+        super().__init__()
+        self.buffer = _BinaryWriter(self)
+        self._file = file
+        self._kind = kind
+        self._pending = []
+
+    def write(self, text):
+        self._pending.append(text)
+        if '\n' in text:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self._pending:
+            text = ''.join(self._pending)
+            self._pending = []
+            send(self._file, **{self._kind: text})
+
+class _BinaryWriter(io.RawIOBase):
+    """The `buffer` of a `_Writer`. Bytes that aren't UTF-8 are kept as
+    surrogates, which the client turns back into the same bytes."""
+
+    def __init__(self, writer):
+        super().__init__()
+        self._writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._writer.write(bytes(data).decode('utf8', 'surrogateescape'))
+        return len(data)
+
+    def flush(self):
+        self._writer.flush()
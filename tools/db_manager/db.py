@@ -3,28 +3,113 @@
 This is intended for lightweight use -- one-time use scripts, jobs that run
 infrequently, etc."""
 
+import atexit
+import collections
+import contextlib
 import functools
+import itertools
 import json
 import os
 import re
 import subprocess
+import sys
+import uuid
+from tools.db_manager import copy_format
+from tools.db_manager import sql_lexer
 
 _HOME_DIR = os.path.expanduser('~')
 
+# Keeps one `psql` process open per database and reuses it across calls.
+SESSION_BACKEND = 'session'
+# Starts a new `psql` process for every call.
+SUBPROCESS_BACKEND = 'subprocess'
+
+# Seconds to wait for psql to exit after its session is closed.
+_SESSION_CLOSE_TIMEOUT = 5
+
+# Bytes read from psql at a time when copying its output to a file.
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+# SQLSTATEs of errors caused by contention for locks, after which a transaction
+# may succeed if it's retried.
+LOCK_NOT_AVAILABLE = '55P03'
+DEADLOCK_DETECTED = '40P01'
+
+# Matches errors reported by psql with `VERBOSITY=verbose`.
+_ERROR_SQLSTATE_RE = re.compile(
+    r'\b(?:ERROR|FATAL):  ([0-9A-Z]{5}): ', re.MULTILINE)
+
 _config_info_paths = []
 
+_backend = SESSION_BACKEND
+
+# Open sessions, keyed by database name.
+_sessions = collections.defaultdict(list)
+
+# Used to give each prepared statement a name that is unique in its session.
+_statement_ids = itertools.count()
+
 def set_config_files(files):
     global _config_info_paths
+    if files != _config_info_paths:
+        # Sessions and the cached config belong to the old files.
+        close()
+        _get_db_config.cache_clear()
     _config_info_paths = files
 
+def set_backend(backend):
+    """Selects how queries are sent to the database."""
+    global _backend
+    if backend not in (SESSION_BACKEND, SUBPROCESS_BACKEND):
+        raise Exception('Unknown database backend "{}".'.format(backend))
+    if backend != _backend:
+        close()
+    _backend = backend
+
+def get_backend():
+    return _backend
+
+def close(db_name=None):
+    """Closes open sessions to a database, or to all databases if no name is
+    given.
+
+    Sessions hold connections, so this must be called before a database is
+    dropped or used as a template."""
+    if db_name is None:
+        names = list(_sessions.keys())
+    else:
+        names = [_resolve_db_name(db_name)]
+    for name in names:
+        for session in _sessions.pop(name, []):
+            session.close()
+
 def connect_repl(db_name=None):
-    env, params = _get_subprocess_params(db_name=db_name)
+    env, params = get_subprocess_params(db_name=db_name)
     subprocess.check_call(
         ['psql'] + params,
         env=env)
 
-def query(text, db_name=None):
-    """Send a SQL query to the database and get the response as text."""
+def query(text, params=None, db_name=None):
+    """Send a SQL query to the database and get the response as text.
+
+    If `params` are given, they are the values of `$1`, `$2` and so on in the
+    query, which is run as a prepared statement. Values are sent as quoted
+    literals, so they are never interpreted as SQL.
+
+    If the text has several statements, only the last one's result is
+    returned, as with `psql -c`."""
+    if params is not None:
+        return executemany(text, [params], db_name=db_name)
+    if _backend == SESSION_BACKEND:
+        statements = sql_lexer.split_statements(text)
+        if len(statements) > 1:
+            # The output of the earlier statements is discarded.
+            last = statements[-1].start
+            text = '\\o /dev/null\n{}\n\\o\n{}'.format(
+                text[0:last], text[last:])
+        with _session(db_name) as session:
+            # The extra semicolon terminates queries that don't end with one.
+            return session.run(text + '\n;')
     return call_with_params(
         [
             'psql',
@@ -33,17 +118,80 @@ def query(text, db_name=None):
         ],
         db_name=db_name)
 
-def query_to_json(text, db_name=None):
+def query_to_json(text, params=None, db_name=None):
     """Send a SQL query to the database and get the response as JSON."""
     query_return = query(
         'SELECT array_to_json(array_agg(t)) FROM ({}) t;'.format(text),
-        db_name)
+        params=params,
+        db_name=db_name)
     if query_return.strip() == '':
         return None
     return json.loads(query_return)
 
+def executemany(text, params_list, db_name=None):
+    """Runs a parameterized query once for each list of params, in a single
+    transaction, and gets the responses as text.
+
+    With the session backend each query is prepared once per session, so
+    running it again skips parsing and planning."""
+    if _backend == SESSION_BACKEND:
+        with _session(db_name) as session:
+            name, prepare = session.prepare(text)
+            return session.run(
+                prepare + _in_transaction(_execute(name, params_list)))
+    name = 'db_manager_statement_{}'.format(next(_statement_ids))
+    return query_script(
+        _prepare(name, text) + _execute(name, params_list),
+        db_name=db_name)
+
+def query_rows(text, db_name=None):
+    """Send a SQL query to the database and yield the rows of its result.
+
+    Each row is a dict keyed by column name, with values decoded according to
+    their column types. Rows are streamed with `COPY ... TO STDOUT` rather than
+    being collected into one value, so memory use stays flat regardless of the
+    size of the result.
+
+    The result's columns are first described with psql's `\\gdesc`, which
+    needs psql 11 or later. Nothing is created in the database, so this works
+    on read-only standbys, and columns may share a name, though only the last
+    of them is kept in each row."""
+    if _backend == SESSION_BACKEND:
+        context = _session(db_name)
+    else:
+        context = _one_time_session(db_name)
+    with context as session:
+        columns = parse_columns(session.lines(get_columns_script(text)))
+        lines = session.lines(get_rows_script(text, columns))
+        decoder = copy_format.RowDecoder(next(lines))
+        for line in lines:
+            yield decoder.decode(line)
+
+def get_columns_script(text):
+    """Gets a psql script that prints the name and type of each column of a
+    query's result, without running the query. `parse_columns` reads its
+    output."""
+    return '{}\n\\gdesc'.format(_strip_semicolon(text))
+
+def parse_columns(lines):
+    """Parses the output of the script from `get_columns_script` into a list
+    of the name and type name of each column."""
+    # Type names never contain `|`, but column names may.
+    return [tuple(line.rsplit('|', 1)) for line in lines if line != '']
+
+def get_rows_script(text, columns):
+    """Gets the psql script `query_rows` runs, given the query's columns from
+    `parse_columns`. It prints a description of the columns, which
+    `copy_format.RowDecoder` takes, followed by the rows."""
+    return '\n'.join([
+        'COPY ({}) TO STDOUT;'.format(copy_format.describe_columns(columns)),
+        'COPY (\n{}\n) TO STDOUT;'.format(_strip_semicolon(text)),
+    ])
+
 def query_file(file, db_name=None):
     """Send a file as a SQL query to the database and get the response text."""
+    if _backend == SESSION_BACKEND:
+        return query_script(include_file(file), db_name=db_name)
     return call_with_params(
         [
             'psql',
@@ -54,6 +202,165 @@ def query_file(file, db_name=None):
         ],
         db_name=db_name)
 
+def query_script(script, db_name=None):
+    """Send a psql script to the database as a single transaction and get the
+    response text.
+
+    The script may use meta-commands, such as the ones built by `include_file`.
+    If any statement fails the whole script is rolled back."""
+    if _backend == SESSION_BACKEND:
+        with _session(db_name) as session:
+            return session.run(_in_transaction(script))
+    env, params = get_subprocess_params(db_name=db_name)
+    return subprocess.check_output(
+        [
+            'psql',
+            '-At',
+            '-v', 'ON_ERROR_STOP=1',
+            '--single-transaction',
+            '-f', '-'
+        ] + params,
+        input=script.encode('utf8'),
+        env=env).decode('utf8')
+
+class QueryError(subprocess.CalledProcessError):
+    """A psql script failed. `sqlstate` is the SQLSTATE of the error that
+    stopped it, if there was one."""
+
+    def __init__(self, returncode, cmd, output, stderr, sqlstate):
+        super().__init__(returncode, cmd, output, stderr)
+        self.sqlstate = sqlstate
+
+def run_script(script, db_name=None, single_transaction=True):
+    """Runs a psql script in a psql process of its own and gets the response
+    text.
+
+    Unlike `query_script`, a failure raises a `QueryError` that says which error
+    stopped the script, so that callers can retry after lock timeouts. Unless
+    `single_transaction` is set, each statement commits on its own."""
+    env, params = get_subprocess_params(db_name=db_name)
+    args = [
+        'psql',
+        '-X',
+        '-At',
+        '-v', 'ON_ERROR_STOP=1',
+        '-v', 'VERBOSITY=verbose',
+    ]
+    if single_transaction:
+        args.append('--single-transaction')
+    args += ['-f', '-'] + params
+    process = subprocess.run(
+        args,
+        input=script.encode('utf8'),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env)
+    stderr = process.stderr.decode('utf8', 'replace')
+    sys.stderr.write(stderr)
+    if process.returncode != 0:
+        matches = _ERROR_SQLSTATE_RE.search(stderr)
+        raise QueryError(
+            process.returncode,
+            args,
+            process.stdout,
+            process.stderr,
+            matches.group(1) if matches else None)
+    return process.stdout.decode('utf8')
+
+def copy_to(query, file, options='', setup=None, db_name=None):
+    """Writes the result of a query to a binary file object with `COPY ...
+    TO STDOUT`, and returns the number of bytes written.
+
+    The output of psql is copied to the file as it arrives, without being
+    decoded or collected, so memory use is constant however large the result
+    is. `options` are the `COPY` options, such as `(FORMAT csv)`. `setup` is
+    SQL run first in the same read-only transaction, whose output is
+    discarded."""
+    env, params = get_subprocess_params(db_name=db_name)
+    args = [
+        'psql',
+        '-X',
+        '-At',
+        '-v', 'ON_ERROR_STOP=1',
+        '--single-transaction',
+        '-f', '-'
+    ] + params
+    script = '\n'.join([
+        '\\set QUIET on',
+        'SET TRANSACTION READ ONLY;',
+        '\\o /dev/null',
+        setup or '',
+        '\\o',
+        'COPY (\n{}\n) TO STDOUT {};'.format(
+            _strip_semicolon(query), options),
+    ])
+    process = subprocess.Popen(
+        args,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE)
+    try:
+        # psql reads the whole script before the `COPY` writes anything, so
+        # writing all of it first can't deadlock.
+        try:
+            process.stdin.write(script.encode('utf8'))
+            process.stdin.close()
+        except BrokenPipeError:
+            # psql exited early; its exit status says why.
+            pass
+        size = 0
+        while True:
+            chunk = process.stdout.read(_COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            file.write(chunk)
+            size += len(chunk)
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+    return size
+
+def _prepare(name, text):
+    return '\n'.join([
+        '\\set QUIET on',
+        'PREPARE {} AS\n{}\n;'.format(name, _strip_semicolon(text)),
+        '\\set QUIET off',
+        '',
+    ])
+
+def _execute(name, params_list):
+    return '\n'.join(
+        'EXECUTE {}({});'.format(
+            name, ', '.join(_format_param(p) for p in params))
+        for params in params_list)
+
+def _format_param(value):
+    """Formats a query parameter as a literal. Values other than NULL are
+    quoted, so they take the type of their parameter."""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, (bytes, bytearray)):
+        value = '\\x' + value.hex()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    else:
+        value = str(value)
+    return '\'{}\''.format(value.replace('\'', '\'\''))
+
+def include_file(file):
+    """Get the psql meta-command which runs a file as part of a script.
+
+    It's followed by a semicolon, which ends the file's last statement if the
+    file doesn't, so that it isn't joined to whatever the script sends next."""
+    return '\\i {}\n;'.format(_quote_argument(file))
+
 def get_db_name():
     """Get the database name."""
     config, _env = _get_db_config()
@@ -70,15 +377,149 @@ def is_host_local():
 
 def call_with_params(before_params, after_params=[], db_name=None):
     """Execute a PostgreSQL command in a subprocess."""
-    env, params = _get_subprocess_params(db_name=db_name)
+    env, params = get_subprocess_params(db_name=db_name)
     return subprocess.check_output(
         before_params
         + params
         + after_params,
         env=env).decode('utf8')
 
-def _get_subprocess_params(db_name=None):
-    config, env = _get_db_config()
+def _in_transaction(script):
+    return '\n'.join([
+        '\\set QUIET on',
+        'BEGIN;',
+        '\\set QUIET off',
+        script,
+        '\\set QUIET on',
+        'COMMIT;',
+        '\\set QUIET off',
+    ])
+
+def _quote_argument(value):
+    """Quotes an argument to a psql meta-command such as `\\i`. Like SQL,
+    psql reads `''` in a quoted argument as one quote."""
+    return '\'' + value.replace('\\', '\\\\').replace('\'', '\'\'') + '\''
+
+def _strip_semicolon(text):
+    return re.sub(r';\s*$', '', text)
+
+def _resolve_db_name(db_name):
+    if db_name is not None:
+        return db_name
+    config, _env = _get_db_config()
+    return config['database']
+
+@contextlib.contextmanager
+def _session(db_name=None):
+    """Borrows an idle session to a database, opening one if there is none."""
+    db_name = _resolve_db_name(db_name)
+    sessions = _sessions[db_name]
+    idle = [s for s in sessions if not s.busy]
+    if len(idle) > 0:
+        session = idle[0]
+    else:
+        session = _PsqlSession(db_name)
+        sessions.append(session)
+    session.busy = True
+    try:
+        yield session
+    except BaseException:
+        # The session may have been left in an unknown state (or psql may have
+        # exited), so it can't be reused.
+        if session in sessions:
+            sessions.remove(session)
+        session.close()
+        raise
+    finally:
+        session.busy = False
+
+@contextlib.contextmanager
+def _one_time_session(db_name=None):
+    session = _PsqlSession(_resolve_db_name(db_name))
+    try:
+        yield session
+    finally:
+        session.close()
+
+class _PsqlSession:
+    """A long-lived `psql` process that runs scripts sent to its stdin.
+
+    After each script an `\\echo` of a unique marker is sent, and output is read
+    until the marker comes back. `ON_ERROR_STOP` makes psql exit on the first
+    error, which the reader sees as the end of its output."""
+
+    def __init__(self, db_name):
+        env, params = get_subprocess_params(db_name=db_name)
+        self.db_name = db_name
+        self.busy = False
+        # Names of the statements prepared in this session, keyed by query.
+        self._prepared = dict()
+        self._marker = '__db_manager_{}__'.format(uuid.uuid4().hex)
+        self._args = ['psql', '-X', '-At', '-v', 'ON_ERROR_STOP=1'] + params
+        self._process = subprocess.Popen(
+            self._args,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    def prepare(self, text):
+        """Gets the name of the prepared statement for a query, and the script
+        that prepares it if that hasn't been done yet in this session."""
+        if text in self._prepared:
+            return self._prepared[text], ''
+        name = 'db_manager_statement_{}'.format(next(_statement_ids))
+        self._prepared[text] = name
+        return name, _prepare(name, text)
+
+    def run(self, script):
+        """Runs a script and returns everything it prints."""
+        return ''.join(line + '\n' for line in self.lines(script))
+
+    def lines(self, script):
+        """Runs a script and yields each line it prints, without line
+        endings.
+
+        A script that ends inside a string, quoted identifier or comment is
+        rejected without being sent, since psql would wait for the rest of it
+        and the marker would never come back."""
+        sql_lexer.check_terminated(script)
+        try:
+            self._process.stdin.write(
+                '{}\n\\echo {}\n'.format(script, self._marker).encode('utf8'))
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        for line in iter(self._process.stdout.readline, b''):
+            line = line.decode('utf8').rstrip('\n')
+            if line == self._marker:
+                return
+            yield line
+        raise subprocess.CalledProcessError(self._process.wait(), self._args)
+
+    def close(self):
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        # Closing stdout stops psql if it is still writing the output of a
+        # script whose reader stopped early.
+        self._process.stdout.close()
+        try:
+            self._process.wait(timeout=_SESSION_CLOSE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+atexit.register(close)
+
+def get_subprocess_params(db_name=None, config_files=None):
+    """Gets the environment and connection arguments for running `psql` and
+    other PostgreSQL commands against a database.
+
+    `config_files` overrides the configured files, so that databases on other
+    servers can be reached."""
+    config, env = _get_db_config(
+        None if config_files is None else tuple(config_files))
     return env, [
         '-h', config['host'],
         '-p', str(config['port']),
@@ -86,18 +527,18 @@ def _get_subprocess_params(db_name=None):
         '-d', db_name if db_name is not None else config['database']
     ]
 
-@functools.lru_cache(maxsize=1)
-def _get_db_config():
-    config = _get_db_config_object()
+@functools.lru_cache(maxsize=16)
+def _get_db_config(config_files=None):
+    config = _get_db_config_object(config_files or _config_info_paths)
     env = os.environ.copy()
     env['PGPASSWORD'] = config['password']
     return config, env
 
-def _get_db_config_object():
-    if len(_config_info_paths) == 0:
+def _get_db_config_object(config_files):
+    if len(config_files) == 0:
         raise Exception('Config file location has not been configured.')
     obj = dict()
-    for file in _config_info_paths:
+    for file in config_files:
         with open(file) as info:
             obj.update(json.load(info))
     return obj
@@ -0,0 +1,106 @@
+"""Runs queries as coroutines, so that many databases can be queried at once.
+
+Each query runs in a `psql` process of its own, like `db` does with its
+subprocess backend, and at most `set_max_processes` of them run at a time.
+Everything else waits for a free slot, so fanning out over many databases
+doesn't open more connections than the servers are meant to take. For example:
+
+    statuses = db_async.run(asyncio.gather(*[
+        db_async.query('SELECT count(*) FROM db_patches', db_name=name)
+        for name in names]))
+
+Queries go to the databases configured with `db.set_config_files`, unless
+`config_files` are given, which allows querying other servers too. Results are
+collected in memory, so this is meant for catalog and status queries rather
+than large exports."""
+
+import asyncio
+import subprocess
+import weakref
+from tools.db_manager import copy_format
+from tools.db_manager import db
+
+_max_processes = 8
+
+# Limits the processes running in each event loop, keyed by the loop.
+_semaphores = weakref.WeakKeyDictionary()
+
+def set_max_processes(count):
+    """Sets how many queries can run at a time. Takes effect in event loops
+    that haven't run a query yet."""
+    global _max_processes
+    if count < 1:
+        raise Exception('At least one process must be allowed.')
+    _max_processes = count
+
+def run(coroutine):
+    """Runs a coroutine to completion in the current event loop and returns
+    its result."""
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+async def query(text, db_name=None, config_files=None):
+    """Send a SQL query to the database and get the response as text."""
+    return await _call(
+        ['psql', '-At', '-c', text],
+        db_name=db_name,
+        config_files=config_files)
+
+async def query_rows(text, db_name=None, config_files=None):
+    """Send a SQL query to the database and get a list of the rows of its
+    result, decoded like `db.query_rows` does."""
+    args = ['psql', '-X', '-At', '-v', 'ON_ERROR_STOP=1', '-f', '-']
+    columns = db.parse_columns((await _call(
+        args,
+        input=db.get_columns_script(text),
+        db_name=db_name,
+        config_files=config_files)).split('\n'))
+    output = await _call(
+        args,
+        input=db.get_rows_script(text, columns),
+        db_name=db_name,
+        config_files=config_files)
+    lines = output.split('\n')[:-1]
+    decoder = copy_format.RowDecoder(lines[0])
+    return [decoder.decode(line) for line in lines[1:]]
+
+async def query_file(file, db_name=None, config_files=None):
+    """Send a file as a SQL query to the database and get the response text."""
+    return await _call(
+        [
+            'psql',
+            '-At',
+            '-v', 'ON_ERROR_STOP=1',
+            '--single-transaction',
+            '-f', file
+        ],
+        db_name=db_name,
+        config_files=config_files)
+
+async def _call(args, input=None, db_name=None, config_files=None):
+    env, params = db.get_subprocess_params(
+        db_name=db_name, config_files=config_files)
+    async with _get_semaphore():
+        process = await asyncio.create_subprocess_exec(
+            *(args + params),
+            env=env,
+            stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        try:
+            output, _ = await process.communicate(
+                None if input is None else input.encode('utf8'))
+        except BaseException:
+            # Cancelled, for example because another query in a `gather`
+            # failed. The process would otherwise outlive its query.
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return output.decode('utf8')
+
+def _get_semaphore():
+    loop = asyncio.get_event_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(_max_processes)
+    return _semaphores[loop]
@@ -1,14 +1,227 @@
 from tools.db_manager import db
+from tools.db_manager import file_reader
 from tools.db_manager import patch_reader
+import collections
+import contextlib
 import functools
 import hashlib
 import re
+import subprocess
+import time
+
+# The schema of a newly initialized database, before any patches are applied.
+_INITIAL_SCHEMA = (
+    'CREATE TABLE db_patches ( '
+        'hash bytea PRIMARY KEY NOT NULL, '
+        'applied_time timestamp with time zone DEFAULT now() NOT NULL '
+            'CHECK (date_part(\'timezone\', applied_time) = 0));')
+
+# Partitions of partitioned tables are kept in this schema, which is left out of
+# the saved schema, since which partitions exist depends on when the database
+# was built.
+PARTITION_SCHEMA = 'partitions'
+
+# Objects in these schemas, and objects that belong to extensions, are not part
+# of the schema fingerprint, just as they're not part of `pg_dump` output.
+_USER_NAMESPACES = '''
+    SELECT oid FROM pg_namespace
+        WHERE nspname NOT IN ('pg_catalog', 'information_schema', '{}')
+            AND nspname NOT LIKE 'pg\\_toast%'
+            AND nspname NOT LIKE 'pg\\_temp\\_%'
+'''.format(PARTITION_SCHEMA)
+_NOT_IN_EXTENSION = '''
+    NOT EXISTS (
+        SELECT 1 FROM pg_depend d
+            WHERE d.classid = '{catalog}'::regclass
+                AND d.objid = {oid}
+                AND d.deptype = 'e')
+'''
+
+# Describes everything `pg_dump --schema-only` would, one line per object
+# or column, and hashes the sorted lines. Function bodies and comments are
+# included as their own hashes. Columns are numbered by their position among
+# the columns that weren't dropped, since that's the order they're dumped in.
+_SCHEMA_FINGERPRINT_QUERY = '''
+WITH lines(line) AS (
+    SELECT format('relation %s.%s %s %s %s %s %s %s %s %s %s',
+            c.relnamespace::regnamespace, c.relname, c.relkind,
+            c.relpersistence, pg_get_userbyid(c.relowner), c.relacl,
+            c.reloptions, c.relrowsecurity, c.relforcerowsecurity,
+            c.relreplident,
+            CASE WHEN c.relkind = 'p' THEN pg_get_partkeydef(c.oid) END)
+        FROM pg_class c
+        WHERE c.relnamespace IN ({namespaces})
+            AND c.relkind IN ('r', 'p', 'v', 'm', 'S', 'f')
+            AND {class_not_in_extension}
+    UNION ALL
+    SELECT format('column %s.%s.%s %s %s %s %s %s %s %s %s %s %s',
+            c.relnamespace::regnamespace, c.relname, a.attname,
+            row_number() OVER (PARTITION BY a.attrelid ORDER BY a.attnum),
+            format_type(a.atttypid, a.atttypmod), a.attnotnull,
+            pg_get_expr(ad.adbin, ad.adrelid), a.attacl, a.attidentity,
+            a.attstattarget, a.attstorage, a.attoptions, a.attcollation)
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        LEFT JOIN pg_attrdef ad
+            ON ad.adrelid = a.attrelid AND ad.adnum = a.attnum
+        WHERE c.relnamespace IN ({namespaces})
+            AND c.relkind IN ('r', 'p', 'v', 'm', 'c', 'f')
+            AND a.attnum > 0
+            AND NOT a.attisdropped
+            AND {class_not_in_extension}
+    UNION ALL
+    SELECT format('constraint %s.%s.%s %s',
+            co.connamespace::regnamespace,
+            coalesce(c.relname, t.typname), co.conname,
+            pg_get_constraintdef(co.oid))
+        FROM pg_constraint co
+        LEFT JOIN pg_class c ON c.oid = co.conrelid
+        LEFT JOIN pg_type t ON t.oid = co.contypid
+        WHERE co.connamespace IN ({namespaces})
+    UNION ALL
+    SELECT format('index %s', pg_get_indexdef(i.indexrelid))
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relnamespace IN ({namespaces})
+    UNION ALL
+    SELECT format('function %s.%s(%s) %s %s %s %s %s %s %s',
+            p.pronamespace::regnamespace, p.proname,
+            pg_get_function_identity_arguments(p.oid),
+            pg_get_function_result(p.oid), l.lanname, p.provolatile,
+            p.prosecdef, pg_get_userbyid(p.proowner), p.proacl,
+            md5(p.prosrc))
+        FROM pg_proc p
+        JOIN pg_language l ON l.oid = p.prolang
+        WHERE p.pronamespace IN ({namespaces})
+            AND {proc_not_in_extension}
+    UNION ALL
+    SELECT format('trigger %s', pg_get_triggerdef(t.oid))
+        FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        WHERE c.relnamespace IN ({namespaces})
+            AND NOT t.tgisinternal
+    UNION ALL
+    SELECT format('type %s.%s %s %s %s %s',
+            t.typnamespace::regnamespace, t.typname, t.typtype,
+            pg_get_userbyid(t.typowner),
+            format_type(t.typbasetype, t.typtypmod),
+            (SELECT string_agg(e.enumlabel, ',' ORDER BY e.enumsortorder)
+                FROM pg_enum e
+                WHERE e.enumtypid = t.oid))
+        FROM pg_type t
+        LEFT JOIN pg_class c ON c.oid = t.typrelid
+        WHERE t.typnamespace IN ({namespaces})
+            AND (t.typtype IN ('e', 'd', 'r')
+                OR (t.typtype = 'c' AND c.relkind = 'c'))
+            AND {type_not_in_extension}
+    UNION ALL
+    SELECT format('view %s.%s %s',
+            c.relnamespace::regnamespace, c.relname,
+            md5(pg_get_viewdef(c.oid)))
+        FROM pg_class c
+        WHERE c.relnamespace IN ({namespaces})
+            AND c.relkind IN ('v', 'm')
+    UNION ALL
+    SELECT format('extension %s %s', e.extname, e.extnamespace::regnamespace)
+        FROM pg_extension e
+        WHERE e.extname <> 'plpgsql'
+    UNION ALL
+    SELECT format('schema %s %s', n.nspname, pg_get_userbyid(n.nspowner))
+        FROM pg_namespace n
+        WHERE n.oid IN ({namespaces})
+    UNION ALL
+    SELECT format('sequence %s.%s %s %s %s %s %s %s %s %s',
+            c.relnamespace::regnamespace, c.relname,
+            format_type(s.seqtypid, NULL), s.seqstart, s.seqincrement,
+            s.seqmax, s.seqmin, s.seqcache, s.seqcycle,
+            (SELECT pg_describe_object(d.refclassid, d.refobjid, d.refobjsubid)
+                FROM pg_depend d
+                WHERE d.classid = 'pg_class'::regclass
+                    AND d.objid = c.oid
+                    AND d.deptype IN ('a', 'i')))
+        FROM pg_sequence s
+        JOIN pg_class c ON c.oid = s.seqrelid
+        WHERE c.relnamespace IN ({namespaces})
+            AND {class_not_in_extension}
+    UNION ALL
+    SELECT format('policy %s.%s %s %s %s %s %s',
+            p.polrelid::regclass, p.polname, p.polcmd, p.polpermissive,
+            p.polroles::regrole[], pg_get_expr(p.polqual, p.polrelid),
+            pg_get_expr(p.polwithcheck, p.polrelid))
+        FROM pg_policy p
+        JOIN pg_class c ON c.oid = p.polrelid
+        WHERE c.relnamespace IN ({namespaces})
+    UNION ALL
+    SELECT format('rule %s', pg_get_ruledef(r.oid))
+        FROM pg_rewrite r
+        JOIN pg_class c ON c.oid = r.ev_class
+        WHERE c.relnamespace IN ({namespaces})
+            AND r.rulename <> '_RETURN'
+    UNION ALL
+    SELECT format('comment %s %s',
+            pg_describe_object(d.classoid, d.objoid, d.objsubid),
+            md5(d.description))
+        FROM pg_description d
+        WHERE coalesce(
+                (pg_identify_object(d.classoid, d.objoid, d.objsubid)).schema,
+                CASE WHEN d.classoid = 'pg_namespace'::regclass
+                    THEN d.objoid::regnamespace::text END)
+                IN (SELECT nspname FROM pg_namespace
+                    WHERE oid IN ({namespaces}))
+            AND NOT EXISTS (
+                SELECT 1 FROM pg_depend e
+                    WHERE e.classid = d.classoid
+                        AND e.objid = d.objoid
+                        AND e.deptype = 'e')
+)
+SELECT md5(string_agg(line, E'\\n' ORDER BY line)) FROM lines;
+'''.format(
+    namespaces=_USER_NAMESPACES,
+    class_not_in_extension=_NOT_IN_EXTENSION.format(
+        catalog='pg_class', oid='c.oid'),
+    proc_not_in_extension=_NOT_IN_EXTENSION.format(
+        catalog='pg_proc', oid='p.oid'),
+    type_not_in_extension=_NOT_IN_EXTENSION.format(
+        catalog='pg_type', oid='t.oid'))
+
+# Dev mode snapshots record when they were last used in their database comment.
+_LAST_USED_COMMENT = 'db_manager last used: {}'
+_LAST_USED_COMMENT_RE = re.compile(r'^db_manager last used: ([\d.]+)$')
+
+# Dev mode snapshots are named after the database and a version hash. Other
+# databases named after the database, such as templates and clones, aren't
+# snapshots.
+_SNAPSHOT_SUFFIX_RE = re.compile(r'^[0-9a-f]+$')
+
+# Clones are named after their prefix and a number.
+_CLONE_SUFFIX_RE = re.compile(r'^\d+$')
 
 _dev_mode = False
 
+# Set by `use_database` to send queries to another database, such as a scratch
+# database.
+_db_name_override = None
+
+# In dev mode, a snapshot of the database is saved after every `stride` patches
+# applied by an upgrade. `None` disables this.
+_checkpoint_stride = None
+
+# The number of patches applied to the most recent snapshot the dev mode
+# database was created from or saved as.
+_last_checkpoint = 0
+
+_Snapshot = collections.namedtuple(
+    'Snapshot',
+    # `patch_count` is the number of current patches the snapshot has applied,
+    # or `None` if it doesn't match a prefix of the current patches.
+    ['name', 'size', 'last_used', 'patch_count'])
+
 def set_config_files(files):
     db.set_config_files(files)
 
+def set_backend(backend):
+    db.set_backend(backend)
+
 def set_dev_mode(value):
     global _dev_mode
     if value and not db.is_host_local():
@@ -17,55 +230,338 @@ def set_dev_mode(value):
             'database.')
     _dev_mode = value
 
+def is_dev_mode():
+    return _dev_mode
+
+def clear_caches():
+    """Forgets what was read from the patch files, in case they changed."""
+    file_reader.read.cache_clear()
+    patch_reader.get_patches.cache_clear()
+    _get_db_name.cache_clear()
+    _get_version_hashes.cache_clear()
+    _get_patch_counts_by_db_name.cache_clear()
+
+def set_checkpoint_stride(stride):
+    global _checkpoint_stride
+    _checkpoint_stride = stride
+
+@contextlib.contextmanager
+def use_database(db_name):
+    """Sends queries to another database until the context exits."""
+    global _db_name_override
+    previous = _db_name_override
+    _db_name_override = db_name
+    try:
+        yield
+    finally:
+        _db_name_override = previous
+
 def connect_repl():
-    db.connect_repl(db_name=_get_db_name(_dev_mode))
+    db.connect_repl(db_name=get_db_name())
+
+def query(text, params=None):
+    return db.query(text, params=params, db_name=get_db_name())
+
+def query_to_json(text, params=None):
+    return db.query_to_json(text, params=params, db_name=get_db_name())
 
-def query(text):
-    return db.query(text, db_name=_get_db_name(_dev_mode))
+def executemany(text, params_list):
+    return db.executemany(text, params_list, db_name=get_db_name())
 
-def query_to_json(text):
-    return db.query_to_json(text, db_name=_get_db_name(_dev_mode))
+def query_rows(text):
+    return db.query_rows(text, db_name=get_db_name())
 
 def query_file(file):
-    return db.query_file(file, db_name=_get_db_name(_dev_mode))
+    return db.query_file(file, db_name=get_db_name())
+
+def query_script(script):
+    return db.query_script(script, db_name=get_db_name())
+
+def copy_to(query, file, options='', setup=None):
+    return db.copy_to(
+        query, file, options=options, setup=setup, db_name=get_db_name())
+
+def run_script(script, single_transaction=True):
+    return db.run_script(
+        script,
+        db_name=get_db_name(),
+        single_transaction=single_transaction)
+
+def create_initial_schema():
+    # In dev mode, this is the database for no patches.
+    db.query(_INITIAL_SCHEMA, db_name=_db_name_override)
+
+def load_baseline(path):
+    """Loads a baseline written by `baseline.write` instead of the initial
+    schema."""
+    # Baselines are `pg_dump` output, which changes session settings such as
+    # the search path, so they're loaded in a psql process of their own.
+    db.run_script(db.include_file(path), db_name=_db_name_override)
+
+def create_database(db_name):
+    db.query('CREATE DATABASE {}'.format(db_name), db_name='postgres')
+
+def drop_database(db_name):
+    db.close(db_name)
+    db.query('DROP DATABASE IF EXISTS {}'.format(db_name), db_name='postgres')
+
+def rename_database(db_name, new_name):
+    db.close(db_name)
+    db.query(
+        'ALTER DATABASE {} RENAME TO {}'.format(db_name, new_name),
+        db_name='postgres')
+
+def database_exists(db_name):
+    """Whether a database named after this one exists."""
+    return db_name in _get_existing_db_names()
+
+def get_template_db_name():
+    """Gets the name of the template database for the current patches, which
+    clones are created from."""
+    patch_count = len(_get_version_hashes()) - 1
+    name = '{}_template_{}'.format(
+        db.get_db_name(), get_version_hash(patch_count))
+    # PostreSQL truncates database names to 63 characters.
+    return name[0:63]
+
+def drop_stale_templates():
+    """Drops template databases for anything but the current patches."""
+    current = get_template_db_name()
+    for name in _get_db_names_with_prefix(db.get_db_name() + '_template_'):
+        if name != current:
+            drop_database(name)
+
+def create_clones(template, prefix, count):
+    """Creates `count` copies of a template database, named `prefix_0`,
+    `prefix_1` and so on, and returns their names."""
+    names = ['{}_{}'.format(prefix, i) for i in range(count)]
+    for name in names:
+        _copy_database(template, name)
+    return names
+
+def drop_clones(prefix):
+    """Drops the copies made by `create_clones` with a prefix, and returns
+    their names. Other databases whose names start with the prefix are left
+    alone."""
+    names = [
+        name for name in _get_db_names_with_prefix(prefix + '_')
+        if _CLONE_SUFFIX_RE.match(name[len(prefix) + 1:])]
+    for name in names:
+        drop_database(name)
+    return names
 
 def rewind_invalid_patches():
     """Unapplies patches that no longer exist by rewinding the database."""
-    if not _db_exists():
-        db_name = _get_db_name(_dev_mode)
-        copy_from = _get_closest_db_name()
-        db.query('CREATE DATABASE {} TEMPLATE {}'.format(db_name, copy_from))
+    global _last_checkpoint
+    existing_names = _get_existing_db_names()
+    db_name = _get_db_name(_dev_mode)
+    if db_name not in existing_names:
+        copy_from = _get_closest_db_name(existing_names)
+        _copy_database(copy_from, db_name)
+        _last_checkpoint = _get_patch_count(copy_from)
+        _mark_used(copy_from)
+    _mark_used(db_name)
 
-def _get_closest_db_name():
-    """Tries to find an existing database to base a new one on.
+def save_checkpoint():
+    """Saves a snapshot of the dev mode database if enough patches have been
+    applied since the last one.
 
-    Drops patches one at a time, starting with the last, until it finds a
-    pre-existing database."""
-    skip = 0
+    Later rewinds can then start from the snapshot instead of replaying
+    those patches."""
+    global _last_checkpoint
+    if (not _dev_mode
+            or _checkpoint_stride is None
+            or _db_name_override is not None):
+        return
     patches = patch_reader.get_patches()
-    while skip <= len(patches):
+    unapplied = patch_reader.get_unapplied_patches()
+    applied_count = len(patches) - len(unapplied)
+    # Snapshots are only meaningful for databases with a prefix of the
+    # patches applied.
+    if unapplied != patches[applied_count:]:
+        return
+    if (applied_count == len(patches)
+            or applied_count - _last_checkpoint < _checkpoint_stride):
+        return
+    name = _get_db_name(_dev_mode, len(patches) - applied_count)
+    _last_checkpoint = applied_count
+    if name in _get_existing_db_names():
+        return
+    try:
+        _copy_database(_get_db_name(_dev_mode), name)
+    except subprocess.CalledProcessError:
+        print('Warning: Could not save snapshot "{}".'.format(name))
+        return
+    _mark_used(name)
+
+def get_snapshot_db_name(patch_count):
+    """Gets the name of the dev mode database with the first `patch_count`
+    current patches applied."""
+    return _get_db_name(True, len(_get_version_hashes()) - 1 - patch_count)
+
+def copy_closest_snapshot(db_name, max_patch_count):
+    """Creates a database from the dev mode database with the most patches
+    applied, out of those with at most `max_patch_count` of the current
+    patches, and returns how many patches it has."""
+    existing_names = _get_existing_db_names()
+    for patch_count in range(max_patch_count, -1, -1):
+        name = get_snapshot_db_name(patch_count)
+        if name in existing_names:
+            _copy_database(name, db_name)
+            _mark_used(name)
+            return patch_count
+    raise Exception('Existing database could not be found.')
+
+def restore_snapshot(name):
+    """Replaces the dev mode database for the current patches with a copy of a
+    snapshot."""
+    db_name = _get_db_name(_dev_mode)
+    drop_database(db_name)
+    _copy_database(name, db_name)
+    _mark_used(name)
+
+def get_snapshots():
+    """Lists the dev mode snapshots of the database, least recently used
+    first."""
+    base_name = db.get_db_name()
+    rows = db.query_to_json(
+        'SELECT datname AS name, '
+                'pg_database_size(oid) AS size, '
+                'shobj_description(oid, \'pg_database\') AS description '
+            'FROM pg_database '
+            'WHERE left(datname, $1) = $2',
+        params=[len(base_name) + 1, base_name + '_'],
+        db_name='postgres')
+    counts = _get_patch_counts_by_db_name()
+    snapshots = []
+    for row in rows or []:
+        if not _SNAPSHOT_SUFFIX_RE.match(row['name'][len(base_name) + 1:]):
+            continue
+        matches = _LAST_USED_COMMENT_RE.match(row['description'] or '')
+        snapshots.append(_Snapshot(
+            row['name'],
+            row['size'],
+            # Snapshots which were never marked count as the oldest.
+            float(matches.group(1)) if matches else 0,
+            counts.get(row['name'])))
+    return sorted(snapshots, key=lambda s: (s.last_used, s.name))
+
+def evict_snapshots(max_bytes=None, max_count=None):
+    """Drops least recently used snapshots until the rest fit in a budget.
+
+    The database for the current patches is never dropped, but it counts
+    towards the budget. Returns the dropped snapshots."""
+    current = _get_db_name(True)
+    snapshots = get_snapshots()
+    total_size = sum(s.size for s in snapshots)
+    count = len(snapshots)
+    evicted = []
+    for snapshot in snapshots:
+        if ((max_bytes is None or total_size <= max_bytes)
+                and (max_count is None or count <= max_count)):
+            break
+        if snapshot.name == current:
+            continue
+        drop_database(snapshot.name)
+        total_size -= snapshot.size
+        count -= 1
+        evicted.append(snapshot)
+    return evicted
+
+def _copy_database(source, destination):
+    # Creating a database from a template fails while anything is connected to
+    # the template, including our own sessions.
+    db.close(source)
+    db.query(
+        'CREATE DATABASE {} TEMPLATE {}'.format(destination, source),
+        db_name='postgres')
+
+def _mark_used(db_name):
+    if not _dev_mode or db_name == db.get_db_name():
+        return
+    db.query(
+        'COMMENT ON DATABASE {} IS \'{}\''.format(
+            db_name, _LAST_USED_COMMENT.format(time.time())),
+        db_name='postgres')
+
+def _get_patch_count(db_name):
+    """Gets the number of patches applied to a dev mode database, based on
+    its name."""
+    return _get_patch_counts_by_db_name().get(db_name, 0)
+
+@functools.lru_cache(maxsize=1)
+def _get_patch_counts_by_db_name():
+    patch_count = len(_get_version_hashes()) - 1
+    return {
+        _get_db_name(True, skip): patch_count - skip
+        for skip in range(patch_count + 1)}
+
+def _get_closest_db_name(existing_names):
+    """Tries to find an existing database to base a new one on.
+
+    Picks the database with the most patches applied out of the databases
+    whose names match a prefix of the current patches."""
+    patch_count = len(_get_version_hashes()) - 1
+    for skip in range(patch_count + 1):
         name = _get_db_name(_dev_mode, skip)
-        if _db_exists(name):
+        if name in existing_names:
             return name
-        skip += 1
     raise Exception('Existing database could not be found.')
 
+def _get_existing_db_names():
+    """Gets the names of the database and all of its dev mode versions in one
+    query."""
+    base_name = db.get_db_name()
+    rows = db.query_to_json(
+        'SELECT datname FROM pg_database '
+            'WHERE datname = $1 OR left(datname, $2) = $3',
+        params=[base_name, len(base_name) + 1, base_name + '_'],
+        db_name='postgres')
+    if rows is None:
+        return set()
+    return {row['datname'] for row in rows}
+
+def _get_db_names_with_prefix(prefix):
+    rows = db.query_to_json(
+        'SELECT datname FROM pg_database '
+            'WHERE left(datname, $1) = $2 '
+            'ORDER BY datname',
+        params=[len(prefix), prefix],
+        db_name='postgres')
+    return [row['datname'] for row in rows or []]
+
 def get_schema():
     schema = db.call_with_params(
         [
             'pg_dump',
-            '--schema-only'
+            '--schema-only',
+            '--exclude-schema={}'.format(PARTITION_SCHEMA)
         ],
-        db_name=_get_db_name(_dev_mode))
+        db_name=get_db_name())
     return _normalize_schema(schema)
 
+def get_schema_fingerprint():
+    """Gets a hash of the current schema computed from the system catalogs.
+
+    This is much cheaper than `get_schema`, but the hash depends on the
+    PostgreSQL version, so it's only useful for detecting that a schema has
+    not changed."""
+    return query(_SCHEMA_FINGERPRINT_QUERY).strip()
+
 def _normalize_schema(schema):
     schema = re.sub(r' +\n', '\n', schema)
     return schema
 
 def get_db_name():
+    if _db_name_override is not None:
+        return _db_name_override
     return _get_db_name(_dev_mode)
 
+def get_version_hash(patch_count):
+    """Gets the version hash of a database with the first `patch_count`
+    patches applied."""
+    return _get_version_hashes()[patch_count]
+
 @functools.lru_cache(maxsize=128)
 def _get_db_name(dev_mode, skip_patches=0):
     if not dev_mode:
@@ -77,31 +573,27 @@ def _get_db_name(dev_mode, skip_patches=0):
     # PostreSQL truncates database names to 63 characters.
     return name[0:63]
 
-# TOD: Should this also take into account the initial schema used to
-# get the database started?
-@functools.lru_cache(maxsize=128)
 def _get_db_version_hash(skip_patches=0):
-    patches = patch_reader.get_patches()
-    assert skip_patches <= len(patches)
-    if skip_patches == len(patches):
+    hashes = _get_version_hashes()
+    assert skip_patches < len(hashes)
+    if skip_patches == len(hashes) - 1:
         return ''
-    use_patches = patches[0:len(patches) - skip_patches]
-    all_patch_content = '\n'.join(p.content for p in use_patches)
-    return _compute_hash(all_patch_content)
+    return hashes[len(hashes) - 1 - skip_patches]
+
+@functools.lru_cache(maxsize=1)
+def _get_version_hashes():
+    """Gets the version hash of the database after each prefix of the patches.
+
+    Entry k is the hash after the first k patches have been applied. Each hash
+    is chained from the previous one and the hash of the next patch, starting
+    from a hash of the initial schema, so the whole table is computed in one
+    pass."""
+    version_hash = _compute_hash(_INITIAL_SCHEMA)
+    hashes = [version_hash]
+    for patch in patch_reader.get_patches():
+        version_hash = _compute_hash(version_hash + patch.hash)
+        hashes.append(version_hash)
+    return tuple(hashes)
 
 def _compute_hash(content):
     return hashlib.sha224(content.encode('utf-8')).hexdigest()
-
-def _db_exists(db_name=None):
-    if db_name is None:
-        db_name = _get_db_name(_dev_mode)
-    rows = db.query_to_json(
-        'SELECT 1 AS exists FROM pg_database WHERE datname=\'{}\''.format(
-            db_name),
-        db_name='postgres')
-    if rows is None or len(rows) == 0:
-        return False
-    assert len(rows) == 1
-    row = rows[0]
-    assert 'exists' in row
-    return row['exists'] == 1
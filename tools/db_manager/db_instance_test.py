@@ -0,0 +1,26 @@
+import unittest
+from unittest import mock
+from tools.db_manager import db_instance
+
+class DropClonesTest(unittest.TestCase):
+
+    def test_drops_only_clones(self):
+        names = [
+            'pod_clone_0',
+            'pod_clone_12',
+            'pod_clone_template',
+            'pod_clone_0_backup',
+        ]
+        with mock.patch.object(
+                db_instance, '_get_db_names_with_prefix',
+                return_value=names) as get_names, mock.patch.object(
+                db_instance, 'drop_database') as drop_database:
+            dropped = db_instance.drop_clones('pod_clone')
+        get_names.assert_called_once_with('pod_clone_')
+        self.assertEqual(dropped, ['pod_clone_0', 'pod_clone_12'])
+        self.assertEqual(
+            drop_database.call_args_list,
+            [mock.call('pod_clone_0'), mock.call('pod_clone_12')])
+
+if __name__ == '__main__':
+    unittest.main()
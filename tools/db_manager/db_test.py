@@ -0,0 +1,33 @@
+import unittest
+from tools.db_manager import db
+from tools.db_manager import sql_lexer
+
+class IncludeFileTest(unittest.TestCase):
+
+    def test_quotes(self):
+        self.assertEqual(
+            db.include_file('/patches/it\'s\\0001.sql'),
+            '\\i \'/patches/it\'\'s\\\\0001.sql\'\n;')
+
+    def test_is_terminated(self):
+        script = db.include_file('/patches/it\'s.sql')
+        statements = sql_lexer.split_statements(script)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(statements[0].end, len(script))
+
+class QueryRowsTest(unittest.TestCase):
+
+    def test_parse_columns(self):
+        self.assertEqual(
+            db.parse_columns(['a|b|integer', 'a|text[]', '']),
+            [('a|b', 'integer'), ('a', 'text[]')])
+
+    def test_rows_script(self):
+        script = db.get_rows_script(
+            'SELECT 1 AS a, 2 AS a;\n', [('a', 'integer'), ('a', 'integer')])
+        self.assertTrue(
+            script.endswith('COPY (\nSELECT 1 AS a, 2 AS a\n) TO STDOUT;'))
+        self.assertNotIn('VIEW', script)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Exports the result of a query as CSV or newline-delimited JSON.
+
+The query is run with `COPY ... TO STDOUT`, and psql's output is written out
+as it arrives, so exports of whole tables take constant memory. The rows are
+formatted by the database itself: CSV with a header line, or one
+`row_to_json` object per line for NDJSON.
+
+A script may be exported too, in which case its last statement is the query
+and the statements before it are run first, in the same transaction."""
+
+import gzip
+import re
+from tools.db_manager import db_instance
+from tools.db_manager import sql_lexer
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+FORMATS = (CSV, NDJSON)
+
+# Faster compression is preferred, so that compressing doesn't limit how fast
+# rows can be exported.
+_GZIP_LEVEL = 1
+
+# NDJSON rows are written in CSV format with a quote character and delimiter
+# that JSON can't contain unescaped, so that nothing is quoted or escaped.
+_COPY_OPTIONS = {
+    CSV: 'WITH (FORMAT csv, HEADER)',
+    NDJSON: 'WITH (FORMAT csv, QUOTE E\'\\x01\', DELIMITER E\'\\x02\')',
+}
+
+def export(script, file, format=CSV, compress=False):
+    """Writes the result of the last statement of a script to a binary file
+    object, optionally compressed with gzip. Returns the number of bytes
+    written, before compression."""
+    if format not in FORMATS:
+        raise Exception('Unknown export format "{}". Expected one of: '
+            '{}'.format(format, ', '.join(FORMATS)))
+    statements = sql_lexer.split_statements(script)
+    if len(statements) == 0:
+        raise Exception('There is no query to export.')
+    query = re.sub(r';\s*$', '', statements[-1].text.strip())
+    setup = script[:statements[-1].start]
+    if format == NDJSON:
+        query = 'SELECT row_to_json(r) FROM (\n{}\n) r'.format(query)
+    if compress:
+        with gzip.GzipFile(
+                fileobj=file, mode='wb', compresslevel=_GZIP_LEVEL) as out:
+            return db_instance.copy_to(
+                query, out, _COPY_OPTIONS[format], setup)
+    return db_instance.copy_to(query, file, _COPY_OPTIONS[format], setup)
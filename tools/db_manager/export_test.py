@@ -0,0 +1,59 @@
+import gzip
+import io
+import unittest
+from unittest import mock
+from tools.db_manager import export
+
+class ExportTest(unittest.TestCase):
+
+    def _export(self, script, output, **kwargs):
+        """Exports a script with `copy_to` writing `output`, and returns what
+        was written and the arguments `copy_to` was called with."""
+        def copy_to(query, file, options, setup):
+            file.write(output)
+            return len(output)
+        file = io.BytesIO()
+        with mock.patch.object(export, 'db_instance') as db_instance:
+            db_instance.copy_to.side_effect = copy_to
+            self.assertEqual(
+                export.export(script, file, **kwargs), len(output))
+        query, _, options, setup = db_instance.copy_to.call_args[0]
+        return file.getvalue(), query, options, setup
+
+    def test_csv(self):
+        _, query, options, setup = self._export(
+            'SET search_path = public;\nSELECT * FROM assets;\n', b'')
+        self.assertEqual(query, 'SELECT * FROM assets')
+        self.assertEqual(options, 'WITH (FORMAT csv, HEADER)')
+        self.assertEqual(setup, 'SET search_path = public;\n')
+
+    def test_ndjson(self):
+        _, query, options, setup = self._export(
+            'SELECT id, \'a;b\' AS name FROM assets', b'', format=export.NDJSON)
+        self.assertEqual(
+            query,
+            'SELECT row_to_json(r) FROM (\n'
+            'SELECT id, \'a;b\' AS name FROM assets\n'
+            ') r')
+        self.assertEqual(setup, '')
+        # JSON escapes every control character in strings, and has none
+        # elsewhere, so neither the quote nor the delimiter can appear in a
+        # row, and rows are written as they are.
+        self.assertIn('QUOTE E\'\\x01\'', options)
+        self.assertIn('DELIMITER E\'\\x02\'', options)
+        self.assertNotIn('HEADER', options)
+
+    def test_compressed(self):
+        output = b'{"id":1}\n{"id":2}\n'
+        written, _, _, _ = self._export(
+            'SELECT 1', output, format=export.NDJSON, compress=True)
+        self.assertEqual(gzip.decompress(written), output)
+
+    def test_errors(self):
+        with self.assertRaisesRegex(Exception, 'Unknown export format'):
+            export.export('SELECT 1', io.BytesIO(), format='xml')
+        with self.assertRaisesRegex(Exception, 'no query'):
+            export.export('-- Nothing.\n', io.BytesIO())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Stands in for `psql` when benchmarking db manager.
+
+Every invocation is recorded in `$FAKE_PSQL_STATE/calls`, along with the number
+of bytes of SQL it was sent. Patch hashes inserted into `db_patches` are
+remembered in `$FAKE_PSQL_STATE/hashes` so that upgrades make progress, and
+just enough other queries are answered for db manager to run. Scripts sent on
+stdin are handled a chunk at a time, with each `\\echo` answered as soon as it
+arrives, so long-lived sessions work too."""
+
+import json
+import os
+import re
+import sys
+
+_HASH_RE = re.compile(r"'\\x([0-9a-f]+)'")
+_INCLUDE_RE = re.compile(r"^\\i '((?:[^'\\]|\\.|'')*)'$", re.MULTILINE)
+_PREPARE_RE = re.compile(
+    r'^PREPARE (\w+) AS\n(.*?)\n;$', re.MULTILINE | re.DOTALL)
+_EXECUTE_RE = re.compile(r'^EXECUTE (\w+)\((.*)\);$', re.MULTILINE)
+_PARAM_RE = re.compile(r"NULL|'(?:[^']|'')*'")
+
+# The result description `copy_format.describe_columns` would produce for
+# `SELECT hash FROM db_patches`.
+_PATCHES_DESCRIPTION = {
+    'columns': [['hash', 17]],
+    'types': [{
+        'oid': 17,
+        'name': 'bytea',
+        'type': 'b',
+        'category': 'U',
+        'element': 0,
+        'base': 0,
+        'attributes': None,
+    }],
+}
+_EMPTY_DESCRIPTION = {'columns': [], 'types': []}
+
+# Statements prepared by the script so far, keyed by name.
+_prepared = dict()
+
+def _state_path(name):
+    return os.path.join(os.environ['FAKE_PSQL_STATE'], name)
+
+def _record(sent, argv):
+    with open(_state_path('calls'), 'at', encoding='utf8') as file:
+        file.write('{}\t{}\n'.format(sent, ' '.join(argv)))
+
+def _read_hashes():
+    try:
+        with open(_state_path('hashes'), 'rt', encoding='utf8') as file:
+            return file.read().split()
+    except FileNotFoundError:
+        return []
+
+def _run(script):
+    """Answers a chunk of a script, returning the number of bytes it sent."""
+    # Files included with `\i` are read like psql would.
+    for matches in _INCLUDE_RE.finditer(script):
+        path = re.sub(
+            r"\\(.)|''", lambda m: m.group(1) or "'", matches.group(1))
+        with open(path, 'rt', encoding='utf8') as file:
+            script += '\n' + file.read()
+    # Prepared statements are run as if their parameters were in the query.
+    for matches in _PREPARE_RE.finditer(script):
+        _prepared[matches.group(1)] = matches.group(2)
+    for matches in _EXECUTE_RE.finditer(script):
+        params = _PARAM_RE.findall(matches.group(2))
+        script += '\n' + re.sub(
+            r'\$(\d+)',
+            lambda m: params[int(m.group(1)) - 1],
+            _prepared[matches.group(1)])
+    if 'INSERT INTO db_patches' in script:
+        with open(_state_path('hashes'), 'at', encoding='utf8') as file:
+            for hash in _HASH_RE.findall(
+                    script[script.index('INSERT INTO db_patches'):]):
+                file.write(hash + '\n')
+    # The dev mode database lookup finds just the base database.
+    matches = re.search(r"FROM pg_database WHERE datname = '([^']+)'", script)
+    if matches:
+        print(json.dumps([{'datname': matches.group(1)}]))
+    if re.search(r'^\\gdesc$', script, re.MULTILINE):
+        if re.search(r'SELECT hash FROM db_patches', script):
+            print('hash|bytea')
+    elif "'columns'" in script and 'json_build_object' in script:
+        if re.search(r'SELECT hash FROM db_patches', script):
+            print(json.dumps(_PATCHES_DESCRIPTION))
+            for hash in _read_hashes():
+                # bytea values are written in hex, with the backslash escaped.
+                print('\\\\x' + hash)
+        else:
+            print(json.dumps(_EMPTY_DESCRIPTION))
+    return len(script.encode('utf8'))
+
+def main(argv):
+    if '-c' in argv:
+        _record(_run(argv[argv.index('-c') + 1]), argv)
+        return
+    if '-f' in argv and argv[argv.index('-f') + 1] != '-':
+        with open(argv[argv.index('-f') + 1], 'rt', encoding='utf8') as file:
+            _record(_run(file.read()), argv)
+        return
+    sent = 0
+    chunk = []
+    for line in sys.stdin:
+        if line.startswith('\\echo '):
+            sent += _run(''.join(chunk))
+            chunk = []
+            sys.stdout.write(line[len('\\echo '):])
+            sys.stdout.flush()
+        else:
+            chunk.append(line)
+    sent += _run(''.join(chunk))
+    _record(sent, argv)
+
+if __name__ == '__main__':
+    main(sys.argv)
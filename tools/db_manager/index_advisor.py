@@ -0,0 +1,255 @@
+"""Reports how tables and indexes are used, and suggests indexes to add.
+
+Usage comes from the statistics views, so it covers the time since the
+statistics were last reset, and should be read from a database that has been
+serving real traffic. Top queries come from `pg_stat_statements`, if it's
+installed.
+
+Indexes are suggested for foreign keys without one, since lookups by the key
+and deletes from the referenced table otherwise scan the whole table, and for
+columns that the top queries filter on in tables that are mostly read by
+sequential scans. The latter are guesses from the query text, so suggestions
+should be checked against the queries' plans before being applied."""
+
+import collections
+import re
+import textwrap
+from tools.db_manager import db_instance
+from tools.db_manager import sql_lexer
+
+Suggestion = collections.namedtuple(
+    'Suggestion',
+    # `columns` are in index order. `reason` says why the index may help.
+    ['table', 'columns', 'reason'])
+
+# Tables with fewer rows than this are cheap to scan, however often they are.
+_MIN_ROWS = 10000
+
+# Bloat is only worth reporting above this fraction of dead rows.
+_MIN_DEAD_FRACTION = 0.2
+
+# The most columns suggested for one index.
+_MAX_INDEX_COLUMNS = 3
+
+_TABLES = '''
+SELECT s.relname AS table_name,
+        s.seq_scan,
+        s.seq_tup_read,
+        coalesce(s.idx_scan, 0) AS idx_scan,
+        s.n_live_tup,
+        s.n_dead_tup,
+        pg_total_relation_size(s.relid) AS size,
+        greatest(s.last_vacuum, s.last_autovacuum) AS last_vacuum
+    FROM pg_stat_user_tables s
+    WHERE s.schemaname = 'public'
+    ORDER BY s.seq_tup_read DESC, s.relname'''
+
+# Indexes that back constraints are needed even if no query uses them.
+_UNUSED_INDEXES = '''
+SELECT s.relname AS table_name,
+        s.indexrelname AS index_name,
+        pg_relation_size(s.indexrelid) AS size
+    FROM pg_stat_user_indexes s
+    JOIN pg_index i ON i.indexrelid = s.indexrelid
+    WHERE s.schemaname = 'public'
+        AND s.idx_scan = 0
+        AND NOT i.indisunique
+        AND NOT EXISTS (
+            SELECT 1 FROM pg_constraint c WHERE c.conindid = s.indexrelid)
+    ORDER BY pg_relation_size(s.indexrelid) DESC, s.indexrelname'''
+
+# The leading columns of each index, as names.
+_INDEXES = '''
+SELECT t.relname AS table_name,
+        ARRAY(
+            SELECT a.attname
+                FROM unnest(string_to_array(i.indkey::text, ' ')::int2[])
+                    WITH ORDINALITY k(attnum, n)
+                JOIN pg_attribute a
+                    ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                ORDER BY k.n) AS columns
+    FROM pg_index i
+    JOIN pg_class t ON t.oid = i.indrelid
+    WHERE t.relnamespace = 'public'::regnamespace'''
+
+_FOREIGN_KEYS = '''
+SELECT t.relname AS table_name,
+        c.conname AS constraint_name,
+        ARRAY(
+            SELECT a.attname
+                FROM unnest(c.conkey) WITH ORDINALITY k(attnum, n)
+                JOIN pg_attribute a
+                    ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+                ORDER BY k.n) AS columns
+    FROM pg_constraint c
+    JOIN pg_class t ON t.oid = c.conrelid
+    WHERE c.contype = 'f'
+        AND c.connamespace = 'public'::regnamespace
+    ORDER BY t.relname, c.conname'''
+
+_COLUMNS = '''
+SELECT t.relname AS table_name, a.attname AS column_name
+    FROM pg_attribute a
+    JOIN pg_class t ON t.oid = a.attrelid
+    WHERE t.relnamespace = 'public'::regnamespace
+        AND t.relkind IN ('r', 'p')
+        AND a.attnum > 0
+        AND NOT a.attisdropped'''
+
+_STATEMENTS = '''
+SELECT query,
+        calls,
+        {total} AS total_ms,
+        {total} / greatest(calls, 1) AS mean_ms,
+        rows
+    FROM pg_stat_statements
+    WHERE dbid = (
+        SELECT oid FROM pg_database WHERE datname = current_database())
+    ORDER BY {total} DESC
+    LIMIT {limit}'''
+
+# Matches a filter on a column, given its name. Equality filters are captured
+# in the first group.
+_FILTER = (
+    r'(?<![\w"])(?:\w+\.)?"?{}"?\s*'
+    r'(?:(=|\bIN\b|\bIS\b|=\s*ANY\b)|<=|>=|<|>|\bBETWEEN\b)')
+
+def get_stats_reset():
+    """Gets when the statistics were last reset, or `None` if they never
+    were."""
+    rows = db_instance.query_to_json(
+        'SELECT stats_reset FROM pg_stat_database '
+            'WHERE datname = current_database()')
+    return rows[0]['stats_reset'] if rows else None
+
+def get_tables():
+    return list(db_instance.query_rows(_TABLES))
+
+def is_scan_heavy(table):
+    """Whether a table is large and mostly read by sequential scans."""
+    return (
+        table['n_live_tup'] >= _MIN_ROWS
+        and table['seq_scan'] > table['idx_scan'])
+
+def is_bloated(table):
+    rows = table['n_live_tup'] + table['n_dead_tup']
+    return (
+        rows >= _MIN_ROWS
+        and table['n_dead_tup'] / rows >= _MIN_DEAD_FRACTION)
+
+def get_unused_indexes():
+    return list(db_instance.query_rows(_UNUSED_INDEXES))
+
+def get_top_statements(limit):
+    """Gets the statements that took the most time in total, or `None` if
+    `pg_stat_statements` isn't installed."""
+    columns = db_instance.query_to_json(
+        'SELECT attname FROM pg_attribute '
+            'WHERE attrelid = to_regclass(\'pg_stat_statements\') '
+                'AND attname IN (\'total_exec_time\', \'total_time\')')
+    if not columns:
+        return None
+    # The column was renamed in PostgreSQL 13.
+    return list(db_instance.query_rows(_STATEMENTS.format(
+        total=columns[0]['attname'],
+        limit=int(limit))))
+
+def suggest_indexes(tables, statements):
+    """Gets `Suggestion`s for the tables and top statements of a report."""
+    indexed = collections.defaultdict(list)
+    for row in db_instance.query_rows(_INDEXES):
+        indexed[row['table_name']].append(row['columns'])
+
+    def is_indexed(table, columns):
+        # An index can be used for a filter on its leading columns, in any
+        # order.
+        return any(
+            set(index[0:len(columns)]) == set(columns)
+            for index in indexed[table])
+
+    suggestions = []
+    for row in db_instance.query_rows(_FOREIGN_KEYS):
+        if not is_indexed(row['table_name'], row['columns']):
+            suggestions.append(Suggestion(
+                row['table_name'],
+                row['columns'],
+                'The foreign key {} has no index, so lookups by it and '
+                'deletes from the table it references scan {}.'.format(
+                    row['constraint_name'], row['table_name'])))
+            indexed[row['table_name']].append(row['columns'])
+
+    columns = collections.defaultdict(list)
+    for row in db_instance.query_rows(_COLUMNS):
+        columns[row['table_name']].append(row['column_name'])
+    for table in tables:
+        if not is_scan_heavy(table):
+            continue
+        name = table['table_name']
+        filtered = _get_filtered_columns(name, columns[name], statements or [])
+        if len(filtered) > 0 and not is_indexed(name, filtered):
+            suggestions.append(Suggestion(
+                name,
+                filtered,
+                '{} is mostly read by sequential scans ({} scans, {} rows '
+                'read), and the top queries filter it on {}.'.format(
+                    name,
+                    table['seq_scan'],
+                    table['seq_tup_read'],
+                    ', '.join(filtered))))
+    return suggestions
+
+def _get_filtered_columns(table, columns, statements):
+    """Guesses which columns of a table to index from the filters of the
+    statements that use it.
+
+    Columns filtered by equality come first, then at most one filtered by a
+    range, since an index can't be used for columns after a range. Columns are
+    ranked by the total time of the statements that filter on them."""
+    equality_time = collections.Counter()
+    range_time = collections.Counter()
+    table_re = re.compile(r'\b{}\b'.format(re.escape(table)), re.IGNORECASE)
+    for statement in statements:
+        query = statement['query']
+        if not table_re.search(query):
+            continue
+        matches = re.search(r'\bWHERE\b(.*)', query, re.IGNORECASE | re.DOTALL)
+        if matches is None:
+            continue
+        for column in columns:
+            for filter in re.finditer(
+                    _FILTER.format(re.escape(column)),
+                    matches.group(1),
+                    re.IGNORECASE):
+                if filter.group(1):
+                    equality_time[column] += statement['total_ms']
+                else:
+                    range_time[column] += statement['total_ms']
+    out = [column for column, _ in equality_time.most_common()]
+    out = out[0:_MAX_INDEX_COLUMNS]
+    ranges = [
+        column for column, _ in range_time.most_common() if column not in out]
+    if len(ranges) > 0 and len(out) < _MAX_INDEX_COLUMNS:
+        out.append(ranges[0])
+    return out
+
+def get_patch(suggestions):
+    """Gets a patch creating the suggested indexes.
+
+    The indexes are built CONCURRENTLY, so that the tables can still be written
+    to while they're built, which means the patch is marked to run outside a
+    transaction."""
+    out = ['-- db_manager: {}'.format(sql_lexer.NO_TRANSACTION), '']
+    for suggestion in suggestions:
+        name = '{}_{}_idx'.format(
+            suggestion.table, '_'.join(suggestion.columns))
+        out.extend(
+            '-- ' + line for line in textwrap.wrap(suggestion.reason, 77))
+        out.append(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS {}\n'
+            '    ON {} ({});'.format(
+                # PostreSQL truncates names to 63 characters.
+                name[0:63],
+                suggestion.table,
+                ', '.join(suggestion.columns)))
+        out.append('')
+    return '\n'.join(out)
@@ -0,0 +1,127 @@
+"""Finds statements that can block other sessions for a long time.
+
+These are statements that rewrite or scan a whole table, or build an index,
+while holding a lock that blocks reads or writes of the table. Statements on
+tables created earlier in the same script are not reported, since nothing else
+can be using those tables yet."""
+
+import collections
+import re
+from tools.db_manager import sql_lexer
+
+BlockingStatement = collections.namedtuple(
+    'BlockingStatement',
+    # `line` is the line of the script the statement starts on.
+    ['statement', 'line', 'reason'])
+
+_NAME = r'(?:"(?:[^"]|"")*"|[^\s(]+)'
+_CREATE_TABLE_RE = re.compile(
+    r'^CREATE (?:UNLOGGED )?TABLE (?:IF NOT EXISTS )?(' + _NAME + r')')
+_ALTER_TABLE_RE = re.compile(
+    r'^ALTER TABLE (?:IF EXISTS )?(?:ONLY )?(' + _NAME + r')')
+_INDEX_TABLE_RE = re.compile(r' ON (?:ONLY )?(' + _NAME + r')')
+
+# Each check is a pattern matched against statements as normalized by
+# `sql_lexer`, and a description of why the statement blocks.
+_CHECKS = [(re.compile(pattern), reason) for pattern, reason in [
+    (
+        r'^ALTER TABLE .*\bALTER (?:COLUMN )?' + _NAME
+            + r' (?:SET DATA )?TYPE\b',
+        'Changing the type of a column rewrites the table while holding an '
+        'ACCESS EXCLUSIVE lock.',
+    ),
+    (
+        r'^ALTER TABLE .*\bADD (?:COLUMN )?(?!CONSTRAINT\b)[^,]*\bDEFAULT\b',
+        'Adding a column with a default rewrites the table while holding an '
+        'ACCESS EXCLUSIVE lock before PostgreSQL 11, and on any version if '
+        'the default is volatile.',
+    ),
+    (
+        r'^ALTER TABLE .*\bADD (?:COLUMN )?[^,]*\bGENERATED ALWAYS AS\b',
+        'Adding a stored generated column rewrites the table while holding an '
+        'ACCESS EXCLUSIVE lock.',
+    ),
+    (
+        r'^ALTER TABLE .*\bSET NOT NULL\b',
+        'Setting NOT NULL scans the table while holding an ACCESS EXCLUSIVE '
+        'lock. Consider adding a NOT VALID check constraint first.',
+    ),
+    (
+        r'^ALTER TABLE .*\bADD (?:CONSTRAINT ' + _NAME
+            + r' )?(?:CHECK|FOREIGN KEY)\b(?!.*\bNOT VALID\b)',
+        'Adding a check or foreign key constraint scans the table while '
+        'holding a lock that blocks writes. Consider adding it NOT VALID and '
+        'validating it in a later patch.',
+    ),
+    (
+        r'^ALTER TABLE .*\bADD (?:CONSTRAINT ' + _NAME
+            + r' )?(?:PRIMARY KEY|UNIQUE|EXCLUDE)\b(?! USING INDEX\b)',
+        'Adding a primary key, unique or exclusion constraint builds an index '
+        'while holding an ACCESS EXCLUSIVE lock. Consider building the index '
+        'CONCURRENTLY first and adding the constraint USING INDEX.',
+    ),
+    (
+        r'^ALTER TABLE .*\bSET (?:UN)?LOGGED\b',
+        'Changing whether a table is logged rewrites it while holding an '
+        'ACCESS EXCLUSIVE lock.',
+    ),
+    (
+        r'^CREATE (?:UNIQUE )?INDEX (?!CONCURRENTLY\b)',
+        'Creating an index without CONCURRENTLY blocks writes to the table '
+        'until the index is built.',
+    ),
+    (
+        r'^REINDEX (?!.*\bCONCURRENTLY\b)',
+        'Reindexing without CONCURRENTLY blocks writes to the table.',
+    ),
+    (
+        r'^(?:CLUSTER\b|VACUUM (?:\(.*)?FULL\b)',
+        'This rewrites the table while holding an ACCESS EXCLUSIVE lock.',
+    ),
+    (
+        r'^REFRESH MATERIALIZED VIEW (?!CONCURRENTLY\b)',
+        'Refreshing a materialized view without CONCURRENTLY blocks reads of '
+        'it.',
+    ),
+    (
+        r'^LOCK\b',
+        'Explicit table locks are held until the end of the transaction.',
+    ),
+    (
+        r'^(?:UPDATE|DELETE FROM) (?!.*\bWHERE\b)',
+        'This locks every row of the table until the end of the transaction.',
+    ),
+]]
+
+def find_blocking_statements(script):
+    """Gets a `BlockingStatement` for each problem found in a script."""
+    out = []
+    created_tables = set()
+    for statement in sql_lexer.split_statements(script):
+        matches = _CREATE_TABLE_RE.match(statement.code)
+        if matches:
+            created_tables.add(_normalize_name(matches.group(1)))
+            continue
+        table = _get_table(statement.code)
+        if table is not None and table in created_tables:
+            continue
+        for check, reason in _CHECKS:
+            if check.search(statement.code):
+                out.append(BlockingStatement(
+                    statement.text,
+                    script.count('\n', 0, statement.start) + 1,
+                    reason))
+    return out
+
+def _get_table(code):
+    matches = _ALTER_TABLE_RE.match(code)
+    if matches is None and code.startswith('CREATE '):
+        matches = _INDEX_TABLE_RE.search(code)
+    if matches is None:
+        return None
+    return _normalize_name(matches.group(1))
+
+def _normalize_name(name):
+    if name.startswith('PUBLIC.'):
+        name = name[len('PUBLIC.'):]
+    return name.strip('"')
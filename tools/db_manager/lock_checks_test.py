@@ -0,0 +1,57 @@
+import unittest
+from tools.db_manager import lock_checks
+
+class FindBlockingStatementsTest(unittest.TestCase):
+
+    def _find(self, script):
+        return [
+            (b.statement, b.line)
+            for b in lock_checks.find_blocking_statements(script)]
+
+    def test_blocking_statements(self):
+        for statement in [
+                'ALTER TABLE a ALTER COLUMN b TYPE bigint;',
+                'ALTER TABLE a ADD COLUMN b int DEFAULT random();',
+                'ALTER TABLE a ALTER b SET NOT NULL;',
+                'ALTER TABLE a ADD CONSTRAINT b CHECK (c > 0);',
+                'ALTER TABLE a ADD PRIMARY KEY (b);',
+                'create index a_b on a (b);',
+                'REINDEX TABLE a;',
+                'VACUUM (VERBOSE, FULL) a;',
+                'REFRESH MATERIALIZED VIEW a;',
+                'LOCK a;',
+                'DELETE FROM a;']:
+            self.assertEqual(
+                self._find(statement), [(statement, 1)], statement)
+
+    def test_safe_statements(self):
+        for statement in [
+                'ALTER TABLE a ADD CONSTRAINT b CHECK (c > 0) NOT VALID;',
+                'ALTER TABLE a ADD CONSTRAINT b PRIMARY KEY USING INDEX c;',
+                'ALTER TABLE a ADD COLUMN b int;',
+                'CREATE INDEX CONCURRENTLY a_b ON a (b);',
+                'REINDEX TABLE CONCURRENTLY a;',
+                'DELETE FROM a WHERE b;',
+                'SELECT \'LOCK a\';']:
+            self.assertEqual(self._find(statement), [], statement)
+
+    def test_tables_created_in_script(self):
+        self.assertEqual(
+            self._find(
+                'CREATE TABLE IF NOT EXISTS "New" (a int);\n'
+                'CREATE INDEX new_a ON public."New" (a);\n'
+                'ALTER TABLE ONLY "New" ALTER a SET NOT NULL;\n'
+                '-- Not created here.\n'
+                'CREATE INDEX old_a ON old (a);\n'),
+            [('-- Not created here.\nCREATE INDEX old_a ON old (a);', 4)])
+
+    def test_function_bodies(self):
+        self.assertEqual(
+            self._find(
+                'CREATE FUNCTION f() RETURNS void AS $$\n'
+                '    DELETE FROM a;\n'
+                '$$ LANGUAGE sql;\n'),
+            [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,22 +3,44 @@
 
 import collections
 from enum import Enum
+import functools
+import hashlib
+import json
 import os
+import random
 import re
+import select
 import shutil
 import subprocess
 import sys
-import tempfile
+import time
+import traceback
+import uuid
+from tools.db_manager import backfill
+from tools.db_manager import baseline
+from tools.db_manager import daemon
 from tools.db_manager import db
 from tools.db_manager import db_instance
+from tools.db_manager import export
 from tools.db_manager import file_reader
+from tools.db_manager import index_advisor
+from tools.db_manager import lock_checks
+from tools.db_manager import partitioning
+from tools.db_manager import patch_history
 from tools.db_manager import patch_reader
+from tools.db_manager import schema_diff
+from tools.db_manager import sql_lexer
 from tools.workspace import workspace
 
 _HOME_DIR = os.path.expanduser('~')
 _WORKSPACE = workspace.get_path()
 _LINE = '--------------------------------------------------'
 
+# Seconds to wait before retrying a patch that could not get its locks in
+# online mode. The wait doubles after each attempt, up to the maximum.
+_ONLINE_BACKOFF = 1
+_ONLINE_MAX_BACKOFF = 60
+
 _SqlUpgrade = collections.namedtuple(
     'SqlUpgrade',
     ['query', 'files', 'hashes', 'followups'])
@@ -31,6 +53,23 @@ _ShellUpgrade = collections.namedtuple(
     'ShellUpgrade',
     ['script', 'files', 'hashes'])
 
+_OnlineSettings = collections.namedtuple(
+    'OnlineSettings',
+    # Timeouts are PostgreSQL intervals such as '5s', or `None` to use the
+    # database's defaults.
+    ['lock_timeout', 'statement_timeout', 'retries'])
+
+# Online mode is for upgrading a database that is serving traffic. Each patch
+# runs in its own transaction with timeouts, so that a patch waiting for a lock
+# doesn't queue up everything else behind it. `None` when disabled.
+_online = None
+
+# If set, upgrades stop once this many patches have been applied.
+_patch_limit = None
+
+# Seconds to wait for more changes to the patches before a watch applies them.
+_WATCH_SETTLE_TIME = 0.1
+
 def _should_continue(prompt):
     cont = input('{} [y/n] '.format(prompt))
     return bool(re.match(r'[yY]', cont))
@@ -40,8 +79,11 @@ def _save_current_db_schema(schema_path):
             'This will override changes to {}, continue?'.format(
                 schema_path)):
         return
+    schema = db_instance.get_schema()
     with open(schema_path, 'wt', encoding='utf8') as schema_file:
-        schema_file.write(db_instance.get_schema())
+        schema_file.write(schema)
+    _save_schema_fingerprint(
+        schema_path, schema, db_instance.get_schema_fingerprint())
 
 def _get_next_upgrade():
     upgrades = list(_get_next_batch_of_upgrades())
@@ -61,15 +103,20 @@ def _get_next_batch_of_upgrades():
     is_first = True
     for upgrade in _get_upgrades():
         if (not isinstance(upgrade, _SqlUpgrade)
-                or _query_must_be_split(upgrade.query + ';')):
+                or _query_must_be_split(upgrade.query)):
             if is_first:
                 yield upgrade
             break
         yield upgrade
         is_first = False
+        if _online is not None:
+            break
 
 def _get_upgrades():
     patches = patch_reader.get_unapplied_patches()
+    if _patch_limit is not None:
+        allowed = set(patch_reader.get_patches()[:_patch_limit])
+        patches = [p for p in patches if p in allowed]
     for patch in patches:
         if patch.type == patch_reader.PatchType.SQL:
             yield _SqlUpgrade(
@@ -132,6 +179,11 @@ def upgrade(schema_path, force=False):
     else:
         while _do_next_batch_upgrade(force):
             pass
+    # Partitions are created ahead of time on every upgrade, as well as on a
+    # schedule, so that databases that are only upgraded still get them.
+    created, _ = partitioning.maintain()
+    for name in created:
+        print('Created partition {}.'.format(name))
     if not force:
         _verify_saved_schema_matches_current_schema(schema_path)
     patch_reader.verify_no_invalid_hashes()
@@ -160,27 +212,324 @@ def _do_next_batch_upgrade(force=False):
             sys.exit(1)
 
     if isinstance(upgrade, _SqlUpgrade):
+        if _online is not None:
+            _warn_about_blocking_statements(upgrade.files)
         if _query_must_be_split(upgrade.query):
-            _db_query(upgrade.query, force)
+            # Statements are committed as they go, so the patch is timed as a
+            # whole.
+            start_time = time.time()
+            if _online is not None:
+                _query_online_split(upgrade)
+            else:
+                _db_query(
+                    upgrade.query,
+                    force or sql_lexer.NO_TRANSACTION
+                        in sql_lexer.get_annotations(upgrade.query))
+            _record_patch_history(upgrade, start_time)
         else:
+            # Each file is followed by the insert of its hash, and the whole
+            # batch is applied in one session as one transaction.
             assert len(upgrade.files) == len(upgrade.followups)
+            script = []
             for i, file in enumerate(upgrade.files):
-                _db_query_file(file, force)
-                _db_query(upgrade.followups[i], force)
+                script.append(patch_history.start_sql())
+                script.append(db.include_file(file))
+                script.append(patch_history.finish_sql(
+                    upgrade.hashes[i],
+                    _format_file_list([file], '')))
+                script.append(upgrade.followups[i])
+            if _online is not None:
+                _run_online('\n'.join(script))
+            else:
+                _db_query_script('\n'.join(script))
     elif isinstance(upgrade, _PythonUpgrade):
+        start_time = time.time()
         _execute_python(upgrade.script)
-        _db_query(
-            'INSERT INTO db_patches (hash) VALUES {};'.format(
-                _format_hashes_for_insert(upgrade.hashes)))
+        _record_applied_patch(upgrade, start_time)
     else:
         assert isinstance(upgrade, _ShellUpgrade)
+        start_time = time.time()
         _execute_shell_script(upgrade.script)
-        _db_query(
-            'INSERT INTO db_patches (hash) VALUES {};'.format(
-                _format_hashes_for_insert(upgrade.hashes)))
+        _record_applied_patch(upgrade, start_time)
 
+    db_instance.save_checkpoint()
     return True
 
+def _get_patch_history_sql(upgrade, start_time):
+    return patch_history.record_sql(
+        upgrade.hashes,
+        [_format_file_list([f], '') for f in upgrade.files],
+        start_time,
+        time.time() - start_time)
+
+def _record_patch_history(upgrade, start_time):
+    _db_query_script(_get_patch_history_sql(upgrade, start_time))
+
+def _record_applied_patch(upgrade, start_time):
+    """Inserts the hashes of a patch that ran outside the database, and records
+    its history, in one transaction, so that neither is saved without the
+    other."""
+    _db_query_script('INSERT INTO db_patches (hash) VALUES {};\n{}'.format(
+        _format_hashes_for_insert(upgrade.hashes),
+        _get_patch_history_sql(upgrade, start_time)))
+
+def _export(query_path, format, output_path, compress):
+    """Exports the result of the query in a file, or on stdin if no file is
+    given, to a file or stdout. Output files ending in `.gz` are compressed."""
+    if query_path:
+        script = file_reader.read(query_path)
+    else:
+        script = sys.stdin.read()
+    if output_path is None or output_path == '-':
+        sys.stdout.flush()
+        export.export(script, sys.stdout.buffer, format, compress)
+        sys.stdout.buffer.flush()
+        return
+    compress = compress or output_path.endswith('.gz')
+    with open(output_path, 'wb') as file:
+        size = export.export(script, file, format, compress)
+    print('Exported {:.1f} MB to {}.'.format(size / 1024 ** 2, output_path),
+        file=sys.stderr)
+
+def _watch():
+    """Re-applies the patches whenever they change.
+
+    Each time, the database is copied from a snapshot with the patches before
+    the first one that has changed since the watch started, and only the
+    patches after that are applied. The snapshot is made when it's first
+    needed, so the first upgrade takes longer than the ones after it."""
+    snapshot_patch_count = None
+    hashes = None
+    for _ in _wait_for_patch_changes():
+        db_instance.clear_caches()
+        new_hashes = [patch.hash for patch in patch_reader.get_patches()]
+        if new_hashes == hashes:
+            continue
+        if hashes is None:
+            # The patch being written is most likely the last one.
+            changed = max(len(new_hashes) - 1, 0)
+        else:
+            changed = 0
+            while (changed < min(len(hashes), len(new_hashes))
+                    and hashes[changed] == new_hashes[changed]):
+                changed += 1
+        hashes = new_hashes
+        if snapshot_patch_count is None or changed < snapshot_patch_count:
+            snapshot_patch_count = changed
+        try:
+            _upgrade_from_snapshot(snapshot_patch_count)
+        except Exception:
+            traceback.print_exc()
+            print('The upgrade failed. Waiting for changes.')
+        sys.stdout.flush()
+
+def _upgrade_from_snapshot(patch_count):
+    start_time = time.time()
+    snapshot = db_instance.get_snapshot_db_name(patch_count)
+    if not db_instance.database_exists(snapshot):
+        print('Saving a snapshot with {} patches applied.'.format(patch_count))
+        db_instance.copy_closest_snapshot(snapshot, patch_count)
+        with db_instance.use_database(snapshot):
+            _upgrade_through(patch_count)
+    if snapshot != db_instance.get_db_name():
+        db_instance.restore_snapshot(snapshot)
+    restore_time = time.time()
+    _upgrade_through()
+    end_time = time.time()
+    print('Applied {} patches in {:.2f}s, after {:.2f}s restoring the '
+        'snapshot.'.format(
+            len(patch_reader.get_patches()) - patch_count,
+            end_time - restore_time,
+            restore_time - start_time))
+
+def _wait_for_patch_changes():
+    """Yields once at first, and then after each batch of changes to the
+    patch directory."""
+    try:
+        process = subprocess.Popen(
+            [
+                'inotifywait',
+                '-m',
+                '-q',
+                '-e', 'close_write',
+                '-e', 'moved_to',
+                '-e', 'delete',
+                '--format', '%f',
+                patch_reader.get_patch_dir(),
+            ],
+            stdout=subprocess.PIPE)
+    except FileNotFoundError:
+        raise Exception(
+            'The watch command needs inotifywait, from inotify-tools.')
+    try:
+        yield
+        for line in process.stdout:
+            file = line.decode('utf8').rstrip('\n')
+            # Editor backups and the patch index don't change the patches.
+            if re.search(r'(\.swp|~)$', file) or file.startswith('.'):
+                continue
+            # Editors may save in several steps, so wait for them to finish.
+            while select.select(
+                    [process.stdout], [], [], _WATCH_SETTLE_TIME)[0]:
+                if not process.stdout.readline():
+                    break
+            yield
+    finally:
+        process.kill()
+        process.wait()
+
+def _serve(socket_path):
+    """Runs commands sent by `client.py` until interrupted."""
+    sources = _get_source_mtimes()
+    try:
+        daemon.serve(
+            socket_path,
+            _run_served_command,
+            lambda: _get_source_mtimes() != sources)
+    except KeyboardInterrupt:
+        pass
+
+def _run_served_command(argv):
+    cwd = os.getcwd()
+    if cwd != _WORKSPACE and not cwd.startswith(_WORKSPACE + '/'):
+        raise Exception('This server is for the workspace "{}".'.format(
+            _WORKSPACE))
+    # Start from the state of a new process, except for what's kept warm.
+    global _online, _patch_limit
+    _online = None
+    _patch_limit = None
+    set_db_backend(db.SESSION_BACKEND)
+    db_instance.set_checkpoint_stride(None)
+    db_instance.clear_caches()
+    main(argv)
+
+def _get_source_mtimes():
+    """Gets the modification times of the code a server runs."""
+    dirs = [os.path.dirname(__file__), os.path.dirname(workspace.__file__)]
+    return {
+        os.path.join(dir, file): os.stat(os.path.join(dir, file)).st_mtime_ns
+        for dir in dirs
+        for file in os.listdir(dir)
+        if file.endswith('.py')}
+
+def _analyze(limit, write):
+    """Prints how tables and indexes are used, and the indexes that may be
+    worth adding. With `write`, the indexes are saved as the next patch."""
+    print('Statistics since {}.'.format(
+        index_advisor.get_stats_reset() or 'the database was created'))
+    tables = index_advisor.get_tables()
+    print('')
+    print('Tables mostly read by sequential scans:')
+    print('{:>10}  {:>14}  {:>10}  {:>12}  {}'.format(
+        'seq scans', 'rows read', 'idx scans', 'live rows', 'table'))
+    for table in filter(index_advisor.is_scan_heavy, tables):
+        print('{:>10}  {:>14}  {:>10}  {:>12}  {}'.format(
+            table['seq_scan'],
+            table['seq_tup_read'],
+            table['idx_scan'],
+            table['n_live_tup'],
+            table['table_name']))
+    print('')
+    print('Tables with many dead rows:')
+    for table in filter(index_advisor.is_bloated, tables):
+        print('{:>10.0%} dead  {:>10}  {}  last vacuumed {}'.format(
+            table['n_dead_tup'] / (table['n_live_tup'] + table['n_dead_tup']),
+            _format_size(table['size']),
+            table['table_name'],
+            table['last_vacuum'] or 'never'))
+    print('')
+    print('Unused indexes:')
+    for index in index_advisor.get_unused_indexes():
+        print('{:>10}  {} on {}'.format(
+            _format_size(index['size']),
+            index['index_name'],
+            index['table_name']))
+    print('')
+    try:
+        statements = index_advisor.get_top_statements(limit)
+    except subprocess.CalledProcessError:
+        # The extension is installed but its library isn't loaded.
+        statements = None
+    if statements is None:
+        print('Top queries are not available without pg_stat_statements.')
+    else:
+        print('Top queries by total time:')
+        print('{:>12}  {:>10}  {:>10}  {}'.format(
+            'total ms', 'calls', 'mean ms', 'query'))
+        for statement in statements:
+            query = ' '.join(statement['query'].split())
+            print('{:>12.0f}  {:>10}  {:>10.2f}  {}'.format(
+                statement['total_ms'],
+                statement['calls'],
+                statement['mean_ms'],
+                query if len(query) <= 100 else query[0:97] + '...'))
+    print('')
+    suggestions = index_advisor.suggest_indexes(tables, statements)
+    if len(suggestions) == 0:
+        print('No indexes to suggest.')
+        return
+    patch = index_advisor.get_patch(suggestions)
+    if not write:
+        print('Suggested patch:')
+        print('')
+        print(patch)
+        return
+    path = os.path.join(
+        patch_reader.get_patch_dir(),
+        '{:04d}.sql'.format(_get_next_patch_number()))
+    with open(path, 'wt', encoding='utf8') as file:
+        file.write(patch)
+    print('Saved the suggested indexes as {}.'.format(path))
+
+def _maintain_partitions(table, detach_after, drop):
+    """Creates the partitions of the coming months and detaches the ones
+    older than `detach_after`, for `table` or every partitioned table. Meant
+    to be run on a schedule."""
+    if drop and detach_after is None:
+        raise Exception('--drop requires --detach_after.')
+    created, detached = partitioning.maintain(table, detach_after, drop)
+    for name in created:
+        print('Created partition {}.'.format(name))
+    for name in detached:
+        print('{} partition {}.'.format(
+            'Dropped' if drop else 'Detached', name))
+    if len(created) == 0 and len(detached) == 0:
+        print('Partitions are up to date.')
+
+def _get_next_patch_number():
+    numbers = [
+        int(re.match(r'\d+', os.path.basename(patch.file_path)).group(0))
+        for patch in patch_reader.get_patches()]
+    return max(numbers, default=0) + 1
+
+def _print_history(limit):
+    if not patch_history.has_table():
+        print('No patch history has been recorded.')
+        return
+    print('Slowest patches:')
+    for row in patch_history.get_slowest_patches(limit):
+        print('{:>10.3f}s  {}  {}  {}'.format(
+            row['seconds'],
+            row['file_name'],
+            row['start_time'].strftime('%Y-%m-%d %H:%M:%S'),
+            row['deploy']))
+        details = []
+        if row['rows_affected'] is not None:
+            details.append('{} rows'.format(row['rows_affected']))
+        if row['locks']:
+            details.append('locks: ' + ', '.join(row['locks']))
+        if details:
+            print('             ' + '; '.join(details))
+    print('')
+    print('Upgrade time per deploy:')
+    for row in patch_history.get_deploys(limit):
+        print('{:>10.3f}s  {}  {}  {} patches in {} runs'.format(
+            row['seconds'],
+            row['start_time'].strftime('%Y-%m-%d %H:%M:%S'),
+            row['deploy'],
+            row['patches'],
+            row['runs']))
+
 def _format_file_list(files, prefix):
     relative_files = []
     if _WORKSPACE[-1] == '/':
@@ -201,72 +550,179 @@ def _verify_saved_schema_matches_current_schema(schema_path):
         print(diff)
 
 def _diff_current_schema_vs_saved_schema(schema_path):
-    saved_schema = file_reader.read(schema_path)
-    current_schema = db_instance.get_schema()
-    if _schemas_equal(current_schema, saved_schema):
+    diff = _get_schema_diff(schema_path)
+    if diff is None:
         return ''
-    with tempfile.NamedTemporaryFile('wt', encoding='utf8') as schema_file:
-        schema_file.write(current_schema)
-        schema_file.flush()
+    return schema_diff.format_diff(diff)
+
+def _get_schema_diff(schema_path):
+    """Compares the current schema to the saved one object by object.
+
+    Returns `None` if they match."""
+    saved_schema = file_reader.read(schema_path)
+    fingerprint = db_instance.get_schema_fingerprint()
+    if _saved_fingerprint_matches(schema_path, saved_schema, fingerprint):
+        return None
+    diff = schema_diff.diff_schemas(saved_schema, db_instance.get_schema())
+    if schema_diff.is_empty(diff):
+        # The fingerprint is only a cache, so it's fine if it can't be saved.
         try:
-            return subprocess.check_output(
-                [
-                    'git',
-                    '--no-pager',
-                    'diff',
-                    '--color',
-                    '--ignore-space-at-eol',
-                    schema_path,
-                    schema_file.name
-                ]).stdout.decode('utf8')
-        # `git diff` has a non-zero exit code when there is a diff, seemingly by
-        # default, at least for me -- even though the docs make it sound like
-        # you need to specify `--exit-code` for this behavior.
-        except subprocess.CalledProcessError as err:
-            return err.output.decode('utf8')
-
-def _schemas_equal(schema_a, schema_b):
-    rep = re.compile(r'\s+')
-    return rep.sub('', schema_a) == rep.sub('', schema_b)
+            _save_schema_fingerprint(schema_path, saved_schema, fingerprint)
+        except OSError:
+            pass
+        return None
+    return diff
 
-def _query_must_be_split(query):
+def _print_schema_diff(schema_path, as_json):
+    diff = _get_schema_diff(schema_path)
+    if as_json:
+        print(schema_diff.diff_to_json(
+            diff if diff is not None else schema_diff.SchemaDiff(
+                [], [], [], [], {}, {})))
+    elif diff is not None:
+        print(schema_diff.format_diff(diff))
+    if diff is not None:
+        sys.exit(1)
+
+def _get_fingerprint_path(schema_path):
+    # The fingerprint is a local cache of the last comparison against this
+    # machine's database, so it isn't checked in (see .gitignore).
+    return schema_path + '.fingerprint'
+
+def _saved_fingerprint_matches(schema_path, schema, fingerprint):
+    """Whether the saved fingerprint matches the current one and was saved for
+    this version of the schema file."""
+    try:
+        with open(
+                _get_fingerprint_path(schema_path),
+                'rt',
+                encoding='utf8') as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return False
     return (
-        re.search(r'ALTER TYPE', query, flags=re.IGNORECASE)
-        and re.search(r'\;(.|\n)*\;', query))
-
-# This is not comprehensive. Any string in the query which contains a semicolon
-# will break the ability to split. This is just common with functions and
-# uncommon with other queries, so this is a close approximation.
-# TODO: To adequately solve this issue we need to be able to appropriately parse
-# PostgreSQL strings or any other expressions which may contain semicolons not
-# used as a line terminator. OR we can just stop using enums, avoiding the need
-# to split queries entirely.
-def _query_cannot_be_split(query):
-    return re.search(r'CREATE (?:OR REPLACE )?FUNCTION', query)
+        saved.get('schema_hash') == _compute_hash(schema)
+        and saved.get('fingerprint') == fingerprint)
+
+def _save_schema_fingerprint(schema_path, schema, fingerprint):
+    _write_file(
+        _get_fingerprint_path(schema_path),
+        json.dumps(
+            {
+                'fingerprint': fingerprint,
+                'schema_hash': _compute_hash(schema),
+            },
+            indent=2,
+            sort_keys=True) + '\n')
+
+def _compute_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def _query_must_be_split(query):
+    if sql_lexer.NO_TRANSACTION in sql_lexer.get_annotations(query):
+        return True
+    return not all(s.transactional for s in sql_lexer.split_statements(query))
+
+def _split_into_transactions(query):
+    """Groups the statements of a query into as few parts as possible.
+
+    Consecutive statements that can run inside a transaction are grouped into
+    one transactional part, and each statement that can't is a part of its own.
+    Returns a list of (text, transactional) tuples."""
+    parts = []
+    for statement in sql_lexer.split_statements(query):
+        if statement.transactional and len(parts) > 0 and parts[-1][1]:
+            parts[-1][0].append(statement.text)
+        else:
+            parts.append(([statement.text], statement.transactional))
+    return [('\n'.join(texts), transactional) for texts, transactional in parts]
 
 def _db_query(query, force=False):
     if _query_must_be_split(query):
-        if _query_cannot_be_split(query):
-            raise Exception(
-                'Query cannot be executed due to the use of both ALTER TYPEs '
-                'and CREATE FUNCTIONs. The best path forward is probably to '
-                'apply ALTER TYPE statements manually and then try to rerun '
-                'the upgrade again without them.')
         if not force:
             if not _should_continue(
-                    'Warning: This query cannot be run as a transaction. '
-                    'Split into multiple queries?'):
+                    'Warning: This query cannot be run as a single '
+                    'transaction. Split into multiple queries?'):
                 sys.exit(0)
         out = []
-        for part in query.split(';'):
-            result = _db_query(part)
+        for part, transactional in _split_into_transactions(query):
+            if transactional:
+                result = _db_query_script(part)
+            else:
+                result = db_instance.query(part)
             if result != '':
                 out.append(result)
         return '\n'.join(out)
     return db_instance.query(query)
 
-def _db_query_file(file, force=False):
-    return db_instance.query_file(file)
+def _db_query_script(script):
+    return db_instance.query_script(script)
+
+def _warn_about_blocking_statements(files):
+    for file in files:
+        for blocking in lock_checks.find_blocking_statements(
+                file_reader.read(file)):
+            print('Warning: {}:{}: {}'.format(
+                _format_file_list([file], ''),
+                blocking.line,
+                blocking.reason))
+            print('    ' + blocking.statement.split('\n')[0])
+
+def _query_online_split(upgrade):
+    """Runs a patch that can't be run as one transaction statement by
+    statement, with each group of statements that can be run in a transaction
+    grouped as usual."""
+    if sql_lexer.NO_TRANSACTION not in sql_lexer.get_annotations(
+            upgrade.query):
+        raise Exception(
+            '{} cannot be run in a single transaction. To apply it statement '
+            'by statement, add a "-- db_manager: {}" comment before its '
+            'first statement.'.format(
+                _format_file_list(upgrade.files, ''),
+                sql_lexer.NO_TRANSACTION))
+    for part, transactional in _split_into_transactions(upgrade.query):
+        _run_online(part, transactional)
+
+def _run_online(script, transactional=True):
+    """Runs a script with the online mode timeouts.
+
+    Transactions that fail because a lock could not be acquired in time are
+    retried with exponential backoff. Statements outside of a transaction are
+    not retried, since they may have partly taken effect (as a failed `CREATE
+    INDEX CONCURRENTLY` does), and they don't get a lock timeout, since the
+    statements that can't run in a transaction are the ones meant to not
+    block."""
+    settings = []
+    # `SET LOCAL` has no effect outside a transaction.
+    set_command = 'SET LOCAL' if transactional else 'SET'
+    if transactional and _online.lock_timeout is not None:
+        settings.append('{} lock_timeout = {};'.format(
+            set_command, _quote_literal(_online.lock_timeout)))
+    if _online.statement_timeout is not None:
+        settings.append('{} statement_timeout = {};'.format(
+            set_command, _quote_literal(_online.statement_timeout)))
+    script = '\n'.join(settings + [script])
+    attempt = 0
+    while True:
+        try:
+            return db_instance.run_script(script, transactional)
+        except db.QueryError as e:
+            if (not transactional
+                    or e.sqlstate not in (
+                        db.LOCK_NOT_AVAILABLE, db.DEADLOCK_DETECTED)
+                    or attempt >= _online.retries):
+                raise
+        # Waits are randomized so that retries don't line up with whatever
+        # holds the lock.
+        delay = min(_ONLINE_BACKOFF * 2 ** attempt, _ONLINE_MAX_BACKOFF)
+        delay *= random.uniform(0.5, 1)
+        attempt += 1
+        print('Could not acquire locks, retrying in {:.1f}s ({} of {}).'.format(
+            delay, attempt, _online.retries))
+        time.sleep(delay)
+
+def _quote_literal(value):
+    return '\'{}\''.format(value.replace('\'', '\'\''))
 
 def _execute_python(script):
     with open(script, 'rb') as file:
@@ -274,6 +730,12 @@ def _execute_python(script):
     exec(code, {
         '__file__': script,
         '__name__': '__main__',
+        'backfill': functools.partial(
+            backfill.backfill,
+            patch=_format_file_list([script], '')),
+        'partition_by_range': functools.partial(
+            partitioning.partition_by_range,
+            patch=_format_file_list([script], '')),
     })
 
 def _execute_shell_script(script):
@@ -312,23 +774,183 @@ def _verify_db_up_to_date(schema_path):
     if exit_with_failure:
         sys.exit(1)
 
-def _init(schema_path, dbname, force=False):
+def _init(schema_path, baseline_path, force=False):
     if not force:
         if not _should_continue(
                 'This will initialize your local database, continue?'):
             return
-    _super_db_query('CREATE DATABASE {};'.format(db.get_db_name()))
-    _super_db_query('ALTER DATABASE {} OWNER TO {}'.format(
-        db.get_db_name(),
-        db.get_db_user()))
-    db.query(
-        'CREATE TABLE db_patches ( '
-            'hash bytea PRIMARY KEY NOT NULL, '
-            'applied_time timestamp with time zone DEFAULT now() NOT NULL '
-                'CHECK (date_part(\'timezone\', applied_time) = 0));')
+    _create_owned_database(db.get_db_name())
+    patch_count = _get_baseline_patch_count(baseline_path)
+    if patch_count is None:
+        db_instance.create_initial_schema()
+    elif db_instance.is_dev_mode():
+        # In dev mode the database itself is the one for no patches, so the
+        # baseline is loaded into the snapshot for the patches it covers.
+        db_instance.create_initial_schema()
+        snapshot = db_instance.get_snapshot_db_name(patch_count)
+        _create_owned_database(snapshot)
+        with db_instance.use_database(snapshot):
+            db_instance.load_baseline(baseline_path)
+    else:
+        db_instance.load_baseline(baseline_path)
     db_instance.rewind_invalid_patches()
     upgrade(schema_path, force)
 
+def _create_owned_database(db_name):
+    _super_db_query('CREATE DATABASE {};'.format(db_name))
+    _super_db_query('ALTER DATABASE {} OWNER TO {}'.format(
+        db_name,
+        db.get_db_user()))
+
+def _get_baseline_patch_count(baseline_path):
+    """Gets the number of patches covered by a usable baseline, or `None` if
+    there is none."""
+    if not os.path.exists(baseline_path):
+        return None
+    patch_count = baseline.read_patch_count(baseline_path)
+    if patch_count is None:
+        print(
+            'Warning: {} is out of date with the patches it covers, so it '
+            'will not be used. Run squash again to update it.'.format(
+                baseline_path))
+    return patch_count
+
+def _get_default_baseline_path():
+    return os.path.join(
+        os.path.dirname(os.path.normpath(patch_reader.get_patch_dir())),
+        'baseline.sql')
+
+def _squash(baseline_path, through, check_only):
+    """Writes a baseline for the first patches, up to and including
+    `through`, or all patches if it's `None`.
+
+    Either way, the baseline is then checked by loading it into one scratch
+    database, replaying the patches it covers into another, and comparing
+    their schema fingerprints and applied patches."""
+    if check_only:
+        if not os.path.exists(baseline_path):
+            raise Exception('There is no baseline at {}.'.format(baseline_path))
+        patch_count = _get_baseline_patch_count(baseline_path)
+        if patch_count is None:
+            sys.exit(1)
+    else:
+        patch_count = _get_patch_count_through(through)
+    replay_db = _get_scratch_db_name('squash_replay')
+    baseline_db = _get_scratch_db_name('squash_baseline')
+    try:
+        print('Replaying {} patches...'.format(patch_count))
+        _build_database(replay_db, patch_count=patch_count)
+        with db_instance.use_database(replay_db):
+            if not check_only:
+                baseline.write(baseline_path, patch_count)
+                print('Wrote {}.'.format(baseline_path))
+            replay_fingerprint = db_instance.get_schema_fingerprint()
+            replay_patches = _get_applied_hashes()
+
+        db_instance.drop_database(baseline_db)
+        db_instance.create_database(baseline_db)
+        with db_instance.use_database(baseline_db):
+            db_instance.load_baseline(baseline_path)
+            baseline_fingerprint = db_instance.get_schema_fingerprint()
+            baseline_patches = _get_applied_hashes()
+    finally:
+        db_instance.drop_database(replay_db)
+        db_instance.drop_database(baseline_db)
+
+    if (baseline_fingerprint != replay_fingerprint
+            or baseline_patches != replay_patches):
+        print('The baseline does not match a replay of its patches.')
+        sys.exit(1)
+    print('The baseline matches a replay of its {} patches.'.format(
+        patch_count))
+
+def _build_database(db_name, baseline_path=None, patch_count=None):
+    """Creates a database and upgrades it, starting from a baseline if one is
+    given and usable. Stops after `patch_count` patches if it's set."""
+    db_instance.drop_database(db_name)
+    db_instance.create_database(db_name)
+    with db_instance.use_database(db_name):
+        if (baseline_path is not None
+                and _get_baseline_patch_count(baseline_path) is not None):
+            db_instance.load_baseline(baseline_path)
+        else:
+            db_instance.create_initial_schema()
+        _upgrade_through(patch_count)
+
+def _upgrade_through(patch_count=None):
+    """Applies patches without asking, stopping after `patch_count` patches if
+    it's set."""
+    global _patch_limit
+    _patch_limit = patch_count
+    try:
+        while _do_next_batch_upgrade(True):
+            pass
+    finally:
+        _patch_limit = None
+
+def _clone(action, count, prefix, baseline_path):
+    # Clones and their templates are for tests, and have no place on a shared
+    # server.
+    if not db.is_host_local():
+        raise Exception(
+            'The clone command is only allowed with a local database.')
+    if action == 'create':
+        if prefix is None:
+            prefix = _get_scratch_db_name(
+                'clone_' + uuid.uuid4().hex[0:8])
+        template = _ensure_template(baseline_path)
+        for name in db_instance.create_clones(template, prefix, count):
+            print(name)
+    elif action == 'drop':
+        if prefix is None:
+            prefix = _get_scratch_db_name('clone')
+        for name in db_instance.drop_clones(prefix):
+            print('Dropped {}'.format(name))
+    else:
+        raise Exception('Invalid clone action: {}\n{}'.format(
+            action,
+            'Expected one of: create, drop'))
+
+def _ensure_template(baseline_path):
+    """Gets the template database for the current patches, building it if it
+    doesn't exist yet."""
+    template = db_instance.get_template_db_name()
+    if db_instance.database_exists(template):
+        return template
+    # The template is built under another name and renamed once it's complete,
+    # so that a partly built template is never cloned.
+    building = _get_scratch_db_name('build_' + uuid.uuid4().hex[0:8])
+    try:
+        _build_database(building, baseline_path)
+        try:
+            db_instance.rename_database(building, template)
+        except subprocess.CalledProcessError:
+            # Another process may have built the template first.
+            if not db_instance.database_exists(template):
+                raise
+    finally:
+        db_instance.drop_database(building)
+    db_instance.drop_stale_templates()
+    return template
+
+def _get_patch_count_through(through):
+    patches = patch_reader.get_patches()
+    if through is None:
+        return len(patches)
+    for i, patch in enumerate(patches):
+        name = os.path.basename(patch.file_path)
+        if through in (name, os.path.splitext(name)[0]):
+            return i + 1
+    raise Exception('Patch "{}" was not found.'.format(through))
+
+def _get_applied_hashes():
+    return {r['hash'] for r in db_instance.query_rows(
+        'SELECT hash FROM db_patches')}
+
+def _get_scratch_db_name(purpose):
+    # PostreSQL truncates database names to 63 characters.
+    return '{}_{}'.format(db.get_db_name(), purpose)[0:63]
+
 def _super_db_query(query):
     return subprocess.check_output(
         [
@@ -339,6 +961,51 @@ def _super_db_query(query):
             '-c', query
         ]).decode('utf8')
 
+def _snapshots(action, max_bytes, max_count):
+    if action == 'list':
+        current = db_instance.get_db_name()
+        for snapshot in db_instance.get_snapshots():
+            print('{}{}  {:>10}  {}  {}'.format(
+                '*' if snapshot.name == current else ' ',
+                snapshot.name,
+                _format_size(snapshot.size),
+                _format_time(snapshot.last_used),
+                'stale' if snapshot.patch_count is None
+                    else '{} patches'.format(snapshot.patch_count)))
+    elif action == 'evict':
+        if max_bytes is None and max_count is None:
+            raise Exception(
+                'Either --snapshot_max_bytes or --snapshot_max_count must be '
+                'provided.')
+        for snapshot in db_instance.evict_snapshots(max_bytes, max_count):
+            print('Dropped {} ({})'.format(
+                snapshot.name, _format_size(snapshot.size)))
+    else:
+        raise Exception('Invalid snapshots action: {}\n{}'.format(
+            action,
+            'Expected one of: list, evict'))
+
+def _format_size(size):
+    units = ['B', 'kB', 'MB', 'GB', 'TB']
+    unit = 0
+    while size >= 1024 and unit < len(units) - 1:
+        size /= 1024
+        unit += 1
+    return '{:.1f} {}'.format(size, units[unit])
+
+def _format_time(timestamp):
+    if timestamp == 0:
+        return 'never used'.ljust(19)
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+def _parse_size(value):
+    """Parses a byte count, which may have a k, M, G or T suffix."""
+    matches = re.search(r'^(\d+)([kKmMgGtT]?)B?$', value)
+    if matches is None:
+        raise Exception('Invalid size "{}".'.format(value))
+    exponent = ' KMGT'.index(matches.group(2).upper() or ' ')
+    return int(matches.group(1)) * 1024 ** exponent
+
 def _has_arg(argv, arg):
     for u in argv[1:]:
         if u == arg:
@@ -351,29 +1018,94 @@ def _get_command_from_args(argv):
             return u
     return ''
 
+def _get_subcommand_from_args(argv):
+    commands = [u for u in argv[1:] if u[0:1] != '-']
+    return commands[1] if len(commands) > 1 else ''
+
 def set_patch_dir(dir):
     patch_reader.set_patch_dir(dir)
 
 def set_config_files(files):
     db_instance.set_config_files(files)
 
+def set_db_backend(backend):
+    db_instance.set_backend(backend)
+
+def set_online_mode(lock_timeout='5s', statement_timeout=None, retries=5):
+    global _online
+    _online = _OnlineSettings(lock_timeout, statement_timeout, retries)
+
 def main(argv):
     schema_path = None
+    snapshot_max_bytes = None
+    snapshot_max_count = None
+    limit = 10
+    baseline_path = None
+    through = None
+    clone_count = 1
+    clone_prefix = None
+    export_format = export.CSV
+    export_path = None
+    socket_path = None
+    detach_after = None
+    online_settings = dict()
 
-    for arg in sys.argv[1:]:
-        matches = re.search(r'^--(db_config|patches|schema)\=(.*)$', arg)
+    for arg in argv[1:]:
+        matches = re.search(
+            r'^--(db_config|db_backend|patches|schema|snapshot_max_bytes'
+                r'|snapshot_max_count|snapshot_stride|limit|lock_timeout'
+                r'|statement_timeout|lock_retries|baseline|through|count'
+                r'|name|format|output|socket|detach_after)\=(.*)$',
+            arg)
         if matches:
             if matches.group(1) == 'db_config':
                 set_config_files(matches.group(2).split(','))
+            elif matches.group(1) == 'db_backend':
+                set_db_backend(matches.group(2))
             elif matches.group(1) == 'patches':
                 set_patch_dir(matches.group(2))
             elif matches.group(1) == 'schema':
                 schema_path = matches.group(2)
+            elif matches.group(1) == 'snapshot_max_bytes':
+                snapshot_max_bytes = _parse_size(matches.group(2))
+            elif matches.group(1) == 'snapshot_max_count':
+                snapshot_max_count = int(matches.group(2))
+            elif matches.group(1) == 'snapshot_stride':
+                db_instance.set_checkpoint_stride(int(matches.group(2)))
+            elif matches.group(1) == 'limit':
+                limit = int(matches.group(2))
+            elif matches.group(1) == 'lock_timeout':
+                online_settings['lock_timeout'] = matches.group(2)
+            elif matches.group(1) == 'statement_timeout':
+                online_settings['statement_timeout'] = matches.group(2)
+            elif matches.group(1) == 'lock_retries':
+                online_settings['retries'] = int(matches.group(2))
+            elif matches.group(1) == 'baseline':
+                baseline_path = matches.group(2)
+            elif matches.group(1) == 'through':
+                through = matches.group(2)
+            elif matches.group(1) == 'count':
+                clone_count = int(matches.group(2))
+            elif matches.group(1) == 'name':
+                clone_prefix = matches.group(2)
+            elif matches.group(1) == 'format':
+                export_format = matches.group(2)
+            elif matches.group(1) == 'output':
+                export_path = matches.group(2)
+            elif matches.group(1) == 'socket':
+                socket_path = matches.group(2)
+            elif matches.group(1) == 'detach_after':
+                detach_after = matches.group(2)
             else:
                 raise Exception('Unknown param "{}"'.format(matches.group(1)))
 
     command = _get_command_from_args(argv)
     force = _has_arg(argv, '-y')
+    if _has_arg(argv, '--online'):
+        set_online_mode(**online_settings)
+    elif len(online_settings) > 0:
+        raise Exception(
+            'Timeouts and retries can only be set with --online.')
     dev_mode = _has_arg(argv, '--dev_mode')
     db_instance.set_dev_mode(dev_mode)
     dev_mode_allowed = _has_arg(argv, '--WARNING__permit_data_loss')
@@ -383,12 +1115,19 @@ def main(argv):
             raise Exception(
                 'In order to use dev_mode, you must pass the parameter '
                 '--WARNING__permit_data_loss.')
-        db_instance.rewind_invalid_patches()
+        if command not in ('snapshots', 'squash', 'clone', 'serve', 'watch'):
+            db_instance.rewind_invalid_patches()
+            if snapshot_max_bytes is not None or snapshot_max_count is not None:
+                db_instance.evict_snapshots(
+                    snapshot_max_bytes, snapshot_max_count)
+
+    if baseline_path is None and command in ('init', 'squash', 'clone'):
+        baseline_path = _get_default_baseline_path()
 
     if command == 'init':
         if schema_path is None:
             raise Exception('Schema path was not provided.')
-        _init(schema_path, force)
+        _init(schema_path, baseline_path, force)
     elif command == 'upgrade':
         if schema_path is None:
             raise Exception('Schema path was not provided.')
@@ -410,6 +1149,10 @@ def main(argv):
         if schema_path is None:
             raise Exception('Schema path was not provided.')
         _save_current_db_schema(schema_path)
+    elif command == 'diff_schema':
+        if schema_path is None:
+            raise Exception('Schema path was not provided.')
+        _print_schema_diff(schema_path, _has_arg(argv, '--json'))
     elif command == 'verify':
         if schema_path is None:
             raise Exception('Schema path was not provided.')
@@ -422,12 +1165,51 @@ def main(argv):
         print(db_instance.query(sys.stdin.read()))
     elif command == 'query_file':
         print(db_instance.query_file(argv[-1]))
+    elif command == 'export':
+        _export(
+            _get_subcommand_from_args(argv),
+            export_format,
+            export_path,
+            _has_arg(argv, '--gzip'))
+    elif command == 'squash':
+        _squash(baseline_path, through, _has_arg(argv, '--check'))
+    elif command == 'clone':
+        _clone(
+            _get_subcommand_from_args(argv),
+            clone_count,
+            clone_prefix,
+            baseline_path)
+    elif command == 'serve':
+        if socket_path is None:
+            raise Exception('Socket path was not provided.')
+        _serve(socket_path)
+    elif command == 'analyze':
+        _analyze(limit, _has_arg(argv, '--write'))
+    elif command == 'history':
+        _print_history(limit)
+    elif command == 'partitions':
+        _maintain_partitions(
+            _get_subcommand_from_args(argv) or None,
+            detach_after,
+            _has_arg(argv, '--drop'))
+    elif command == 'watch':
+        if not dev_mode:
+            raise Exception('The watch command requires --dev_mode.')
+        _watch()
+    elif command == 'snapshots':
+        if not dev_mode:
+            raise Exception('The snapshots command requires --dev_mode.')
+        _snapshots(
+            _get_subcommand_from_args(argv),
+            snapshot_max_bytes,
+            snapshot_max_count)
     else:
         raise Exception('Invalid command: {}\n{}'.format(
             command,
             'Expected one of: verify, upgrade, show_upgrade, '
-            'show_current_schema, save_current_schema, database_name, '
-            'connect, query, query_file'))
+            'show_current_schema, save_current_schema, diff_schema, '
+            'database_name, connect, query, query_file, export, analyze, '
+            'history, partitions, squash, clone, serve, watch, snapshots'))
 
 if __name__ == '__main__':
     main(sys.argv)
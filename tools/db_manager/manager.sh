@@ -2,4 +2,4 @@
 set -e -o pipefail
 workspace=$(pwd)
 
-PYTHONPATH="$workspace" "$workspace/tools/db_manager/manager.py" $@
+PYTHONPATH="$workspace" "$workspace/tools/db_manager/manager.py" "$@"
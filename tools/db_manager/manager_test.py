@@ -0,0 +1,151 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from tools.db_manager import db
+from tools.db_manager import manager
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# Stands in for a script that maintain.sh runs, and saves the arguments it
+# was given.
+_RECORDER = '''#!{python}
+import json
+import sys
+with open({path!r}, 'a') as file:
+    file.write(json.dumps(sys.argv) + '\\n')
+'''
+
+class MaintainShTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workspace)
+        self.calls_path = os.path.join(self.workspace, 'calls')
+        for path in [
+                'tools/db_manager/manager.sh',
+                'glaze_db/DEPLOY/maintain.sh']:
+            self._copy(path)
+        for path in [
+                'tools/db_manager/manager.py',
+                'glaze_db/scripts/prune_tables.py']:
+            self._write_recorder(path)
+
+    def _copy(self, path):
+        destination = os.path.join(self.workspace, path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copy2(os.path.join(_ROOT, path), destination)
+
+    def _write_recorder(self, path):
+        destination = os.path.join(self.workspace, path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, 'w') as file:
+            file.write(_RECORDER.format(
+                python=sys.executable, path=self.calls_path))
+        os.chmod(destination, 0o755)
+
+    def _run_maintain(self, env):
+        subprocess.check_call(
+            ['bash', 'glaze_db/DEPLOY/maintain.sh'],
+            cwd=self.workspace,
+            env=dict(os.environ, DB_CONFIG='a.json', DB_USER_CONFIG='b.json',
+                **env))
+        with open(self.calls_path) as file:
+            return [json.loads(line) for line in file]
+
+    def _run_manager(self, argv):
+        previous = db._config_info_paths
+        self.addCleanup(db.set_config_files, previous)
+        with mock.patch.object(manager, '_maintain_partitions') as maintain:
+            manager.main(argv)
+        return maintain.call_args
+
+    def test_retention_with_spaces(self):
+        manager_argv, prune_argv = self._run_maintain({})
+        self.assertEqual(manager_argv[1:], [
+            '--db_config=a.json,b.json',
+            'partitions',
+            '--detach_after=90 days',
+            '--drop',
+        ])
+        self.assertEqual(
+            self._run_manager(manager_argv),
+            mock.call(None, '90 days', True))
+        self.assertEqual(prune_argv[1:], [
+            '--db_config=a.json,b.json',
+            '--metrics=-',
+        ])
+
+    def test_retention_from_environment(self):
+        manager_argv, _ = self._run_maintain({'LOG_RETENTION': '6 months'})
+        self.assertEqual(
+            self._run_manager(manager_argv),
+            mock.call(None, '6 months', True))
+
+class MaintainPartitionsTest(unittest.TestCase):
+
+    def test_rejects_retention_without_unit(self):
+        with mock.patch.object(manager.partitioning, 'db_instance') as db_:
+            with self.assertRaisesRegex(Exception, 'no unit'):
+                manager._maintain_partitions(None, '90', True)
+            db_.query.assert_not_called()
+
+    def test_rejects_short_retention(self):
+        with mock.patch.object(manager.partitioning, 'db_instance') as db_:
+            db_.query.return_value = 'f\n'
+            with self.assertRaisesRegex(Exception, 'shorter than'):
+                manager._maintain_partitions(None, '90 seconds', True)
+            self.assertEqual(db_.query.call_count, 1)
+
+class CloneTest(unittest.TestCase):
+
+    def test_requires_local_database(self):
+        with mock.patch.object(manager.db, 'is_host_local', return_value=False):
+            with mock.patch.object(manager, 'db_instance') as db_instance:
+                for action in ['create', 'drop']:
+                    with self.assertRaisesRegex(Exception, 'local database'):
+                        manager._clone(action, 1, 'pod_clone', None)
+                self.assertEqual(db_instance.mock_calls, [])
+
+class QueryMustBeSplitTest(unittest.TestCase):
+
+    def test_annotation(self):
+        self.assertTrue(manager._query_must_be_split(
+            '-- db_manager: no_transaction\nSELECT 1;'))
+        self.assertFalse(manager._query_must_be_split(
+            'SELECT 1;\n-- db_manager: no_transaction\n'))
+        self.assertFalse(manager._query_must_be_split(
+            'SELECT $$\n-- db_manager: no_transaction\n$$;'))
+
+    def test_non_transactional_statement(self):
+        self.assertTrue(manager._query_must_be_split(
+            'SELECT 1;\nCREATE INDEX CONCURRENTLY a ON b (c);'))
+
+class PythonUpgradeTest(unittest.TestCase):
+
+    def test_bookkeeping_is_one_script(self):
+        script = os.path.join(manager._WORKSPACE, 'patches', '0057.py')
+        upgrade = manager._PythonUpgrade(script, [script], ['ab', 'cd'])
+        with mock.patch.object(
+                manager, '_get_next_upgrade', return_value=upgrade), \
+                mock.patch.object(manager, '_execute_python'), \
+                mock.patch.object(manager, 'db_instance') as db_instance:
+            self.assertTrue(manager._do_next_batch_upgrade(True))
+        self.assertEqual(db_instance.executemany.call_count, 0)
+        self.assertEqual(db_instance.query.call_count, 0)
+        self.assertEqual(db_instance.query_script.call_count, 1)
+        script = db_instance.query_script.call_args[0][0]
+        self.assertIn(
+            'INSERT INTO db_patches (hash) VALUES \n'
+                '    (\'\\xab\'),\n'
+                '    (\'\\xcd\');',
+            script)
+        self.assertIn('INSERT INTO db_patch_history', script)
+
+if __name__ == '__main__':
+    unittest.main()
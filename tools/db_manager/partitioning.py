@@ -0,0 +1,510 @@
+"""Converts tables to tables partitioned by month, and keeps their partitions.
+
+Python patches get `partition_by_range` as a global. For example:
+
+    partition_by_range('event_logs', 'creation_time')
+
+converts `event_logs` while it's still being written to. A copy of the table
+partitioned by range of `creation_time` is created with the same columns,
+defaults, indexes and foreign keys, and a partition for each month with rows
+in the table and the next few months. Rows are copied to it in batches ordered
+by `key`, with a checkpoint saved like `backfill` does, so an interrupted
+conversion picks up where it left off. Once the copy has caught up, the table
+is locked against writes, the rows written since are copied, and the copy
+replaces the table, all in one transaction.
+
+Rows are only copied in batches once they're older than `_SETTLE_TIME`, so that
+rows whose keys were assigned by transactions that haven't committed yet
+aren't skipped. This assumes no transaction writing to the table runs longer.
+
+Partitions are created in the `partitions` schema, which is left out of saved
+schemas, since which partitions a database has depends on when it was built.
+`maintain` creates partitions for the months ahead, and detaches the ones past
+a retention, so that old rows are dropped a partition at a time. It runs after
+every upgrade and on a schedule, from `glaze_db/DEPLOY/cronjob.yaml`. Each
+table also has a default partition, so that rows are still accepted if
+maintenance falls behind; `maintain` moves them to their month's partition
+when it creates it.
+
+Default partitions, and indexes and foreign keys on partitioned tables, need
+PostgreSQL 11 or later, which `partition_by_range` checks before it starts."""
+
+import datetime
+import random
+import re
+import time
+from tools.db_manager import backfill
+from tools.db_manager import db
+from tools.db_manager import db_instance
+
+_SCHEMA = db_instance.PARTITION_SCHEMA
+
+# The oldest `server_version_num` that can partition a table.
+_MIN_SERVER_VERSION = 110000
+
+# Partitions are created this many months ahead.
+_FUTURE_PARTITIONS = 3
+
+# How long to wait before copying a row. Longer than any transaction that
+# inserts into a table being converted should take.
+_SETTLE_TIME = '5 minutes'
+
+# The shortest retention `maintain` accepts, so that a mistyped one can't
+# detach the partitions of recent months.
+_MIN_RETENTION = '1 month'
+
+# Statements that lock a partitioned table give up after this long, so that
+# writes don't queue up behind them, and are retried after a wait that doubles
+# each time, up to the maximum.
+_LOCK_TIMEOUT = '5s'
+_LOCK_RETRIES = 10
+_LOCK_BACKOFF = 1
+_LOCK_MAX_BACKOFF = 60
+
+# Copies one batch and saves the checkpoint in the same statement, so both
+# commit together. Prints the number of keys in the batch, the number of rows
+# copied and the last key. `$1` is the name of the checkpoint, `$2` the last
+# key that has settled, and `$3` the last key of the batch before. The range
+# of a batch includes every row with its last key, so `key` needn't be unique.
+_COPY_BATCH = '''
+WITH batch AS (
+    SELECT {key} AS copy_key FROM {table}
+        WHERE {after}{key} <= $2
+        ORDER BY {key}
+        LIMIT {batch_size}),
+copied AS (
+    INSERT INTO {copy}
+        SELECT * FROM {table}
+            WHERE {after}{key} <= (SELECT max(copy_key) FROM batch)
+        RETURNING 1),
+checkpoint AS (
+    INSERT INTO db_backfills AS b (name, last_key, rows_updated, updated_time)
+        SELECT $1::text, max(copy_key)::text,
+                (SELECT count(*) FROM copied), now()
+            FROM batch
+            HAVING count(*) > 0
+        ON CONFLICT (name) DO UPDATE SET
+            last_key = EXCLUDED.last_key,
+            rows_updated = b.rows_updated + EXCLUDED.rows_updated,
+            updated_time = EXCLUDED.updated_time)
+SELECT count(*), (SELECT count(*) FROM copied), max(copy_key)::text
+    FROM batch'''
+
+# The indexes of a table, with the names of their columns in order.
+_INDEXES = '''
+SELECT c.relname AS index_name,
+        pg_get_indexdef(i.indexrelid) AS definition,
+        i.indisprimary AS is_primary,
+        i.indisunique AS is_unique,
+        ARRAY(
+            SELECT a.attname
+                FROM unnest(string_to_array(i.indkey::text, ' ')::int2[])
+                    WITH ORDINALITY k(attnum, n)
+                JOIN pg_attribute a
+                    ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                ORDER BY k.n) AS columns
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = $1::regclass
+    ORDER BY c.relname'''
+
+_CREATE_INDEX_RE = re.compile(r'^CREATE INDEX \S+ ON (?:ONLY )?\S+ (USING .*)$')
+
+# Seconds between progress reports.
+_PROGRESS_INTERVAL = 10
+
+def partition_by_range(
+        table,
+        column,
+        key='id',
+        batch_size=1000,
+        rows_per_second=None,
+        patch=None):
+    """Converts `table` to a table partitioned by month of `column`, copying
+    its rows in batches of `batch_size` ordered by `key`.
+
+    `rows_per_second` limits how fast rows are copied. The checkpoint is saved
+    under the table name, qualified by the patch the conversion is run
+    from."""
+    _check_server_version()
+    if _is_partitioned(table):
+        print('{} is already partitioned.'.format(table))
+        return
+    name = 'partition {}'.format(table)
+    if patch is not None:
+        name = '{}:{}'.format(patch, name)
+    copy = table + '_partitioned'
+    backfill.create_checkpoint_table()
+    if not _exists(copy):
+        _create_copy(table, column, copy)
+    bounds = db_instance.query_to_json(
+        'SELECT to_char(min({}) AT TIME ZONE \'UTC\', \'YYYYMM\') AS first '
+            'FROM {}'.format(column, table))[0]
+    this_month = _get_this_month()
+    _create_partitions(
+        copy,
+        column,
+        min(_parse_month(bounds['first'] or this_month.strftime('%Y%m')),
+            this_month),
+        _add_months(this_month, _FUTURE_PARTITIONS),
+        # Partitions are named after the table they'll belong to.
+        table)
+    last_key, rows_copied, _ = backfill.get_checkpoint(name)
+    if last_key is not None:
+        print('Resuming the copy of {} after {} = {}.'.format(
+            table, key, last_key))
+
+    start = time.time()
+    last_report = start
+    while True:
+        # Each pass copies up to the last key that has settled. Rows written
+        # during a pass are copied by the next one, until a pass has little
+        # left to copy.
+        settled = db_instance.query(
+            'SELECT max({})::text FROM {} '
+                'WHERE {} < now() - $1::interval'.format(key, table, column),
+            [_SETTLE_TIME]).strip()
+        if settled == '':
+            break
+        copied_this_pass = 0
+        while True:
+            batch_start = time.time()
+            after = ''
+            params = [name, settled]
+            if last_key is not None:
+                after = '{} > $3 AND '.format(key)
+                params.append(last_key)
+            count, copied, batch_last_key = db_instance.query(
+                _COPY_BATCH.format(
+                    key=key,
+                    table=table,
+                    copy=copy,
+                    after=after,
+                    batch_size=int(batch_size)),
+                params).strip().split('|')
+            if int(count) == 0:
+                break
+            last_key = batch_last_key
+            copied_this_pass += int(copied)
+            rows_copied += int(copied)
+
+            now = time.time()
+            if now - last_report >= _PROGRESS_INTERVAL:
+                last_report = now
+                print('Copying {}: {} rows copied, at {} {} of {}.'.format(
+                    table, rows_copied, key, last_key, settled))
+            if int(count) < batch_size:
+                break
+            if rows_per_second is not None:
+                time.sleep(max(
+                    0, int(copied) / rows_per_second - (now - batch_start)))
+        if copied_this_pass < batch_size:
+            break
+
+    _swap(table, key, copy, last_key)
+    backfill.mark_done(name)
+    print('Partitioned {}: {} rows copied in {:.1f}s.'.format(
+        table, rows_copied, time.time() - start))
+
+def maintain(table=None, detach_after=None, drop=False):
+    """Creates the partitions of the coming months for `table`, or for every
+    partitioned table, and returns the names of the partitions that were
+    created and detached.
+
+    With `detach_after`, an interval, partitions whose rows are all older than
+    that are detached, and with `drop` they're also dropped. It must have a
+    unit and be at least `_MIN_RETENTION`, which is checked before anything is
+    changed."""
+    if detach_after is not None:
+        _check_retention(detach_after)
+    if table is None:
+        tables = get_partitioned_tables()
+    elif _is_partitioned(table):
+        tables = [table]
+    else:
+        raise Exception('{} is not partitioned.'.format(table))
+    created = []
+    detached = []
+    if len(tables) == 0:
+        return created, detached
+    this_month = _get_this_month()
+    for table in tables:
+        created.extend(_create_partitions(
+            table,
+            _get_partition_column(table),
+            this_month,
+            _add_months(this_month, _FUTURE_PARTITIONS)))
+        if detach_after is None:
+            continue
+        # Partitions of months before the one the cutoff falls in.
+        cutoff = db_instance.query(
+            'SELECT to_char((now() - $1::interval) AT TIME ZONE \'UTC\', '
+                '\'YYYYMM\')',
+            [detach_after]).strip()
+        for name, month in get_partitions(table):
+            if month.strftime('%Y%m') >= cutoff:
+                continue
+            script = 'ALTER TABLE {} DETACH PARTITION {}.{};'.format(
+                table, _SCHEMA, name)
+            if drop:
+                script += '\nDROP TABLE {}.{};'.format(_SCHEMA, name)
+            _run_with_lock_retries(script)
+            detached.append(name)
+    return created, detached
+
+def _check_server_version():
+    version = int(db_instance.query('SHOW server_version_num').strip())
+    if version < _MIN_SERVER_VERSION:
+        raise Exception(
+            'Partitioning needs PostgreSQL {}.{} or later, but the server '
+            'is version {}.{}.'.format(
+                _MIN_SERVER_VERSION // 10000,
+                _MIN_SERVER_VERSION % 10000,
+                version // 10000,
+                version % 10000))
+
+def _check_retention(detach_after):
+    # PostgreSQL reads a number without a unit as seconds.
+    if not re.search(r'[a-zA-Z]', detach_after):
+        raise Exception(
+            'The retention "{}" has no unit, as in "90 days".'.format(
+                detach_after))
+    is_long_enough = db_instance.query(
+        'SELECT $1::interval >= $2::interval',
+        [detach_after, _MIN_RETENTION]).strip()
+    if is_long_enough != 't':
+        raise Exception('The retention "{}" is shorter than {}.'.format(
+            detach_after, _MIN_RETENTION))
+
+def get_partitioned_tables():
+    rows = db_instance.query_to_json(
+        'SELECT relname FROM pg_class '
+            'WHERE relnamespace = \'public\'::regnamespace '
+                'AND relkind = \'p\' '
+            'ORDER BY relname')
+    return [row['relname'] for row in rows or []]
+
+def get_partitions(table):
+    """Gets the name and month of each partition of a table created by
+    `partition_by_range` or `maintain`, in order."""
+    return _get_partitions(table, table)
+
+def _get_partitions(parent, name):
+    rows = db_instance.query_to_json(
+        'SELECT c.relname FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = $1::regclass '
+                'AND c.relnamespace = $2::regnamespace '
+            'ORDER BY c.relname',
+        [parent, _SCHEMA])
+    partitions = []
+    for row in rows or []:
+        matches = re.match(
+            r'^{}_p(\d{{6}})$'.format(re.escape(name)), row['relname'])
+        if matches:
+            partitions.append((row['relname'], _parse_month(matches.group(1))))
+    return partitions
+
+def _create_copy(table, column, copy):
+    """Creates an empty partitioned copy of a table. Indexes are given
+    temporary names, which `_swap` changes to those of the table's
+    indexes."""
+    statements = [
+        'CREATE SCHEMA IF NOT EXISTS {};'.format(_SCHEMA),
+        'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS '
+            'INCLUDING STORAGE INCLUDING COMMENTS)\n'
+            '    PARTITION BY RANGE ({});'.format(copy, table, column),
+    ]
+    for index in _get_indexes(table):
+        if index['is_primary']:
+            # Unique keys of a partitioned table must include the column it's
+            # partitioned by.
+            columns = index['columns']
+            if column not in columns:
+                columns = columns + [column]
+            statements.append(
+                'ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY ({});'.format(
+                    copy, _get_temporary_name(index), ', '.join(columns)))
+        elif index['is_unique']:
+            raise Exception(
+                'The unique index {} can\'t be copied to a partitioned '
+                'table.'.format(index['index_name']))
+        else:
+            matches = _CREATE_INDEX_RE.match(index['definition'])
+            if matches is None:
+                raise Exception('Unexpected index definition "{}".'.format(
+                    index['definition']))
+            statements.append('CREATE INDEX {} ON {} {};'.format(
+                _get_temporary_name(index), copy, matches.group(1)))
+    references = db_instance.query_to_json(
+        'SELECT conname FROM pg_constraint '
+            'WHERE confrelid = $1::regclass AND contype = \'f\'',
+        [table])
+    if references:
+        raise Exception(
+            '{} is referenced by foreign keys, which partitioned tables '
+            'can\'t be without a primary key that includes {}: {}.'.format(
+                table,
+                column,
+                ', '.join(row['conname'] for row in references)))
+    for row in db_instance.query_to_json(
+            'SELECT conname, pg_get_constraintdef(oid) AS definition '
+                'FROM pg_constraint '
+                'WHERE conrelid = $1::regclass AND contype = \'f\' '
+                'ORDER BY conname',
+            [table]) or []:
+        statements.append('ALTER TABLE {} ADD CONSTRAINT {} {};'.format(
+            copy, row['conname'], row['definition']))
+    db_instance.query_script('\n'.join(statements))
+
+def _create_partitions(table, column, first_month, last_month, name=None):
+    """Creates the partitions of `table` for the months from `first_month` to
+    `last_month` that don't exist yet, and returns their names. Partitions
+    are named after `name`, which defaults to the table's.
+
+    Rows of those months in the default partition are moved to the new
+    partitions, since a partition can't be created while the default one has
+    rows that belong in it."""
+    name = name or table
+    default = '{}.{}_default'.format(_SCHEMA, name)
+    _run_with_lock_retries(
+        'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT;'.format(
+            default, table))
+    existing = {n for n, _ in _get_partitions(table, name)}
+    created = []
+    month = first_month
+    while month <= last_month:
+        partition = '{}_p{}'.format(name, month.strftime('%Y%m'))
+        if partition not in existing:
+            create = (
+                'CREATE TABLE {}.{} PARTITION OF {}\n'
+                '    FOR VALUES FROM ({}) TO ({});'.format(
+                    _SCHEMA,
+                    partition,
+                    table,
+                    _format_month(month),
+                    _format_month(_add_months(month, 1))))
+            in_range = '{} >= {} AND {} < {}'.format(
+                column,
+                _format_month(month),
+                column,
+                _format_month(_add_months(month, 1)))
+            if db_instance.query(
+                    'SELECT EXISTS (SELECT 1 FROM {} WHERE {})'.format(
+                        default, in_range)).strip() == 't':
+                create = '\n'.join([
+                    'ALTER TABLE {} DETACH PARTITION {};'.format(
+                        table, default),
+                    create,
+                    'INSERT INTO {}.{} SELECT * FROM {} WHERE {};'.format(
+                        _SCHEMA, partition, default, in_range),
+                    'DELETE FROM {} WHERE {};'.format(default, in_range),
+                    'ALTER TABLE {} ATTACH PARTITION {} DEFAULT;'.format(
+                        table, default),
+                ])
+            _run_with_lock_retries(create)
+            created.append(partition)
+        month = _add_months(month, 1)
+    return created
+
+def _swap(table, key, copy, last_key):
+    """Copies the rows after `last_key` and replaces the table with its copy,
+    in one transaction that blocks writes to the table while it runs."""
+    statements = [
+        'LOCK TABLE {} IN EXCLUSIVE MODE;'.format(table),
+        'INSERT INTO {} SELECT * FROM {}{};'.format(
+            copy,
+            table,
+            '' if last_key is None else ' WHERE {} > {}'.format(
+                key, _quote_literal(last_key))),
+    ]
+    # Sequences owned by the table's columns would be dropped with it.
+    for row in db_instance.query_to_json(
+            'SELECT attname, pg_get_serial_sequence($1, attname) AS sequence '
+                'FROM pg_attribute '
+                'WHERE attrelid = $1::regclass '
+                    'AND attnum > 0 '
+                    'AND NOT attisdropped '
+                    'AND pg_get_serial_sequence($1, attname) IS NOT NULL',
+            [table]) or []:
+        statements.append('ALTER SEQUENCE {} OWNED BY {}.{};'.format(
+            row['sequence'], copy, row['attname']))
+    statements.extend([
+        'DROP TABLE {};'.format(table),
+        'ALTER TABLE {} RENAME TO {};'.format(copy, table),
+    ])
+    for index in _get_indexes(copy):
+        statements.append('ALTER INDEX {} RENAME TO {};'.format(
+            index['index_name'], _get_original_name(index['index_name'])))
+    _run_with_lock_retries('\n'.join(statements))
+
+def _run_with_lock_retries(script):
+    """Runs a script in a transaction that gives up on locks it can't get
+    within `_LOCK_TIMEOUT`, retrying with exponential backoff."""
+    script = 'SET LOCAL lock_timeout = {};\n{}'.format(
+        _quote_literal(_LOCK_TIMEOUT), script)
+    attempt = 0
+    while True:
+        try:
+            return db_instance.run_script(script)
+        except db.QueryError as e:
+            if (e.sqlstate not in (
+                        db.LOCK_NOT_AVAILABLE, db.DEADLOCK_DETECTED)
+                    or attempt >= _LOCK_RETRIES):
+                raise
+        # Waits are randomized so that retries don't line up with whatever
+        # holds the lock.
+        delay = min(_LOCK_BACKOFF * 2 ** attempt, _LOCK_MAX_BACKOFF)
+        delay *= random.uniform(0.5, 1)
+        attempt += 1
+        print('Could not acquire locks, retrying in {:.1f}s ({} of {}).'.format(
+            delay, attempt, _LOCK_RETRIES))
+        time.sleep(delay)
+
+def _get_indexes(table):
+    return db_instance.query_to_json(_INDEXES, [table]) or []
+
+def _get_temporary_name(index):
+    # PostgreSQL truncates names to 63 characters.
+    return 'tmp_' + index['index_name'][0:59]
+
+def _get_original_name(name):
+    assert name.startswith('tmp_')
+    return name[len('tmp_'):]
+
+def _get_partition_column(table):
+    rows = db_instance.query_to_json(
+        'SELECT a.attname FROM pg_partitioned_table p '
+            'JOIN pg_attribute a '
+                'ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0] '
+            'WHERE p.partrelid = $1::regclass AND p.partstrat = \'r\'',
+        [table])
+    if not rows:
+        raise Exception('{} is not partitioned by range.'.format(table))
+    return rows[0]['attname']
+
+def _get_this_month():
+    return _parse_month(db_instance.query(
+        'SELECT to_char(now() AT TIME ZONE \'UTC\', \'YYYYMM\')').strip())
+
+def _is_partitioned(table):
+    return db_instance.query(
+        'SELECT relkind FROM pg_class WHERE oid = $1::regclass',
+        [table]).strip() == 'p'
+
+def _exists(table):
+    return db_instance.query(
+        'SELECT to_regclass($1) IS NOT NULL', [table]).strip() == 't'
+
+def _parse_month(text):
+    return datetime.date(int(text[0:4]), int(text[4:6]), 1)
+
+def _add_months(month, count):
+    months = month.year * 12 + month.month - 1 + count
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+def _format_month(month):
+    return _quote_literal('{} 00:00:00+00'.format(month.isoformat()))
+
+def _quote_literal(value):
+    return '\'{}\''.format(value.replace('\'', '\'\''))
@@ -0,0 +1,109 @@
+import datetime
+import unittest
+from unittest import mock
+from tools.db_manager import partitioning
+
+class _FakeDatabase:
+    """Answers the queries `maintain` makes about a table partitioned by
+    month, with partitions for the months in `months`, and records the
+    scripts it runs."""
+
+    def __init__(self, this_month, cutoff, months):
+        self.this_month = this_month
+        self.cutoff = cutoff
+        self.months = months
+        self.scripts = []
+        self.retentions = []
+
+    def query(self, sql, params=None):
+        if '$1::interval >= $2::interval' in sql:
+            return 't\n'
+        if 'now() - $1::interval' in sql:
+            self.retentions.append(params[0])
+            return self.cutoff + '\n'
+        if 'to_char(now()' in sql:
+            return self.this_month + '\n'
+        if 'relkind' in sql:
+            return 'p\n'
+        assert sql.startswith('SELECT EXISTS'), sql
+        return 'f\n'
+
+    def query_to_json(self, sql, params=None):
+        if 'pg_partitioned_table' in sql:
+            return [{'attname': 'creation_time'}]
+        assert 'pg_inherits' in sql, sql
+        return [
+            {'relname': 'event_logs_p{}'.format(m)} for m in self.months]
+
+    def run_script(self, script):
+        self.scripts.append(script)
+
+class PartitionByRangeTest(unittest.TestCase):
+
+    def test_rejects_old_servers(self):
+        with mock.patch.object(partitioning, 'db_instance') as db_instance:
+            db_instance.query.return_value = '100006\n'
+            with self.assertRaisesRegex(
+                    Exception, 'PostgreSQL 11.0 or later.*version 10.6'):
+                partitioning.partition_by_range('event_logs', 'creation_time')
+            db_instance.query.assert_called_once_with(
+                'SHOW server_version_num')
+
+class MaintainTest(unittest.TestCase):
+
+    def _maintain(self, database, **kwargs):
+        with mock.patch.object(partitioning, 'db_instance', database):
+            return partitioning.maintain('event_logs', **kwargs)
+
+    def test_creates_months_ahead(self):
+        database = _FakeDatabase('202011', None, ['202011'])
+        created, detached = self._maintain(database)
+        self.assertEqual(
+            created,
+            ['event_logs_p202012', 'event_logs_p202101', 'event_logs_p202102'])
+        self.assertEqual(detached, [])
+        self.assertIn(
+            'FOR VALUES FROM (\'2020-12-01 00:00:00+00\') '
+                'TO (\'2021-01-01 00:00:00+00\');',
+            database.scripts[1])
+
+    def test_detaches_months_before_cutoff(self):
+        # A cutoff in March 2020 leaves the partition for March, which has
+        # rows newer than the cutoff, and those of later months.
+        database = _FakeDatabase(
+            '202006', '202003',
+            ['201912', '202001', '202002', '202003', '202006', '202007',
+                '202008', '202009'])
+        created, detached = self._maintain(
+            database, detach_after='90 days', drop=True)
+        self.assertEqual(created, [])
+        self.assertEqual(database.retentions, ['90 days'])
+        self.assertEqual(
+            detached,
+            ['event_logs_p201912', 'event_logs_p202001', 'event_logs_p202002'])
+        self.assertIn(
+            'ALTER TABLE event_logs DETACH PARTITION '
+                'partitions.event_logs_p202002;\n'
+                'DROP TABLE partitions.event_logs_p202002;',
+            database.scripts[-1])
+
+    def test_detach_without_drop(self):
+        database = _FakeDatabase(
+            '202006', '202003',
+            ['202002', '202006', '202007', '202008', '202009'])
+        _, detached = self._maintain(database, detach_after='3 months')
+        self.assertEqual(detached, ['event_logs_p202002'])
+        self.assertNotIn('DROP TABLE', database.scripts[-1])
+
+    def test_add_months(self):
+        for month, count, expected in [
+                ((2020, 11), 3, (2021, 2)),
+                ((2020, 1), -1, (2019, 12)),
+                ((2020, 12), 0, (2020, 12)),
+                ((2019, 6), 18, (2020, 12))]:
+            self.assertEqual(
+                partitioning._add_months(datetime.date(*month, 1), count),
+                datetime.date(*expected, 1))
+
+if __name__ == '__main__':
+    unittest.main()
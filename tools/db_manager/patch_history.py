@@ -0,0 +1,126 @@
+"""Records how long each patch took to apply, and what it did while applying.
+
+Each applied patch gets a row in `db_patch_history` with its duration, the
+number of rows it inserted, updated or deleted, and the locks it acquired. Rows
+are grouped by deploy, which is taken from `$DB_MANAGER_DEPLOY` (the image
+version of the `pb-glaze-db-updater` job) or else the host name, and by run, so
+that retries of the same deploy can be told apart.
+
+The table is created by a patch, so patches applied before it are not
+recorded. The SQL from this module checks for the table first, which is why it
+has to be run as a psql script."""
+
+import os
+import socket
+import uuid
+from tools.db_manager import db_instance
+
+# The rows changed and locks held by the current transaction so far. Locks are
+# held until the end of the transaction, so the locks a patch acquired are the
+# ones held after it that weren't held before it.
+_ROW_COUNT = '''(
+        SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0)
+            FROM pg_stat_xact_user_tables)'''
+_LOCKS = '''ARRAY(
+        SELECT coalesce(l.relation::regclass::text, l.locktype) || ' ' || l.mode
+            FROM pg_locks l
+            WHERE l.pid = pg_backend_pid()
+                AND l.granted
+                AND l.locktype NOT IN ('virtualxid', 'transactionid')
+                AND (l.relation IS NULL OR l.relation NOT IN (
+                    SELECT oid FROM pg_class
+                        WHERE relnamespace = 'pg_catalog'::regnamespace)))'''
+
+# Saves the state before a patch in psql variables. The followup reads them
+# back, so both have to run in the same psql session and transaction.
+_START = '''SELECT clock_timestamp() AS start_time,
+        {row_count} AS row_count,
+        {locks} AS locks
+    \\gset db_manager_'''.format(row_count=_ROW_COUNT, locks=_LOCKS)
+_FINISH = '''INSERT INTO db_patch_history
+        (hash, file_name, deploy, run_id, start_time, duration,
+            rows_affected, locks)
+    SELECT '\\x{hash}', {file_name}, {deploy}, {run_id},
+        :'db_manager_start_time',
+        clock_timestamp() - :'db_manager_start_time'::timestamptz,
+        {row_count} - :db_manager_row_count,
+        ARRAY(
+            SELECT unnest({locks})
+            EXCEPT
+            SELECT unnest(:'db_manager_locks'::text[]));'''
+
+# Runs SQL only if the table exists. It's checked each time, since the patch
+# that creates it can be in the middle of a batch.
+_IF_TABLE_EXISTS = '''SELECT to_regclass('db_patch_history') IS NOT NULL
+        AS has_history
+    \\gset db_manager_
+\\if :db_manager_has_history
+{}
+\\endif'''
+
+_run_id = uuid.uuid4().hex
+
+def has_table():
+    return db_instance.query(
+        'SELECT to_regclass(\'db_patch_history\') IS NOT NULL').strip() == 't'
+
+def get_deploy():
+    return os.environ.get('DB_MANAGER_DEPLOY') or socket.gethostname()
+
+def start_sql():
+    """psql commands to run just before a patch's SQL."""
+    return _START
+
+def finish_sql(hash, file_name):
+    """psql commands to run just after a patch's SQL, in the same transaction,
+    to record it."""
+    return _IF_TABLE_EXISTS.format(_FINISH.format(
+        hash=hash,
+        file_name=_quote(file_name),
+        deploy=_quote(get_deploy()),
+        run_id=_quote(_run_id),
+        row_count=_ROW_COUNT,
+        locks=_LOCKS))
+
+def record_sql(hashes, file_names, start_time, duration):
+    """psql commands recording patches that weren't timed by the database,
+    such as Python and shell patches. Rows affected and locks are unknown for
+    these."""
+    values = ','.join(
+        '\n    (\'\\x{}\', {}, {}, {}, to_timestamp({}), '
+            'make_interval(secs => {}))'.format(
+                hash,
+                _quote(file_name),
+                _quote(get_deploy()),
+                _quote(_run_id),
+                start_time,
+                duration)
+        for hash, file_name in zip(hashes, file_names))
+    return _IF_TABLE_EXISTS.format(
+        'INSERT INTO db_patch_history ({}) VALUES {};'.format(
+            'hash, file_name, deploy, run_id, start_time, duration', values))
+
+def get_slowest_patches(limit):
+    return db_instance.query_rows(
+        '''SELECT file_name, deploy, start_time,
+                extract(epoch FROM duration)::float8 AS seconds,
+                rows_affected, locks
+            FROM db_patch_history
+            ORDER BY duration DESC
+            LIMIT {}'''.format(int(limit)))
+
+def get_deploys(limit):
+    """Gets the total upgrade time of each of the most recent deploys."""
+    return db_instance.query_rows(
+        '''SELECT deploy,
+                min(start_time) AS start_time,
+                count(DISTINCT run_id) AS runs,
+                count(*) AS patches,
+                extract(epoch FROM sum(duration))::float8 AS seconds
+            FROM db_patch_history
+            GROUP BY deploy
+            ORDER BY min(start_time) DESC
+            LIMIT {}'''.format(int(limit)))
+
+def _quote(value):
+    return '\'{}\''.format(value.replace('\'', '\'\''))
@@ -2,8 +2,10 @@ import collections
 from enum import Enum
 import functools
 import hashlib
+import json
 import os
 import re
+import tempfile
 from tools.db_manager import db_instance
 from tools.db_manager import file_reader
 from tools.workspace import workspace
@@ -11,11 +13,19 @@ from tools.workspace import workspace
  # TODO: Create this patch.
 _INIT_PATCH = workspace.resolve('0000.sql')
 
+# Caches the hash of each patch file so that unchanged patches don't have to be
+# read. Stored in the patch directory.
+_INDEX_FILE_NAME = '.patch_index'
+_INDEX_VERSION = 1
+
 _patch_path = None
 
-_Patch = collections.namedtuple(
-    'Patch',
-    ['hash', 'content', 'file_path', 'type'])
+class _Patch(collections.namedtuple('Patch', ['hash', 'file_path', 'type'])):
+    __slots__ = ()
+
+    @property
+    def content(self):
+        return file_reader.read(self.file_path)
 
 class PatchType(Enum):
     SQL = 1
@@ -47,10 +57,8 @@ def _get_unapplied_patches_and_invalid_hashes():
     return unapplied_patches, applied_hashes
 
 def _get_applied_patch_hashes():
-    patches = db_instance.query_to_json('SELECT hash FROM db_patches')
-    if patches is None:
-        return list()
-    return {_process_hash_from_db(p['hash']) for p in patches}
+    rows = db_instance.query_rows('SELECT hash FROM db_patches')
+    return {r['hash'].hex() for r in rows}
 
 @functools.lru_cache(maxsize=1)
 def get_patches():
@@ -59,8 +67,10 @@ def get_patches():
     file_re = re.compile(r'(?:(\d+)(\.sql|\.py|\.sh))$')
     dir_re = re.compile(r'^\d+$')
     ignore_re = re.compile(r'(\.swp|~)$')
+    index = _read_index()
+    new_index = dict()
     for file in os.listdir(get_patch_dir()):
-        if ignore_re.search(file):
+        if ignore_re.search(file) or file == _INDEX_FILE_NAME:
             continue
         # Directories named after patch numbers may be used to supply assets for
         # a patch, but they are ignored by db manager.
@@ -79,17 +89,72 @@ def get_patches():
             assert matches.group(2) == '.sh'
             patch_type = PatchType.SHELL
 
-        file_content = file_reader.read(file_full_path)
-        hash = _compute_hash(file_content)
+        stat = os.stat(file_full_path)
+        entry = index.get(file)
+        if entry is None or not _index_entry_matches(entry, stat, patch_type):
+            entry = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'inode': stat.st_ino,
+                'type': patch_type.name,
+                'hash': _compute_hash(file_reader.read(file_full_path)),
+            }
+        new_index[file] = entry
+        hash = entry['hash']
         if hash in seen_patch_hashes:
             raise Exception(
                 'Duplicate patch hash found "{}" for file "{}".'.format(
                     hash, file_full_path))
         seen_patch_hashes.add(hash)
 
-        patches.add(_Patch(hash, file_content, file_full_path, patch_type))
+        patches.add(_Patch(hash, file_full_path, patch_type))
+    if new_index != index:
+        _write_index(new_index)
     return sorted(patches, key=lambda p: p.file_path)
 
+def _index_entry_matches(entry, stat, patch_type):
+    return (
+        entry.get('size') == stat.st_size
+        and entry.get('mtime') == stat.st_mtime_ns
+        and entry.get('inode') == stat.st_ino
+        and entry.get('type') == patch_type.name)
+
+def _get_index_path():
+    return os.path.join(get_patch_dir(), _INDEX_FILE_NAME)
+
+def _read_index():
+    try:
+        with open(_get_index_path(), 'rt', encoding='utf8') as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return dict()
+    if index.get('version') != _INDEX_VERSION:
+        return dict()
+    return index['patches']
+
+def _write_index(patches):
+    """Saves the index, if the patch directory is writable.
+
+    The index is only a cache, so failing to write it is not an error."""
+    file = None
+    try:
+        with tempfile.NamedTemporaryFile(
+                'wt',
+                encoding='utf8',
+                dir=get_patch_dir(),
+                prefix=_INDEX_FILE_NAME,
+                suffix='~',
+                delete=False) as file:
+            json.dump(
+                {'version': _INDEX_VERSION, 'patches': patches},
+                file,
+                indent=2,
+                sort_keys=True)
+        os.replace(file.name, _get_index_path())
+    except OSError:
+        if file is not None and os.path.exists(file.name):
+            os.remove(file.name)
+
 def verify_no_invalid_hashes():
     _, hashes = _get_unapplied_patches_and_invalid_hashes()
     if len(hashes) > 0:
@@ -98,7 +163,3 @@ def verify_no_invalid_hashes():
 
 def _compute_hash(content):
     return hashlib.sha384(content.encode('utf-8')).hexdigest()
-
-def _process_hash_from_db(hash):
-    assert hash[0:2] == '\\x'
-    return hash[2:]
@@ -0,0 +1,145 @@
+"""Deletes old rows from large tables in small batches.
+
+For example, to delete logs from before a cutoff:
+
+    prune(
+        'event_logs',
+        'creation_time < $1::timestamptz',
+        ['2020-01-01 00:00:00+00'],
+        key='id')
+
+Rows are visited in order of `key`, each batch starting after the last key of
+the one before, so that no batch has to skip over the index entries of rows
+that were already deleted. Each batch is deleted by one statement that commits
+on its own, so locks are held briefly and autovacuum can keep up. The
+statements are prepared once and reused for every batch.
+
+Rows can be archived as NDJSON before they're deleted. Each batch is then read
+and written to the archive first, and only deleted once the archive has been
+flushed, so if the process dies in between, rows may be archived twice but are
+never deleted without being archived. The condition should not depend on the
+time, as with `now()`, so that it matches the same rows when they're deleted as
+when they were archived."""
+
+import collections
+import json
+import time
+from tools.db_manager import db_instance
+
+PruneResult = collections.namedtuple(
+    'PruneResult',
+    ['table', 'rows_deleted', 'batches', 'seconds'])
+
+# Finds the range of keys of the next batch. The range ends at the batch's
+# last key, and includes every row with that key, so `key` needn't be unique.
+_BATCH = '''
+WITH batch AS (
+    SELECT {key} AS prune_key FROM {table}
+        WHERE {after}({condition})
+        ORDER BY {key}
+        LIMIT {batch_size})'''
+
+# Deletes a batch and prints a JSON object with the number of rows visited and
+# deleted, and the last key of the batch.
+_DELETE_BATCH = _BATCH + ''',
+deleted AS (
+    DELETE FROM {table}
+        WHERE {after}{key} <= (SELECT max(prune_key) FROM batch)
+            AND ({condition})
+        RETURNING 1)
+SELECT json_build_object(
+    'visited', (SELECT count(*) FROM batch),
+    'last_key', (SELECT max(prune_key)::text FROM batch),
+    'count', (SELECT count(*) FROM deleted))'''
+
+# Prints a JSON object with the number of rows visited, the last key of the
+# batch and the rows to archive.
+_SELECT_BATCH = _BATCH + '''
+SELECT json_build_object(
+    'visited', (SELECT count(*) FROM batch),
+    'last_key', (SELECT max(prune_key)::text FROM batch),
+    'rows', (
+        SELECT json_agg({table}) FROM {table}
+            WHERE {after}{key} <= (SELECT max(prune_key) FROM batch)
+                AND ({condition})))'''
+
+# Deletes the rows of a batch that was archived, ending at the last key.
+_DELETE_RANGE = '''
+WITH deleted AS (
+    DELETE FROM {table}
+        WHERE {after}{key} <= ${last}
+            AND ({condition})
+        RETURNING 1)
+SELECT count(*) FROM deleted'''
+
+# Seconds between progress reports.
+_PROGRESS_INTERVAL = 10
+
+def prune(
+        table,
+        condition,
+        params=(),
+        key='id',
+        batch_size=1000,
+        pause=0,
+        archive=None):
+    """Deletes the rows of `table` matching `condition`, which may use
+    `params` as `$1`, `$2` and so on, in batches of `batch_size` ordered by
+    `key`, waiting `pause` seconds between batches.
+
+    If `archive` is a text file object, each row is written to it as a line of
+    JSON before it's deleted. Returns a `PruneResult`."""
+    params = list(params)
+    start = time.time()
+    last_report = start
+    last_key = None
+    rows_deleted = 0
+    batches = 0
+    while True:
+        after = ''
+        batch_params = params
+        if last_key is not None:
+            after = '{} > ${} AND '.format(key, len(params) + 1)
+            batch_params = params + [last_key]
+        sql = dict(
+            table=table,
+            key=key,
+            after=after,
+            condition=condition,
+            batch_size=int(batch_size))
+        if archive is None:
+            result = json.loads(db_instance.query(
+                _DELETE_BATCH.format(**sql), batch_params))
+            count = result['count']
+        else:
+            result = json.loads(db_instance.query(
+                _SELECT_BATCH.format(**sql), batch_params))
+            if result['last_key'] is None:
+                break
+            for row in result['rows'] or []:
+                archive.write(json.dumps(row) + '\n')
+            archive.flush()
+            count = int(db_instance.query(
+                _DELETE_RANGE.format(last=len(batch_params) + 1, **sql),
+                batch_params + [result['last_key']]))
+        if result['last_key'] is None:
+            break
+        last_key = result['last_key']
+        rows_deleted += count
+        batches += 1
+        if result['visited'] < batch_size:
+            # That was the last batch.
+            break
+
+        now = time.time()
+        if now - last_report >= _PROGRESS_INTERVAL:
+            last_report = now
+            print('Pruning {}: {} rows deleted ({:.0f}/s), at {} {}.'.format(
+                table,
+                rows_deleted,
+                rows_deleted / (now - start),
+                key,
+                last_key))
+        if pause > 0:
+            time.sleep(pause)
+    return PruneResult(table, rows_deleted, batches, time.time() - start)
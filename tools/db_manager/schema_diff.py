@@ -0,0 +1,212 @@
+"""Compares two `pg_dump --schema-only` outputs object by object.
+
+Dumps are split into the objects named by pg_dump's `-- Name: ...` headers, and
+the columns of each table are split into objects of their own. Objects are
+matched by type, schema and name, so differences in the order pg_dump writes
+objects in, and in whitespace, are not reported, but columns whose order in
+their table changed are, since pg_dump writes them in table order."""
+
+import collections
+import difflib
+import json
+import re
+
+SchemaObject = collections.namedtuple(
+    'SchemaObject',
+    ['type', 'schema', 'name'])
+
+SchemaDiff = collections.namedtuple(
+    'SchemaDiff',
+    # `added`, `removed` and `changed` are lists of `SchemaObject`s, and
+    # `reordered` is a list of `Reordering`s. `saved` and `current` map every
+    # object to its definition.
+    ['added', 'removed', 'changed', 'reordered', 'saved', 'current'])
+
+Reordering = collections.namedtuple(
+    'Reordering',
+    # `table` is a `SchemaObject`. `saved` and `current` are the names of the
+    # columns that are in both dumps, in order.
+    ['table', 'saved', 'current'])
+
+_HEADER_RE = re.compile(
+    r'^-- Name: (.+?); Type: ([^;]+); Schema: ([^;]+); Owner: ?(.*)$')
+_CREATE_TABLE_RE = re.compile(r'^CREATE (?:UNLOGGED )?TABLE (\S+) \($')
+_COLUMN_NAME_RE = re.compile(r'^\s*("(?:[^"]|"")*"|\S+)')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def parse_schema(dump):
+    """Splits a schema dump into an ordered dict mapping each `SchemaObject`
+    to its definition."""
+    return _parse_schema(dump)[0]
+
+def _parse_schema(dump):
+    """Like `parse_schema`, but also gets a dict mapping each table to the
+    `SchemaObject`s of its columns, in order."""
+    objects = collections.OrderedDict()
+    columns = collections.OrderedDict()
+    key = None
+    body = []
+    for line in dump.splitlines():
+        matches = _HEADER_RE.match(line)
+        if matches:
+            _add_object(objects, columns, key, body)
+            key = SchemaObject(
+                matches.group(2), matches.group(3), matches.group(1))
+            body = []
+        # Everything before the first header is session setup.
+        elif key is not None and line != '--' and not line.startswith(
+                '-- PostgreSQL database dump'):
+            body.append(line.rstrip())
+    _add_object(objects, columns, key, body)
+    return objects, columns
+
+def diff_schemas(saved_dump, current_dump):
+    """Diffs two schema dumps. Runs in time linear in the size of the
+    dumps."""
+    saved, saved_columns = _parse_schema(saved_dump)
+    current, current_columns = _parse_schema(current_dump)
+    reordered = []
+    for table, columns in current_columns.items():
+        if table not in saved_columns:
+            continue
+        # Added and removed columns don't count as a reordering.
+        saved_order = [
+            _get_column_name(table, k)
+            for k in saved_columns[table] if k in current]
+        current_order = [
+            _get_column_name(table, k) for k in columns if k in saved]
+        if saved_order != current_order:
+            reordered.append(Reordering(table, saved_order, current_order))
+    return SchemaDiff(
+        [k for k in current if k not in saved],
+        [k for k in saved if k not in current],
+        [
+            k for k in current
+            if k in saved and _collapse(saved[k]) != _collapse(current[k])],
+        reordered,
+        saved,
+        current)
+
+def is_empty(diff):
+    return not (
+        diff.added or diff.removed or diff.changed or diff.reordered)
+
+def format_diff(diff):
+    """Formats a diff for people to read."""
+    out = []
+    if diff.added:
+        out.append('Added:')
+        out.extend('    + ' + _format_object(k) for k in diff.added)
+    if diff.removed:
+        out.append('Removed:')
+        out.extend('    - ' + _format_object(k) for k in diff.removed)
+    if diff.changed:
+        out.append('Changed:')
+        for key in diff.changed:
+            out.append('    ~ ' + _format_object(key))
+            out.extend(
+                '        ' + line.rstrip('\n')
+                for line in difflib.unified_diff(
+                    diff.saved[key].splitlines(),
+                    diff.current[key].splitlines(),
+                    'saved',
+                    'current',
+                    lineterm='')
+                # The file names add nothing for a single object.
+                if not line.startswith(('---', '+++')))
+    if diff.reordered:
+        out.append('Reordered:')
+        for reordering in diff.reordered:
+            out.append('    ~ ' + _format_object(reordering.table))
+            out.append('        saved:   ' + ', '.join(reordering.saved))
+            out.append('        current: ' + ', '.join(reordering.current))
+    return '\n'.join(out)
+
+def diff_to_json(diff):
+    """Formats a diff for machines to read."""
+    return json.dumps(
+        {
+            'added': [_object_to_json(k, current=diff.current[k])
+                for k in diff.added],
+            'removed': [_object_to_json(k, saved=diff.saved[k])
+                for k in diff.removed],
+            'changed': [
+                _object_to_json(
+                    k, saved=diff.saved[k], current=diff.current[k])
+                for k in diff.changed],
+            'reordered': [
+                dict(
+                    _object_to_json(r.table),
+                    saved_columns=r.saved,
+                    current_columns=r.current)
+                for r in diff.reordered],
+        },
+        indent=2)
+
+def _add_object(objects, columns, key, body):
+    if key is None:
+        return
+    definition = '\n'.join(line for line in body if line != '')
+    if key.type == 'TABLE':
+        definition = _split_columns(objects, columns, key, definition)
+    # pg_dump can emit several entries with the same name, such as ACLs.
+    if key in objects:
+        definition = objects[key] + '\n' + definition
+    objects[key] = definition
+
+def _split_columns(objects, columns, key, definition):
+    """Adds the columns and inline constraints of a table as objects of their
+    own, and returns the rest of the table's definition. The table's columns
+    are also added to `columns`, in order."""
+    lines = definition.split('\n')
+    rest = []
+    in_columns = False
+    for line in lines:
+        if in_columns:
+            # The column list ends at its closing parenthesis, which may be
+            # followed by clauses such as `PARTITION BY` or `INHERITS` that
+            # stay in the table's definition.
+            if line.startswith(')'):
+                in_columns = False
+                rest.append(line)
+                continue
+            column = line.strip().rstrip(',')
+            name = _COLUMN_NAME_RE.match(column).group(1)
+            if name == 'CONSTRAINT':
+                column_type = 'TABLE CONSTRAINT'
+                name = _COLUMN_NAME_RE.match(column[len(name):]).group(1)
+            else:
+                column_type = 'COLUMN'
+            column_key = SchemaObject(
+                column_type, key.schema, key.name + '.' + name)
+            objects[column_key] = column
+            if column_type == 'COLUMN':
+                columns.setdefault(key, []).append(column_key)
+        else:
+            if _CREATE_TABLE_RE.match(line):
+                in_columns = True
+            rest.append(line)
+    return '\n'.join(rest)
+
+def _get_column_name(table, key):
+    return key.name[len(table.name) + 1:]
+
+def _collapse(definition):
+    return _WHITESPACE_RE.sub(' ', definition).strip()
+
+def _format_object(key):
+    if key.schema == '-':
+        return '{} {}'.format(key.type, key.name)
+    return '{} {}.{}'.format(key.type, key.schema, key.name)
+
+def _object_to_json(key, saved=None, current=None):
+    out = {
+        'type': key.type,
+        'schema': None if key.schema == '-' else key.schema,
+        'name': key.name,
+    }
+    if saved is not None:
+        out['saved'] = saved
+    if current is not None:
+        out['current'] = current
+    return out
@@ -0,0 +1,86 @@
+import unittest
+from tools.db_manager import schema_diff
+
+_PARTITIONED_TABLE = '''
+--
+-- Name: event_logs; Type: TABLE; Schema: public; Owner: pod_admin
+--
+
+CREATE TABLE public.event_logs (
+    id integer NOT NULL,
+    creation_time timestamp with time zone DEFAULT now() NOT NULL
+)
+PARTITION BY RANGE (creation_time);
+
+
+ALTER TABLE public.event_logs OWNER TO pod_admin;
+
+--
+-- Name: event_logs event_logs_pkey; Type: CONSTRAINT; Schema: public; Owner: pod_admin
+--
+
+ALTER TABLE ONLY public.event_logs
+    ADD CONSTRAINT event_logs_pkey PRIMARY KEY (id, creation_time);
+'''
+
+class ParseSchemaTest(unittest.TestCase):
+
+    def test_partitioned_table(self):
+        objects = schema_diff.parse_schema(_PARTITIONED_TABLE)
+        self.assertEqual(
+            [(k.type, k.name) for k in objects],
+            [
+                ('COLUMN', 'event_logs.id'),
+                ('COLUMN', 'event_logs.creation_time'),
+                ('TABLE', 'event_logs'),
+                ('CONSTRAINT', 'event_logs event_logs_pkey'),
+            ])
+        self.assertEqual(
+            objects[schema_diff.SchemaObject('TABLE', 'public', 'event_logs')],
+            'CREATE TABLE public.event_logs (\n'
+            ')\n'
+            'PARTITION BY RANGE (creation_time);\n'
+            'ALTER TABLE public.event_logs OWNER TO pod_admin;')
+
+    def test_partitioning_is_diffed(self):
+        unpartitioned = _PARTITIONED_TABLE.replace(
+            ')\nPARTITION BY RANGE (creation_time);', ');')
+        diff = schema_diff.diff_schemas(unpartitioned, _PARTITIONED_TABLE)
+        self.assertEqual(diff.added, [])
+        self.assertEqual(diff.removed, [])
+        self.assertEqual(
+            [k.name for k in diff.changed], ['event_logs'])
+
+    def test_reordered_columns(self):
+        id = '    id integer NOT NULL'
+        creation_time = (
+            '    creation_time timestamp with time zone DEFAULT now() NOT NULL')
+        reordered = _PARTITIONED_TABLE.replace(
+            '{},\n{}\n'.format(id, creation_time),
+            '{},\n{}\n'.format(creation_time, id))
+        diff = schema_diff.diff_schemas(_PARTITIONED_TABLE, reordered)
+        self.assertFalse(schema_diff.is_empty(diff))
+        self.assertEqual(diff.changed, [])
+        self.assertEqual(
+            diff.reordered,
+            [
+                schema_diff.Reordering(
+                    schema_diff.SchemaObject('TABLE', 'public', 'event_logs'),
+                    ['id', 'creation_time'],
+                    ['creation_time', 'id']),
+            ])
+        self.assertIn(
+            'current: creation_time, id', schema_diff.format_diff(diff))
+
+    def test_added_column_is_not_reordered(self):
+        added = _PARTITIONED_TABLE.replace(
+            '    id integer NOT NULL,\n',
+            '    name text,\n'
+            '    id integer NOT NULL,\n')
+        diff = schema_diff.diff_schemas(_PARTITIONED_TABLE, added)
+        self.assertEqual(
+            [k.name for k in diff.added], ['event_logs.name'])
+        self.assertEqual(diff.reordered, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+"""Splits PostgreSQL scripts into statements.
+
+Understands string literals (including `E''` strings), quoted identifiers,
+dollar-quoted strings and both kinds of comments, so semicolons inside any of
+them are not mistaken for statement terminators."""
+
+import collections
+import re
+
+Statement = collections.namedtuple(
+    'Statement',
+    # `start` and `end` are offsets into the script, with `end` just past the
+    # terminating semicolon (if any). `code` is the text normalized as described
+    # for `_NON_TRANSACTIONAL_RE`. `transactional` is False for statements that
+    # cannot be run inside a transaction block.
+    ['text', 'start', 'end', 'code', 'transactional'])
+
+# Patches that must run outside a single transaction say so with a
+# `-- db_manager: no_transaction` comment before their first statement.
+NO_TRANSACTION = 'no_transaction'
+ANNOTATIONS = {NO_TRANSACTION}
+
+_IDENTIFIER_START = r'A-Za-z_\u0080-\uffff'
+_IDENTIFIER_CHAR = _IDENTIFIER_START + r'0-9$'
+_DOLLAR_TAG = (
+    r'(?:[' + _IDENTIFIER_START + r'][' + _IDENTIFIER_START + r'0-9]*)?')
+
+_TOKEN_RE = re.compile(
+    r'(?P<line_comment>--)'
+    r'|(?P<block_comment>/\*)'
+    r'|(?P<escape_string>(?<![' + _IDENTIFIER_CHAR + r'])[eE]\')'
+    r'|(?P<string>\')'
+    r'|(?P<identifier>")'
+    r'|(?P<dollar>(?<![' + _IDENTIFIER_CHAR + r'])\$' + _DOLLAR_TAG + r'\$)'
+    r'|(?P<semicolon>;)')
+_STRING_END_RE = re.compile(r"(?:[^']|'')*'")
+_ESCAPE_STRING_END_RE = re.compile(r"(?:[^'\\]|\\.|'')*'", re.DOTALL)
+_IDENTIFIER_END_RE = re.compile(r'(?:[^"]|"")*"')
+_BLOCK_COMMENT_RE = re.compile(r'/\*|\*/')
+_LEADING_COMMENT_RE = re.compile(r'\s*(?:(?P<line>--[^\n]*)|/\*)')
+_ANNOTATION_RE = re.compile(r'^--\s*db_manager:(.*)$')
+
+# Matched against a statement with comments removed, literals blanked out,
+# whitespace collapsed and keywords upper-cased.
+_NON_TRANSACTIONAL_RE = re.compile(
+    r'^(?:'
+    r'ALTER TYPE \S+ ADD VALUE'
+    r'|CREATE (?:UNIQUE )?INDEX CONCURRENTLY'
+    r'|DROP INDEX CONCURRENTLY'
+    r'|REINDEX .*CONCURRENTLY'
+    r'|ALTER TABLE .* DETACH PARTITION .* CONCURRENTLY'
+    r'|(?:CREATE|DROP) (?:DATABASE|TABLESPACE)'
+    r'|ALTER DATABASE \S+ SET TABLESPACE'
+    r'|ALTER SYSTEM'
+    r'|(?:CREATE|DROP) SUBSCRIPTION'
+    r'|VACUUM'
+    r')\b')
+
+def split_statements(script):
+    """Splits a script into a list of `Statement`s.
+
+    Text that contains nothing but whitespace and comments is dropped. A final
+    statement without a terminating semicolon is still returned."""
+    statements = []
+    start = 0
+    # The statement's text with comments removed and literals blanked out,
+    # used to recognize what kind of statement it is.
+    code = []
+    pos = 0
+    length = len(script)
+    while pos < length:
+        matches = _TOKEN_RE.search(script, pos)
+        if matches is None:
+            code.append(script[pos:])
+            break
+        code.append(script[pos:matches.start()])
+        kind = matches.lastgroup
+        if kind == 'line_comment':
+            newline = script.find('\n', matches.end())
+            pos = length if newline < 0 else newline
+            code.append(' ')
+        elif kind == 'block_comment':
+            pos = _skip_block_comment(script, matches.end())
+            code.append(' ')
+        elif kind == 'escape_string':
+            pos = _skip(_ESCAPE_STRING_END_RE, script, matches.end(), 'string')
+            code.append("''")
+        elif kind == 'string':
+            pos = _skip(_STRING_END_RE, script, matches.end(), 'string')
+            code.append("''")
+        elif kind == 'identifier':
+            pos = _skip(_IDENTIFIER_END_RE, script, matches.end(), 'identifier')
+            code.append(script[matches.start():pos])
+        elif kind == 'dollar':
+            tag = matches.group()
+            end = script.find(tag, matches.end())
+            if end < 0:
+                raise _unterminated(script, matches.start(), 'dollar quote')
+            pos = end + len(tag)
+            code.append("''")
+        else:
+            assert kind == 'semicolon'
+            pos = matches.end()
+            _add_statement(statements, script, start, pos, code)
+            start = pos
+            code = []
+    _add_statement(statements, script, start, length, code)
+    return statements
+
+def check_terminated(script):
+    """Raises if a script ends inside a string, quoted identifier, dollar
+    quote or block comment, where psql would wait for the rest of it."""
+    split_statements(script)
+
+def is_transactional(statement_code):
+    """Whether a statement, as normalized by `split_statements`, may be run
+    inside a transaction block."""
+    return not _NON_TRANSACTIONAL_RE.match(statement_code)
+
+def get_annotations(script):
+    """Gets the set of directives given in `-- db_manager: ...` comments,
+    which may list several directives separated by commas. Only comments
+    before the first statement count, so that the text can appear in strings
+    and function bodies."""
+    annotations = set()
+    for comment in _get_leading_line_comments(script):
+        matches = _ANNOTATION_RE.match(comment)
+        if matches is None:
+            continue
+        for annotation in matches.group(1).split(','):
+            annotation = annotation.strip().lower()
+            if annotation == '':
+                continue
+            if annotation not in ANNOTATIONS:
+                raise Exception('Unknown db_manager annotation "{}".'.format(
+                    annotation))
+            annotations.add(annotation)
+    return annotations
+
+def _get_leading_line_comments(script):
+    comments = []
+    pos = 0
+    while True:
+        matches = _LEADING_COMMENT_RE.match(script, pos)
+        if matches is None:
+            return comments
+        if matches.group('line') is not None:
+            comments.append(matches.group('line'))
+            pos = matches.end()
+        else:
+            pos = _skip_block_comment(script, matches.end())
+
+def _add_statement(statements, script, start, end, code):
+    normalized = _normalize(''.join(code))
+    if normalized == '' or normalized == ';':
+        return
+    text = script[start:end]
+    # Comments before a statement are kept with it, but not whitespace.
+    stripped = text.lstrip()
+    start += len(text) - len(stripped)
+    statements.append(Statement(
+        stripped, start, end, normalized, is_transactional(normalized)))
+
+def _normalize(code):
+    return re.sub(r'\s+', ' ', code).strip().upper()
+
+def _skip(end_re, script, pos, description):
+    matches = end_re.match(script, pos)
+    if matches is None:
+        raise _unterminated(script, pos - 1, description)
+    return matches.end()
+
+def _skip_block_comment(script, pos):
+    # Block comments nest in PostgreSQL.
+    depth = 1
+    while depth > 0:
+        matches = _BLOCK_COMMENT_RE.search(script, pos)
+        if matches is None:
+            raise _unterminated(script, pos - 2, 'block comment')
+        depth += 1 if matches.group() == '/*' else -1
+        pos = matches.end()
+    return pos
+
+def _unterminated(script, pos, description):
+    return Exception('Unterminated {} starting on line {}.'.format(
+        description, script.count('\n', 0, pos) + 1))
@@ -0,0 +1,118 @@
+import unittest
+from tools.db_manager import sql_lexer
+
+class SplitStatementsTest(unittest.TestCase):
+
+    def _split(self, script):
+        return [s.text for s in sql_lexer.split_statements(script)]
+
+    def test_dollar_quotes(self):
+        self.assertEqual(
+            self._split(
+                'CREATE FUNCTION f() RETURNS int AS $body$\n'
+                '    SELECT 1; SELECT $$;$$;\n'
+                '$body$ LANGUAGE sql;\n'
+                'SELECT $1, a$b FROM c;'),
+            [
+                'CREATE FUNCTION f() RETURNS int AS $body$\n'
+                    '    SELECT 1; SELECT $$;$$;\n'
+                    '$body$ LANGUAGE sql;',
+                'SELECT $1, a$b FROM c;',
+            ])
+
+    def test_strings(self):
+        self.assertEqual(
+            self._split(
+                'SELECT E\'a\\\';b\', \'c\'\';d\', "e;""f";\n'
+                'SELECT \'g\\\';'),
+            [
+                'SELECT E\'a\\\';b\', \'c\'\';d\', "e;""f";',
+                'SELECT \'g\\\';',
+            ])
+
+    def test_comments(self):
+        statements = sql_lexer.split_statements(
+            '-- Only a comment; not a statement.\n'
+            '/* Nested /* ; */ ; */\n'
+            ';\n'
+            '-- Kept with the statement.\n'
+            'SELECT 1 -- ;\n'
+            '    + 2;\n'
+            '  SELECT 3\n')
+        self.assertEqual(
+            [s.text for s in statements],
+            [
+                '-- Kept with the statement.\nSELECT 1 -- ;\n    + 2;',
+                'SELECT 3\n',
+            ])
+        self.assertEqual(statements[0].code, 'SELECT 1 + 2')
+        self.assertEqual(statements[1].code, 'SELECT 3')
+
+    def test_normalized_code(self):
+        statements = sql_lexer.split_statements(
+            'select \'x\', $$y$$, "Z" from\n\tt;')
+        self.assertEqual(statements[0].code, 'SELECT \'\', \'\', "Z" FROM T')
+
+    def test_non_transactional(self):
+        for script, transactional in [
+                ('CREATE INDEX a ON b (c);', True),
+                ('create unique index concurrently a on b (c);', False),
+                ('/* x */ DROP INDEX CONCURRENTLY a;', False),
+                ('ALTER TYPE a ADD VALUE \'b\';', False),
+                ('VACUUM (ANALYZE) a;', False),
+                ('SELECT \'VACUUM\';', True),
+                ('COMMENT ON TABLE a IS \'CREATE DATABASE b\';', True)]:
+            statement, = sql_lexer.split_statements(script)
+            self.assertEqual(statement.transactional, transactional, script)
+
+    def test_unterminated(self):
+        for script, error in [
+                ('SELECT 1;\nSELECT \'a;', 'string starting on line 2'),
+                ('SELECT E\'a\\\';', 'string starting on line 1'),
+                ('SELECT "a;', 'identifier'),
+                ('SELECT 1;\n\nSELECT $a$ $b$;', 'dollar quote .* line 3'),
+                ('/* /* */ SELECT 1;', 'block comment')]:
+            with self.assertRaisesRegex(Exception, 'Unterminated ' + error):
+                sql_lexer.check_terminated(script)
+
+class GetAnnotationsTest(unittest.TestCase):
+
+    def test_leading_comments(self):
+        self.assertEqual(
+            sql_lexer.get_annotations(
+                '/* A /* nested */ comment. */\n'
+                '-- Some notes.\n'
+                '  --db_manager: NO_TRANSACTION, \n'
+                'CREATE INDEX CONCURRENTLY a ON b (c);\n'),
+            {sql_lexer.NO_TRANSACTION})
+
+    def test_after_first_statement(self):
+        self.assertEqual(
+            sql_lexer.get_annotations(
+                'SELECT 1;\n'
+                '-- db_manager: no_transaction\n'),
+            set())
+
+    def test_in_function_body(self):
+        self.assertEqual(
+            sql_lexer.get_annotations(
+                'CREATE FUNCTION f() RETURNS int AS $$\n'
+                '-- db_manager: no_transaction\n'
+                'SELECT 1;\n'
+                '$$ LANGUAGE sql;\n'),
+            set())
+
+    def test_in_string(self):
+        self.assertEqual(
+            sql_lexer.get_annotations(
+                'SELECT \'\n'
+                '-- db_manager: no_transaction\n'
+                '\';\n'),
+            set())
+
+    def test_unknown_annotation(self):
+        with self.assertRaisesRegex(Exception, 'Unknown db_manager'):
+            sql_lexer.get_annotations('-- db_manager: no_transactions\n')
+
+if __name__ == '__main__':
+    unittest.main()